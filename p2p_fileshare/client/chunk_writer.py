@@ -0,0 +1,197 @@
+"""
+This module contains the write-behind stage of the download pipeline.
+ChunkDownloaders hand the chunks they receive to a ChunkWriter instead of writing them to the disk themselves, so that
+a slow disk doesn't stall the network side (as long as the writer keeps up on average). The writer's queue is bounded,
+so once it's full the downloaders block until the disk catches up.
+"""
+import logging
+import time
+from queue import Queue, Empty, Full
+from threading import Thread
+from typing import Optional, Callable
+from p2p_fileshare.framework.types import FileObject
+from p2p_fileshare.framework.buffer_pool import BufferPool
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkWriterException(Exception):
+    pass
+
+
+class ChunkWriter(object):
+    """
+    Writes the chunks of a single file from a dedicated thread.
+    Queued chunks are sorted and adjacent ones are coalesced into larger writes. A chunk is only marked as downloaded
+    once it's durable according to the fsync policy:
+        fsync_interval=None - chunks are marked once written (durability is left to the OS).
+        fsync_interval=0 - the file is synced after every batch of writes.
+        fsync_interval=N - the file is synced at most once every N seconds, chunks written in between are marked once
+            the sync covering them has been performed.
+    If a buffer pool is given, the data of the queued chunks are buffers taken from it, which the writer releases once
+    they're written.
+    """
+    DEFAULT_MAX_QUEUED_CHUNKS = 8
+    DEFAULT_FSYNC_INTERVAL = 1  # seconds
+    MAX_WRITE_SIZE = 16 * 1024 * 1024
+    CLOSE_POLL_INTERVAL = 0.1  # seconds
+
+    def __init__(self, file_object: FileObject, max_queued_chunks: int = DEFAULT_MAX_QUEUED_CHUNKS,
+                 fsync_interval: Optional[float] = DEFAULT_FSYNC_INTERVAL,
+                 on_durable: Callable[[list[int]], None] = None, buffer_pool: BufferPool = None):
+        """
+        :param on_durable: A function called (from the writer thread) with the chunks that were just marked as
+        downloaded.
+        """
+        self._file_object = file_object
+        self._on_durable = on_durable
+        self._buffer_pool = buffer_pool
+        self._queue = Queue(max_queued_chunks)  # type: Queue[Optional[tuple[int, bytes]]]
+        self._fsync_interval = fsync_interval
+        self._last_sync = time.time()
+        self._unsynced_chunks = []  # type: list[int]
+        self._error = None  # type: Optional[Exception]
+        self._thread = Thread(target=self.__start)
+        self._thread.start()
+
+    def put(self, chunk_num: int, chunk_data: bytes, timeout: Optional[float] = None):
+        """
+        Queues a chunk to be written, blocking while the queue is full.
+        :raises: ChunkWriterException if the chunk can't be queued (the writer has failed, or the timeout has expired),
+        in which case the chunk's buffer is still owned by the caller.
+        """
+        if self._error is not None:
+            raise ChunkWriterException(f"The chunk writer has failed: {self._error}")
+        if not self._thread.is_alive():
+            raise ChunkWriterException("The chunk writer was closed")
+        try:
+            self._queue.put((chunk_num, chunk_data), timeout=timeout)
+        except Full:
+            raise ChunkWriterException("Timed out waiting for the chunk writer")
+
+    @property
+    def error(self) -> Optional[Exception]:
+        """
+        The error the writer has failed on, if any (once it has failed, no more chunks can be queued).
+        """
+        return self._error
+
+    def close(self):
+        """
+        Writes all the queued chunks (and syncs them, unless fsync is disabled), and stops the writer thread.
+        """
+        # the writer thread might have died, in which case nobody would make room in the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=self.CLOSE_POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        self._thread.join()
+
+    def _next_batch(self) -> tuple[list[tuple[int, bytes]], bool]:
+        """
+        Waits for queued chunks, and takes as many of them as possible without waiting any further.
+        :return: A 2-tuple of (the chunks taken, whether the writer should stop).
+        """
+        timeout = None
+        if self._unsynced_chunks:
+            timeout = max(self._last_sync + self._fsync_interval - time.time(), 0)
+        try:
+            items = [self._queue.get(timeout=timeout)]
+        except Empty:
+            return [], False
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except Empty:
+                break
+        should_stop = None in items
+        return sorted(item for item in items if item is not None), should_stop
+
+    def _write_batch(self, chunks: list[tuple[int, bytes]]):
+        """
+        Writes the chunks, coalescing runs of adjacent chunks (each of which but the last one must be a full chunk).
+        """
+        run_start, run_data = None, []
+        run_size = 0
+        for chunk_num, chunk_data in chunks:
+            if run_data and chunk_num == run_start + len(run_data) and run_size + len(chunk_data) <= self.MAX_WRITE_SIZE \
+                    and len(run_data[-1]) == self._file_object.chunk_size:
+                run_data.append(chunk_data)
+                run_size += len(chunk_data)
+                continue
+            self._write_run(run_start, run_data)
+            run_start, run_data, run_size = chunk_num, [chunk_data], len(chunk_data)
+        self._write_run(run_start, run_data)
+
+    def _release_buffers(self, chunks: list[tuple[int, bytes]]):
+        if self._buffer_pool is not None:
+            for _, chunk_data in chunks:
+                self._buffer_pool.release(chunk_data)
+
+    def _write_run(self, first_chunk_num: Optional[int], run_data: list[bytes]):
+        if not run_data:
+            return
+        chunk_nums = list(range(first_chunk_num, first_chunk_num + len(run_data)))
+        try:
+            # a single chunk is written as is, rather than copied
+            run = run_data[0] if len(run_data) == 1 else b"".join(run_data)
+            self._file_object.write_chunks(first_chunk_num, run)
+        except Exception as e:
+            logger.error(f"Failed writing chunks {chunk_nums}: {e}")
+            self._error = e
+            for chunk_num in chunk_nums:
+                self._file_object.return_failed_chunk(chunk_num)
+            return
+        self._unsynced_chunks += chunk_nums
+
+    def _sync(self, force: bool = False):
+        """
+        Syncs the file if the fsync policy requires it, and marks the synced chunks as downloaded.
+        """
+        if not self._unsynced_chunks:
+            return
+        if self._fsync_interval is not None:
+            if not force and time.time() - self._last_sync < self._fsync_interval:
+                return
+            try:
+                self._file_object.sync()
+            except Exception as e:
+                logger.error(f"Failed syncing chunks {self._unsynced_chunks}: {e}")
+                self._error = e
+                for chunk_num in self._unsynced_chunks:
+                    self._file_object.return_failed_chunk(chunk_num)
+                self._unsynced_chunks = []
+                return
+            self._last_sync = time.time()
+        self._file_object.mark_downloaded(self._unsynced_chunks)
+        if self._on_durable is not None:
+            try:
+                self._on_durable(self._unsynced_chunks)
+            except Exception as e:
+                logger.error(f"Failed handling durable chunks: {e}")
+        self._unsynced_chunks = []
+
+    def __start(self):
+        should_stop = False
+        try:
+            while not should_stop:
+                chunks, should_stop = self._next_batch()
+                try:
+                    self._write_batch(chunks)
+                finally:
+                    self._release_buffers(chunks)
+                self._sync(force=should_stop)
+        except Exception as e:
+            logger.error(f"The chunk writer has crashed: {e}")
+            self._error = e
+            # nobody would write the chunks which are still queued
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is not None:
+                    self._release_buffers([item])
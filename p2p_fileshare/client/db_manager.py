@@ -1,51 +1,284 @@
 """
 This module governs the client-side database actions, mainly keeping the state of the application between runs (so
-that the client would be aware of files he's currently sharing).
+that the client would be aware of files he's currently sharing, and could resume unfinished downloads).
 """
+import os
 import sqlite3
+from threading import Lock
+from typing import Optional
 
 from p2p_fileshare.framework.db import AbstractDBManager, db_func
+from p2p_fileshare.framework.types import SharedFile, LEGACY_CHUNK_SIZE
+from p2p_fileshare.framework.hashing import HashCache, FileKey
 
 
-class DBManager(AbstractDBManager):
+class LocalShare(object):
+    """
+    The information kept in memory about a file shared by the client.
+    """
+    def __init__(self, file_path: str, chunk_size: Optional[int], file_key: Optional[FileKey]):
+        """
+        :param chunk_size: The chunk size of the file, or None if it isn't known (the file was shared before chunk
+        sizes were kept).
+        :param file_key: The key of the file when it was hashed, or None if it isn't known.
+        """
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.file_key = file_key
+
+
+class DBManager(AbstractDBManager, HashCache):
     """
     This class governs access to the client's db - used to hold persistent data across multiple starts of the
     application.
+    The DB also caches the hashes of local files, so that files which haven't changed aren't hashed again when they're
+    re-shared (or after a restart).
+    The shares are looked up for every request of another client, so they are indexed in memory - the index is loaded
+    once (see load_shares), and is updated along with the DB on each change, so lookups never access the DB.
     """
     DEFAULT_DB_PATH = "client_db.db"
 
+    def __init__(self, db_path=None):
+        super().__init__(db_path)
+        self._shares = None  # type: Optional[dict[str, LocalShare]]
+        self._shares_lock = Lock()
+
     def _create_empty_db(self, cursor):
         cursor.execute("CREATE TABLE files (file_path text, unique_id text, PRIMARY KEY('unique_id'));")
+        self._upgrade_db(cursor)
+
+    def _upgrade_db(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS downloads (unique_id text, local_path text, name text, "
+                       "modification_time integer, size integer, downloaded_chunks blob, "
+                       "PRIMARY KEY('unique_id', 'local_path'));")
+        cursor.execute("CREATE TABLE IF NOT EXISTS chunk_hashes (unique_id text, chunk_hashes blob, "
+                       "PRIMARY KEY('unique_id'));")
+        # a single entry per path - hashing a file again replaces the entry of its previous state
+        cursor.execute("CREATE TABLE IF NOT EXISTS hash_cache (file_path text, inode integer, size integer, "
+                       "modification_time_ns integer, chunk_size integer, unique_id text, chunk_hashes blob, "
+                       "PRIMARY KEY('file_path'));")
+        cursor.execute("CREATE TABLE IF NOT EXISTS shared_directories (directory_path text, "
+                       "PRIMARY KEY('directory_path'));")
+        # the files shared as part of shared directories (these are shared like any other file as well)
+        cursor.execute("CREATE TABLE IF NOT EXISTS directory_files (file_path text, directory_path text, "
+                       "unique_id text, PRIMARY KEY('file_path'));")
+        # rows added before chunk sizes were kept have a null chunk size, meaning the legacy chunk size
+        self._add_column_if_missing(cursor, "downloads", "chunk_size integer")
+        self._add_column_if_missing(cursor, "chunk_hashes", "chunk_size integer")
+
+    @staticmethod
+    def _add_column_if_missing(cursor: sqlite3.Cursor, table: str, column: str):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column.split()[0] not in [table_column[1] for table_column in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    @db_func
+    def load_shares(self, cursor: sqlite3.Cursor):
+        """
+        Loads the in-memory index of the shares from the DB (otherwise it's loaded on its first use).
+        """
+        cursor.execute("select files.unique_id, files.file_path, chunk_hashes.chunk_size, hash_cache.inode, "
+                       "hash_cache.size, hash_cache.modification_time_ns from files "
+                       "left join chunk_hashes on chunk_hashes.unique_id = files.unique_id "
+                       "left join hash_cache on hash_cache.file_path = files.file_path "
+                       "and hash_cache.unique_id = files.unique_id")
+        shares = {}
+        for unique_id, file_path, chunk_size, inode, size, modification_time_ns in cursor.fetchall():
+            file_key = (file_path, inode, size, modification_time_ns) if inode is not None else None
+            shares[unique_id] = LocalShare(file_path, chunk_size, file_key)
+        self._shares = shares
+
+    @property
+    def _share_index(self) -> dict[str, LocalShare]:
+        if self._shares is None:
+            with self._shares_lock:
+                if self._shares is None:
+                    self.load_shares()
+        return self._shares
+
+    def get_share(self, unique_id: str) -> Optional[LocalShare]:
+        return self._share_index.get(unique_id)
+
+    def get_shared_file_path(self, unique_id: str) -> Optional[str]:
+        share = self._share_index.get(unique_id)
+        return share.file_path if share is not None else None
+
+    def is_there_any_shared_file(self) -> bool:
+        return len(self._share_index) > 0
+
+    def add_share(self, unique_id: str, file_path: str):
+        self.add_shares([(unique_id, file_path)])
+
+    def add_shares(self, shares: list[tuple[str, str]]):
+        """
+        Adds multiple shares in a single transaction.
+        :param shares: A list of (unique ID, file path) tuples. A file which is already shared is updated with its new
+        path.
+        """
+        share_index = self._share_index
+        for unique_id, share in self._add_shares(shares).items():
+            share_index[unique_id] = share
 
     @db_func
-    def get_shared_file_path(self, cursor: sqlite3.Cursor, unique_id: str):
-        cursor.execute(f"select file_path from files where unique_id='{unique_id}'")
-        result = cursor.fetchall()
-        if len(result) == 0:
-            return None
-        return result[0][0]
+    def _add_shares(self, cursor: sqlite3.Cursor, shares: list[tuple[str, str]]) -> dict[str, LocalShare]:
+        """
+        :return: The index entries of the added shares.
+        """
+        cursor.executemany("insert or replace into files values (?, ?)", [(file_path, unique_id)
+                                                                          for unique_id, file_path in shares])
+        added_shares = {}
+        for unique_id, file_path in shares:
+            cursor.execute("select chunk_size from chunk_hashes where unique_id = ?", (unique_id,))
+            chunk_size = cursor.fetchone()
+            cursor.execute("select file_path, inode, size, modification_time_ns from hash_cache "
+                           "where file_path = ? and unique_id = ?", (os.path.abspath(file_path), unique_id))
+            file_key = cursor.fetchone()
+            added_shares[unique_id] = LocalShare(file_path, chunk_size[0] if chunk_size is not None else None,
+                                                 tuple(file_key) if file_key is not None else None)
+        return added_shares
+
+    def list_shares(self) -> list[tuple[str, str]]:
+        """
+        :return: A list of (file path, unique ID) tuples.
+        """
+        return [(share.file_path, unique_id) for unique_id, share in list(self._share_index.items())]
+
+    def remove_share(self, unique_id: str):
+        if unique_id not in self._share_index:
+            raise ValueError(f"File with unique ID {unique_id} isn't shared by the client!")
+        self.remove_shares([unique_id])
+
+    def remove_shares(self, unique_ids: list[str]):
+        """
+        Removes multiple shares in a single transaction, ignoring files which aren't shared by the client.
+        """
+        share_index = self._share_index
+        self._remove_shares(unique_ids)
+        for unique_id in unique_ids:
+            share_index.pop(unique_id, None)
 
     @db_func
-    def is_there_any_shared_file(self, cursor: sqlite3.Cursor):
-        cursor.execute("select * from files")
-        return len(cursor.fetchall()) > 0
+    def _remove_shares(self, cursor: sqlite3.Cursor, unique_ids: list[str]):
+        cursor.executemany("delete from files where unique_id = ?", [(unique_id,) for unique_id in unique_ids])
+        cursor.executemany("delete from chunk_hashes where unique_id = ?", [(unique_id,) for unique_id in unique_ids])
+
+    def add_chunk_hashes(self, chunk_hashes: list[tuple[str, bytes, int]]):
+        """
+        Keeps the hashes of the chunks of shared files, so that they could be served to downloaders.
+        :param chunk_hashes: A list of (unique ID, hashes of the file's chunks, chunk size of the file) tuples.
+        """
+        share_index = self._share_index
+        self._add_chunk_hashes(chunk_hashes)
+        for unique_id, _, chunk_size in chunk_hashes:
+            if unique_id in share_index:
+                share_index[unique_id].chunk_size = chunk_size
 
     @db_func
-    def add_share(self, cursor: sqlite3.Cursor, unique_id: str, file_path: str):
-        cursor.execute(f"insert into files values ('{file_path}', '{unique_id}')")
+    def _add_chunk_hashes(self, cursor: sqlite3.Cursor, chunk_hashes: list[tuple[str, bytes, int]]):
+        cursor.executemany("insert or replace into chunk_hashes values (?, ?, ?)", chunk_hashes)
 
     @db_func
-    def list_shares(self, cursor: sqlite3.Cursor):
-        cursor.execute(f"select * from files")
-        return cursor.fetchall()
+    def get_chunk_hashes(self, cursor: sqlite3.Cursor, unique_id: str) -> Optional[bytes]:
+        cursor.execute("select chunk_hashes from chunk_hashes where unique_id = ?", (unique_id,))
+        result = cursor.fetchone()
+        return result[0] if result is not None else None
 
-    def _is_file_shared(self, cursor: sqlite3.Cursor, unique_id: str) -> bool:
-        cursor.execute(f"select * from files where unique_id='{unique_id}'")
-        result = cursor.fetchall()
-        return len(result) > 0
+    def get_chunk_size(self, unique_id: str) -> Optional[int]:
+        """
+        :return: The chunk size chosen for a shared file, or None if it isn't known (the file isn't shared, or was
+        shared before chunk sizes were kept).
+        """
+        share = self._share_index.get(unique_id)
+        return share.chunk_size if share is not None else None
 
     @db_func
-    def remove_share(self, cursor: sqlite3.Cursor, unique_id: str):
-        if not self._is_file_shared(cursor, unique_id):
-            raise ValueError(f"File with unique ID {unique_id} isn't shared by the client!")
-        cursor.execute(f"delete from files where unique_id='{unique_id}'")
+    def get_cached_hashes(self, cursor: sqlite3.Cursor, file_key: FileKey, chunk_size: int) -> \
+            Optional[tuple[str, bytes]]:
+        cursor.execute("select unique_id, chunk_hashes from hash_cache where file_path = ? and inode = ? and size = ? "
+                       "and modification_time_ns = ? and chunk_size = ?", (*file_key, chunk_size))
+        result = cursor.fetchone()
+        return tuple(result) if result is not None else None
+
+    @db_func
+    def cache_hashes(self, cursor: sqlite3.Cursor, file_key: FileKey, chunk_size: int, file_hash: str,
+                     chunk_hashes: bytes):
+        cursor.execute("insert or replace into hash_cache values (?, ?, ?, ?, ?, ?, ?)",
+                       (*file_key, chunk_size, file_hash, chunk_hashes))
+
+    @db_func
+    def add_shared_directory(self, cursor: sqlite3.Cursor, directory_path: str):
+        cursor.execute("insert or replace into shared_directories values (?)", (directory_path,))
+
+    @db_func
+    def remove_shared_directory(self, cursor: sqlite3.Cursor, directory_path: str):
+        """
+        Forgets a shared directory along with its files (their shares are removed separately).
+        """
+        cursor.execute("delete from shared_directories where directory_path = ?", (directory_path,))
+        cursor.execute("delete from directory_files where directory_path = ?", (directory_path,))
+
+    @db_func
+    def list_shared_directories(self, cursor: sqlite3.Cursor) -> list[str]:
+        cursor.execute("select directory_path from shared_directories")
+        return [directory_path for directory_path, in cursor.fetchall()]
+
+    @db_func
+    def get_directory_files(self, cursor: sqlite3.Cursor, directory_path: str) -> \
+            dict[str, tuple[str, Optional[FileKey]]]:
+        """
+        :return: The unique ID of each of the files of a shared directory, along with the key the file had when it was
+        hashed (or None if it isn't known), by the path of the file.
+        """
+        cursor.execute("select directory_files.file_path, directory_files.unique_id, hash_cache.inode, "
+                       "hash_cache.size, hash_cache.modification_time_ns from directory_files left join hash_cache "
+                       "on hash_cache.file_path = directory_files.file_path "
+                       "and hash_cache.unique_id = directory_files.unique_id where directory_path = ?",
+                       (directory_path,))
+        return {file_path: (unique_id, (file_path, inode, size, modification_time_ns) if inode is not None else None)
+                for file_path, unique_id, inode, size, modification_time_ns in cursor.fetchall()}
+
+    @db_func
+    def add_directory_files(self, cursor: sqlite3.Cursor, directory_path: str, files: list[tuple[str, str]]):
+        """
+        :param files: A list of (file path, unique ID) tuples. Files which are already known are updated.
+        """
+        cursor.executemany("insert or replace into directory_files values (?, ?, ?)",
+                           [(file_path, directory_path, unique_id) for file_path, unique_id in files])
+
+    @db_func
+    def remove_directory_files(self, cursor: sqlite3.Cursor, file_paths: list[str]):
+        cursor.executemany("delete from directory_files where file_path = ?", [(file_path,) for file_path in file_paths])
+
+    @db_func
+    def add_download(self, cursor: sqlite3.Cursor, shared_file: SharedFile, local_path: str):
+        """
+        Starts keeping the state of a new download (replacing the state of a previous download of the file into the
+        same path).
+        """
+        cursor.execute("insert or replace into downloads values (?, ?, ?, ?, ?, ?, ?)",
+                       (shared_file.unique_id, local_path, shared_file.name, shared_file.modification_time,
+                        shared_file.size, b"", shared_file.chunk_size))
+
+    @db_func
+    def update_download(self, cursor: sqlite3.Cursor, unique_id: str, local_path: str, downloaded_chunks: bytes):
+        """
+        :param downloaded_chunks: A bitmap of the chunks that were downloaded (and are durable) so far.
+        """
+        cursor.execute("update downloads set downloaded_chunks = ? where unique_id = ? and local_path = ?",
+                       (downloaded_chunks, unique_id, local_path))
+
+    @db_func
+    def remove_download(self, cursor: sqlite3.Cursor, unique_id: str, local_path: str):
+        cursor.execute("delete from downloads where unique_id = ? and local_path = ?", (unique_id, local_path))
+
+    @db_func
+    def list_downloads(self, cursor: sqlite3.Cursor) -> list[tuple[SharedFile, str, bytes]]:
+        """
+        :return: A list of (file, local path, downloaded chunks bitmap) tuples - one for each unfinished download.
+        """
+        cursor.execute("select unique_id, local_path, name, modification_time, size, downloaded_chunks, chunk_size "
+                       "from downloads")
+        return [(SharedFile(unique_id, name, modification_time, size, [], chunk_size or LEGACY_CHUNK_SIZE), local_path,
+                 downloaded_chunks)
+                for unique_id, local_path, name, modification_time, size, downloaded_chunks, chunk_size
+                in cursor.fetchall()]
@@ -0,0 +1,82 @@
+"""
+This module walks the directories shared by the client, so that the files in them could be shared (and kept in sync
+with the directory's contents).
+"""
+import logging
+import os
+from queue import Queue
+from threading import Thread
+from typing import Iterator, Optional
+
+from p2p_fileshare.framework.hashing import FileKey
+
+
+logger = logging.getLogger(__name__)
+
+
+def scan_directory(directory_path: str) -> Iterator[FileKey]:
+    """
+    Recursively walks a directory using os.scandir (which reads the type of each entry along with its name, so only the
+    regular files found have to be stat'ed). Symbolic links are not followed.
+    :return: An iterator of the keys of all the regular files in the directory and its subdirectories.
+    """
+    pending_directories = [os.path.abspath(directory_path)]
+    while pending_directories:
+        try:
+            with os.scandir(pending_directories.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_directories.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            file_stats = entry.stat(follow_symlinks=False)
+                            yield entry.path, file_stats.st_ino, file_stats.st_size, file_stats.st_mtime_ns
+                    except OSError:
+                        logger.debug(f"Failed reading {entry.path}, skipping it")
+        except OSError:
+            logger.debug(f"Failed listing a directory in {directory_path}, skipping it")
+
+
+class ChangedFilesScanner(object):
+    """
+    Scans a directory in a background thread, queueing the paths of files which have changed since the previous scan
+    so that they could be hashed while the scan goes on. The queue is bounded, so that the scan doesn't run too far
+    ahead of the hashing.
+    """
+    MAX_PENDING_FILES = 100
+
+    def __init__(self, directory_path: str, known_files: dict[str, FileKey]):
+        """
+        :param known_files: The keys the files of the directory had when they were last hashed, by their paths.
+        """
+        self._directory_path = directory_path
+        self._known_files = known_files
+        self._changed_files = Queue(self.MAX_PENDING_FILES)
+        self.found_files = set()  # type: set[str]
+        self._scan_thread = Thread(target=self._scan, daemon=True)
+        self._scan_thread.start()
+
+    def _scan(self):
+        try:
+            for file_key in scan_directory(self._directory_path):
+                self.found_files.add(file_key[0])
+                if self._known_files.get(file_key[0]) != file_key:
+                    self._changed_files.put(file_key[0])
+        finally:
+            self._changed_files.put(None)
+
+    def __iter__(self) -> Iterator[str]:
+        """
+        Iterates the paths of the changed files, until the scan is done.
+        """
+        changed_file = self._changed_files.get()  # type: Optional[str]
+        while changed_file is not None:
+            yield changed_file
+            changed_file = self._changed_files.get()
+        self._scan_thread.join()
+
+    def get_removed_files(self) -> set[str]:
+        """
+        :return: The paths of the known files which weren't found by the scan (must be called once the scan is done).
+        """
+        return set(self._known_files) - self.found_files
@@ -0,0 +1,165 @@
+"""
+This module keeps the downloads of the client, making sure that only a few of them run at a time (queued downloads don't
+use the server channel, the disk or any peer until they're started).
+"""
+import logging
+from itertools import count
+from threading import Lock
+from typing import Optional
+
+from p2p_fileshare.client.file_transfer import FileDownloader, ChunkDownloadSlots
+
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadManager(object):
+    """
+    Runs at most max_active_downloads downloads at a time, queueing the rest by their priorities (downloads of the same
+    priority are started in the order they were queued). The active downloads share one budget of concurrent chunk
+    downloads and origin sessions (see ChunkDownloadSlots).
+    Downloads are identified by their index in the list of downloads (as returned by list_downloads).
+    All methods of this class are thread safe.
+    """
+    MAX_ACTIVE_DOWNLOADS = 4
+    MAX_CHUNK_DOWNLOADS = MAX_ACTIVE_DOWNLOADS * FileDownloader.MAX_CHUNK_DOWNLOADERS
+    MAX_PEER_SESSIONS = 4  # concurrent chunk downloads from each origin, over all downloads
+
+    def __init__(self, max_active_downloads: int = MAX_ACTIVE_DOWNLOADS, max_chunk_downloads: int = MAX_CHUNK_DOWNLOADS,
+                 max_peer_sessions: int = MAX_PEER_SESSIONS):
+        self._max_active_downloads = max_active_downloads
+        self.download_slots = ChunkDownloadSlots(max_chunk_downloads, max_peer_sessions)
+        self._downloads = []  # type: list[FileDownloader]
+        self._active_downloads = set()  # type: set[FileDownloader]
+        # the queued downloads, along with the order in which they were queued
+        self._queued_downloads = {}  # type: dict[FileDownloader, int]
+        self._queue_order = count()
+        self._lock = Lock()
+
+    def add_download(self, downloader: FileDownloader):
+        """
+        Queues a download which hasn't been started (it's started once there's room for it).
+        The downloader's on_stopped callback must be download_stopped.
+        """
+        with self._lock:
+            self._downloads.append(downloader)
+            self._queued_downloads[downloader] = next(self._queue_order)
+            self._start_queued_downloads()
+
+    def has_download(self, unique_id: str, local_path: str) -> bool:
+        with self._lock:
+            return any(downloader.file_info.unique_id == unique_id and downloader.local_path == local_path
+                       for downloader in self._downloads)
+
+    def list_downloads(self) -> list[FileDownloader]:
+        with self._lock:
+            return list(self._downloads)
+
+    def get_download(self, downloader_id: int) -> Optional[FileDownloader]:
+        with self._lock:
+            return self._get_download(downloader_id)
+
+    def _get_download(self, downloader_id: int) -> Optional[FileDownloader]:
+        if not (0 <= downloader_id < len(self._downloads)):
+            logger.warning('Unknown downloader')
+            return None
+        return self._downloads[downloader_id]
+
+    def _sorted_queue(self) -> list[FileDownloader]:
+        return sorted(self._queued_downloads,
+                      key=lambda downloader: (-downloader.priority, self._queued_downloads[downloader]))
+
+    def queue_position(self, downloader: FileDownloader) -> Optional[int]:
+        """
+        :return: The amount of queued downloads which would be started before the download, or None if it isn't queued.
+        """
+        with self._lock:
+            if downloader not in self._queued_downloads:
+                return None
+            return self._sorted_queue().index(downloader)
+
+    def _start_queued_downloads(self):
+        """
+        Starts the queued downloads with the highest priorities, as long as there's room for them.
+        Must be called while holding the lock.
+        """
+        for downloader in self._sorted_queue():
+            if len(self._active_downloads) >= self._max_active_downloads:
+                return
+            if downloader.is_running:
+                continue  # it's still releasing its resources since it was paused, download_stopped will be called
+            self._queued_downloads.pop(downloader)
+            self._active_downloads.add(downloader)
+            logger.debug(f"Starting the download of {downloader.file_info.name} into {downloader.local_path}")
+            try:
+                downloader.start()
+            except Exception as e:
+                logger.error(f"Failed starting the download into {downloader.local_path}: {e}")
+                self._active_downloads.discard(downloader)
+                downloader.stop()  # let the app know the download failed
+
+    def download_stopped(self, downloader: FileDownloader):
+        """
+        Called by a download's thread once it stops, either since it has ended or since it was paused.
+        """
+        with self._lock:
+            if not downloader.is_running:  # it might have been started again already, if it was paused
+                self._active_downloads.discard(downloader)
+            self._start_queued_downloads()
+
+    def pause_download(self, downloader_id: int):
+        with self._lock:
+            downloader = self._get_download(downloader_id)
+            if downloader is None or downloader.is_done():
+                return
+            self._queued_downloads.pop(downloader, None)
+            self._active_downloads.discard(downloader)
+            downloader.pause()
+            self._start_queued_downloads()
+
+    def resume_download(self, downloader_id: int):
+        """
+        Queues a paused download again.
+        """
+        with self._lock:
+            downloader = self._get_download(downloader_id)
+            if downloader is None or not downloader.is_paused or downloader in self._queued_downloads:
+                return
+            self._queued_downloads[downloader] = next(self._queue_order)
+            self._start_queued_downloads()
+
+    def set_priority(self, downloader_id: int, priority: float):
+        """
+        Changes the priority of a download, which determines both its place in the queue and its share of the download
+        bandwidth once it's active.
+        """
+        with self._lock:
+            downloader = self._get_download(downloader_id)
+            if downloader is not None:
+                downloader.priority = priority
+
+    def remove_download(self, downloader_id: int) -> Optional[FileDownloader]:
+        """
+        Stops a download and forgets about it.
+        :return: The removed download, if there was such a download.
+        """
+        with self._lock:
+            downloader = self._get_download(downloader_id)
+            if downloader is None:
+                return None
+            self._downloads.pop(downloader_id)
+            self._queued_downloads.pop(downloader, None)
+            self._active_downloads.discard(downloader)
+            downloader.stop()
+            self._start_queued_downloads()
+            return downloader
+
+    def stop(self):
+        """
+        Stops all the downloads (e.g. when the application exits), leaving them to be resumed on the next run.
+        """
+        with self._lock:
+            self._queued_downloads.clear()
+            self._active_downloads.clear()
+            for downloader in self._downloads:
+                downloader.stop()
@@ -0,0 +1,104 @@
+"""
+This module allows reading a file while it's being downloaded (e.g. playing a media file, or following a log file).
+"""
+import io
+import os
+from typing import Optional
+
+from p2p_fileshare.client.file_transfer import FileDownloader
+from p2p_fileshare.framework.storage import FileStorage
+
+
+class DownloadReader(io.RawIOBase):
+    """
+    A read-only, seekable file-like object over the local copy of a file which is being downloaded.
+    A read blocks until the chunk at the current position is downloaded, and then returns the downloaded data from the
+    position onwards (so it might return less data than requested, but never returns an empty result before the end of
+    the file). While it's blocked, the chunks from the position onwards (up to the downloader's read-ahead window) are
+    requested from the downloader as a priority hint.
+    """
+    def __init__(self, downloader: FileDownloader, timeout: Optional[float] = None):
+        """
+        :param timeout: The maximal amount of seconds a single read may block for (None means forever).
+        """
+        super().__init__()
+        self._downloader = downloader
+        self._timeout = timeout
+        self._position = 0
+        self._storage = None  # type: Optional[FileStorage]
+
+    @property
+    def name(self) -> str:
+        """
+        The name of the shared file.
+        """
+        return self._downloader.file_info.name
+
+    @property
+    def size(self) -> int:
+        return self._downloader.file_info.size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError(f"Invalid whence {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def prioritize_range(self, offset: int, length: int):
+        """
+        Lets the downloader know that the given range is about to be read, so that its chunks would be downloaded first
+        (e.g. when the whole range a reader is going to read is known in advance).
+        """
+        self._downloader.prioritize_range(offset, length)
+
+    def readinto(self, buffer) -> int:
+        """
+        :raises: TimeoutError if the data wasn't downloaded in time, IOError if the download has failed (or was
+        removed).
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        buffer = memoryview(buffer).cast('B')
+        end = min(self._position + len(buffer), self.size)
+        if end <= self._position:
+            return 0
+        chunk_size = self._downloader.file_info.chunk_size
+        chunk_num = self._position // chunk_size
+        if not self._downloader.is_chunk_downloaded(chunk_num):
+            self._downloader.prioritize_range(self._position, max(end - self._position,
+                                                                  self._downloader.READ_AHEAD_SIZE))
+            if not self._downloader.wait_for_chunk(chunk_num, self._timeout):
+                if self._downloader.is_done():
+                    raise IOError(f"The download of {self._downloader.local_path} has failed")
+                raise TimeoutError(f"Timed out waiting for chunk {chunk_num} of {self._downloader.local_path}")
+        # the data of the following chunks is returned as well, as long as they're downloaded
+        available_end = (chunk_num + 1) * chunk_size
+        while available_end < end and self._downloader.is_chunk_downloaded(available_end // chunk_size):
+            available_end += chunk_size
+        end = min(end, available_end)
+        if self._storage is None:
+            self._storage = FileStorage(self._downloader.local_path)
+        bytes_read = self._storage.read_into(self._position, buffer[:end - self._position])
+        self._position += bytes_read
+        return bytes_read
+
+    def close(self):
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+        super().close()
@@ -4,41 +4,351 @@ p2p fashion and start a file transfer.
 """
 from p2p_fileshare.framework.server import Server
 from p2p_fileshare.framework.channel import Channel
-from p2p_fileshare.framework.types import FileObject
-from p2p_fileshare.framework.messages import StartFileTransferMessage, ChunkDataResponseMessage, RTTCheckMessage, RTTResponseMessage
+from p2p_fileshare.framework.types import LEGACY_CHUNK_SIZE
+from p2p_fileshare.framework.storage import FileStorage
+from p2p_fileshare.framework.messages import StartFileTransferMessage, ChunkDataResponseMessage, RTTCheckMessage, \
+    RTTResponseMessage, LoadReportMessage, PeerExchangeMessage, GeneralErrorMessage, ChunkHashesRequestMessage, \
+    ChunkHashesMessage, RangeRequestMessage, RangeDataResponseMessage, BusyMessage
+from p2p_fileshare.framework.hashing import calculate_file_hashes
 from p2p_fileshare.framework.selectable_event import signal
+from p2p_fileshare.framework.bandwidth import upload_limiter
+from p2p_fileshare.framework.buffer_pool import chunk_buffers
 from p2p_fileshare.client.db_manager import DBManager
+from p2p_fileshare.client.peer_exchange import PeerTable
 from logging import getLogger
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Optional
 import socket
+import time
 
 
 logger = getLogger(__file__)
 
+RANGE_BLOCK_SIZE = 256 * 1024  # the maximal amount of data sent in a single RangeDataResponseMessage
+UPLOAD_BUFFER_TIMEOUT = 3  # seconds, shorter than the chunk timeout of downloaders
+
+
+class UploadStatistics(object):
+    """
+    Hands out the upload slots of the sharing server, and keeps track of the transfers it performs so that its load can
+    be reported to the metadata server.
+    When all the slots are taken, uploads wait in a queue for up to MAX_QUEUE_WAIT seconds. The downloaders waiting in
+    the queue take turns getting the freed slots, so that a downloader which requests many chunks at once doesn't
+    starve the others.
+    All methods of this class are thread safe.
+    """
+    RATE_WINDOW = 10  # seconds
+    MAX_QUEUE_WAIT = 3  # seconds, shorter than the chunk timeout of downloaders
+
+    def __init__(self, max_uploads: int, max_queued_uploads: int = 0):
+        self._max_uploads = max_uploads
+        self._max_queued_uploads = max_queued_uploads
+        self._active_uploads = 0
+        self._recent_uploads = deque()  # type: deque[tuple[float, int]]
+        # the queued uploads of each downloader (each one is set once the upload gets a slot), and the order in which the
+        # downloaders get the freed slots
+        self._queued_uploads = {}  # type: dict[str, deque[Event]]
+        self._downloaders_order = deque()  # type: deque[str]
+        self._amount_of_queued_uploads = 0
+        self._lock = Condition()
+
+    def try_start_upload(self) -> bool:
+        """
+        Takes one of the upload slots, if one is free.
+        :return: Whether a slot was available (if it wasn't, the upload must not start).
+        """
+        with self._lock:
+            if self._active_uploads >= self._max_uploads:
+                return False
+            self._active_uploads += 1
+            return True
+
+    def start_upload(self, downloader: str) -> bool:
+        """
+        Takes one of the upload slots, waiting in the queue for one if they're all taken.
+        :param downloader: Identifies the downloading client, so that the queue would be fair between downloaders.
+        :return: Whether a slot was taken (if it wasn't, the upload must not start).
+        """
+        with self._lock:
+            if self._active_uploads < self._max_uploads:
+                self._active_uploads += 1
+                return True
+            if self._amount_of_queued_uploads >= self._max_queued_uploads:
+                return False
+            queued_upload = Event()
+            if downloader not in self._queued_uploads:
+                self._queued_uploads[downloader] = deque()
+                self._downloaders_order.append(downloader)
+            self._queued_uploads[downloader].append(queued_upload)
+            self._amount_of_queued_uploads += 1
+            if not self._lock.wait_for(queued_upload.is_set, self.MAX_QUEUE_WAIT):
+                self._dequeue(downloader, queued_upload)
+            return queued_upload.is_set()
+
+    def _dequeue(self, downloader: str, queued_upload: Event):
+        """
+        Must be called while holding the lock.
+        """
+        downloader_uploads = self._queued_uploads[downloader]
+        downloader_uploads.remove(queued_upload)
+        self._amount_of_queued_uploads -= 1
+        if not downloader_uploads:
+            self._queued_uploads.pop(downloader)
+            self._downloaders_order.remove(downloader)
+
+    def upload_finished(self, size: int):
+        """
+        :param size: The amount of bytes sent to the downloader (0 if the upload has failed).
+        """
+        with self._lock:
+            self._active_uploads -= 1
+            self._recent_uploads.append((time.time(), size))
+            # the freed slot goes to the oldest upload of the next downloader in turn
+            if self._downloaders_order:
+                downloader = self._downloaders_order[0]
+                queued_upload = self._queued_uploads[downloader][0]
+                self._dequeue(downloader, queued_upload)
+                if downloader in self._queued_uploads:
+                    self._downloaders_order.remove(downloader)
+                    self._downloaders_order.append(downloader)
+                queued_upload.set()
+                self._active_uploads += 1
+                self._lock.notify_all()
+
+    @property
+    def retry_after(self) -> int:
+        """
+        A rough estimate of the amount of seconds until a new upload would get a slot.
+        """
+        with self._lock:
+            return 1 + self._amount_of_queued_uploads // max(self._max_uploads, 1)
+
+    def _upload_rate(self) -> int:
+        """
+        The amount of bytes per second uploaded during the last RATE_WINDOW seconds.
+        Must be called while holding the lock.
+        """
+        window_start = time.time() - self.RATE_WINDOW
+        while self._recent_uploads and self._recent_uploads[0][0] < window_start:
+            self._recent_uploads.popleft()
+        return sum(size for _, size in self._recent_uploads) // self.RATE_WINDOW
+
+    def load_report(self) -> LoadReportMessage:
+        with self._lock:
+            return LoadReportMessage(self._active_uploads, self._upload_rate(),
+                                     max(self._max_uploads - self._active_uploads, 0))
+
+
+class OpenFilesCache(object):
+    """
+    Keeps the storages of the recently uploaded files open, so that serving a chunk doesn't require reopening the file.
+    Storages are closed once they haven't been used for IDLE_TIMEOUT seconds, or when there are more than MAX_OPEN_FILES
+    of them (least recently used first), unless they're in use.
+    All methods of this class are thread safe.
+    """
+    MAX_OPEN_FILES = 64
+    IDLE_TIMEOUT = 60  # seconds
+
+    def __init__(self):
+        # (file unique ID, file path) -> [storage, amount of users, last use time]
+        self._storages = OrderedDict()  # type: OrderedDict[tuple[str, str], list]
+        self._lock = Lock()
+
+    @contextmanager
+    def open(self, file_unique_id: str, file_path: str) -> FileStorage:
+        key = (file_unique_id, file_path)
+        with self._lock:
+            entry = self._storages.get(key)
+            if entry is None:
+                entry = self._storages[key] = [FileStorage(file_path), 0, 0]
+            self._storages.move_to_end(key)
+            entry[1] += 1
+            self._close_unused_storages()
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                entry[2] = time.time()
+
+    def _close_unused_storages(self):
+        """
+        Must be called while holding the lock.
+        """
+        idle_time = time.time() - self.IDLE_TIMEOUT
+        excess = len(self._storages) - self.MAX_OPEN_FILES
+        for key, (storage, users, last_use_time) in list(self._storages.items()):
+            if users == 0 and (excess > 0 or last_use_time < idle_time):
+                storage.close()
+                self._storages.pop(key)
+                excess -= 1
+
+    def close(self):
+        with self._lock:
+            for storage, _, _ in self._storages.values():
+                storage.close()
+            self._storages.clear()
+
+
+def exchange_peers(channel: Channel, db_manager: DBManager, peer_table: PeerTable, request: PeerExchangeMessage):
+    """
+    Learns about the origins known by the remote client, and responds with the origins we know about (which the remote
+    client doesn't).
+    """
+    if db_manager.get_shared_file_path(request.file_unique_id) is None:
+        channel.send_message(PeerExchangeMessage(request.file_unique_id, []))
+        return
+    known_peers = peer_table.get_peers(request.file_unique_id, [peer.unique_id for peer in request.peers])
+    peer_table.add_peers(request.file_unique_id, request.peers)
+    channel.send_message(PeerExchangeMessage(request.file_unique_id, known_peers))
+
+
+def send_chunk_hashes(channel: Channel, db_manager: DBManager, request: ChunkHashesRequestMessage):
+    """
+    Responds with the hashes of the chunks of a file we share (or with empty hashes if we don't share the file).
+    """
+    chunk_hashes = b""
+    file_path = db_manager.get_shared_file_path(request.file_unique_id)
+    if file_path is not None:
+        chunk_hashes = db_manager.get_chunk_hashes(request.file_unique_id)
+        if chunk_hashes is None:
+            # The file was shared before the hashes of chunks were kept, so they're calculated (only) once
+            file_hash, chunk_hashes = calculate_file_hashes(file_path, LEGACY_CHUNK_SIZE)
+            if file_hash == request.file_unique_id:
+                db_manager.add_chunk_hashes([(request.file_unique_id, chunk_hashes, LEGACY_CHUNK_SIZE)])
+            else:
+                logger.warning(f"Shared file {file_path} has changed since it was shared")
+                chunk_hashes = b""
+    channel.send_message(ChunkHashesMessage(request.file_unique_id, chunk_hashes))
+
 
 def transfer_file_chunk_to_client(downloader_socket: socket.socket, db_manager: DBManager,
-                                  finished_socket: socket.socket):
+                                  finished_socket: socket.socket, upload_statistics: UploadStatistics,
+                                  peer_table: PeerTable, open_files: OpenFilesCache):
     """
-    Waits for the remote client to request a single file chunk, and transfers it to him via the
-    ChunkDataResponseMessage.
+    Waits for the remote client to request a single file chunk (or range), and transfers it to him via the
+    ChunkDataResponseMessage (or RangeDataResponseMessages).
+    The data sent to the remote client is limited by the process-wide upload bandwidth limiter.
     At the end of this function the finished_socket is signaled to let the FileShareServer know the thread has finished.
     """
-    channel = Channel(downloader_socket)
-    client_request = channel.wait_for_messages([StartFileTransferMessage, RTTCheckMessage])
-    if isinstance(client_request, RTTCheckMessage):
-        logger.debug("Got a RTT check message")
-        channel.send_message(RTTResponseMessage(client_request.send_time))
-    else:
-        file_path = db_manager.get_shared_file_path(client_request._file_id)
-        if file_path is None:
-            logger.warning(f"A client has requested a file which this client does not share. ID: {unique_id}")
-            return  # maybe raise?
-        file_object = FileObject(file_path, is_local=True)
-        chunk_data = file_object.read_chunk(client_request._chunk_num)
+    channel = Channel(downloader_socket, send_limiter=upload_limiter)
+    try:
+        client_request = channel.wait_for_messages([StartFileTransferMessage, RangeRequestMessage, RTTCheckMessage,
+                                                    PeerExchangeMessage, ChunkHashesRequestMessage])
+        if isinstance(client_request, RTTCheckMessage):
+            logger.debug("Got a RTT check message")
+            channel.send_message(RTTResponseMessage(client_request.send_time))
+        elif isinstance(client_request, PeerExchangeMessage):
+            logger.debug("Got a peer exchange message")
+            exchange_peers(channel, db_manager, peer_table, client_request)
+        elif isinstance(client_request, ChunkHashesRequestMessage):
+            logger.debug("Got a chunk hashes request message")
+            send_chunk_hashes(channel, db_manager, client_request)
+        elif isinstance(client_request, RangeRequestMessage):
+            upload_range(channel, db_manager, upload_statistics, open_files, client_request)
+        else:
+            upload_chunk(channel, db_manager, upload_statistics, open_files, client_request)
+    finally:
+        signal(finished_socket)
+        channel.close()
+
+
+def start_upload(channel: Channel, upload_statistics: UploadStatistics) -> bool:
+    """
+    Takes an upload slot for the downloader, or lets it know that we're busy if none is available.
+    :return: Whether the upload may start.
+    """
+    if upload_statistics.start_upload(channel.getpeername()[0]):
+        return True
+    logger.debug("Rejecting a request, all the upload slots are taken and the upload queue is full")
+    channel.send_message(BusyMessage(upload_statistics.retry_after))
+    return False
+
+
+def acquire_upload_buffer(channel: Channel, upload_statistics: UploadStatistics, size: int) -> Optional[bytearray]:
+    """
+    Takes a buffer for the uploaded data from the pool of chunk buffers, or lets the downloader know that we're busy if
+    the pool's budget stays used up for too long.
+    """
+    buffer = chunk_buffers.acquire(size, timeout=UPLOAD_BUFFER_TIMEOUT)
+    if buffer is None:
+        logger.debug("Rejecting a request, the chunk buffers budget is used up")
+        channel.send_message(BusyMessage(upload_statistics.retry_after))
+    return buffer
+
+
+def upload_chunk(channel: Channel, db_manager: DBManager, upload_statistics: UploadStatistics,
+                 open_files: OpenFilesCache, request: StartFileTransferMessage):
+    """
+    Sends the requested chunk to the downloader, once it gets one of the upload slots.
+    """
+    file_path = db_manager.get_shared_file_path(request._file_id)
+    if file_path is None:
+        logger.warning(f"A client has requested a file which this client does not share. ID: {request._file_id}")
+        channel.send_message(GeneralErrorMessage("The requested file is not shared"))
+        return
+    if not start_upload(channel, upload_statistics):
+        return
+    uploaded_size = 0
+    # files shared before chunk sizes were chosen per file have the legacy chunk size
+    chunk_size = db_manager.get_chunk_size(request._file_id) or LEGACY_CHUNK_SIZE
+    buffer = None
+    try:
+        buffer = acquire_upload_buffer(channel, upload_statistics, chunk_size)
+        if buffer is None:
+            return
+        with open_files.open(request._file_id, file_path) as storage:
+            chunk_length = storage.read_into(chunk_size * request._chunk_num, memoryview(buffer))
+        if chunk_length == 0:
+            channel.send_message(GeneralErrorMessage("The requested chunk doesn't exist"))
+            return
         logger.debug("Sending a ChunkDataResponseMessage to another client")
-        channel.send_message(ChunkDataResponseMessage(client_request._file_id, client_request._chunk_num, chunk_data))
-    signal(finished_socket)
-    channel.close()
+        channel.send_message(ChunkDataResponseMessage(request._file_id, request._chunk_num,
+                                                      memoryview(buffer)[:chunk_length]))
+        uploaded_size = chunk_length
+    finally:
+        if buffer is not None:
+            chunk_buffers.release(buffer)
+        upload_statistics.upload_finished(uploaded_size)
+
+
+def upload_range(channel: Channel, db_manager: DBManager, upload_statistics: UploadStatistics,
+                 open_files: OpenFilesCache, request: RangeRequestMessage):
+    """
+    Sends the requested range of a file to the downloader in blocks of at most RANGE_BLOCK_SIZE bytes, once it gets one
+    of the upload slots.
+    """
+    file_path = db_manager.get_shared_file_path(request.file_id)
+    if file_path is None:
+        logger.warning(f"A client has requested a file which this client does not share. ID: {request.file_id}")
+        channel.send_message(GeneralErrorMessage("The requested file is not shared"))
+        return
+    if not start_upload(channel, upload_statistics):
+        return
+    uploaded_size = 0
+    buffer = None
+    try:
+        buffer = acquire_upload_buffer(channel, upload_statistics, max(min(RANGE_BLOCK_SIZE, request.length), 1))
+        if buffer is None:
+            return
+        with open_files.open(request.file_id, file_path) as storage:
+            offset, end = request.offset, request.offset + request.length
+            while offset < end:
+                block = memoryview(buffer)[:min(len(buffer), end - offset)]
+                block_length = storage.read_into(offset, block)
+                if block_length == 0:
+                    break
+                channel.send_message(RangeDataResponseMessage(request.file_id, offset, block[:block_length]))
+                offset += block_length
+                uploaded_size += block_length
+        if uploaded_size == 0:
+            channel.send_message(GeneralErrorMessage("The requested range doesn't exist"))
+    finally:
+        if buffer is not None:
+            chunk_buffers.release(buffer)
+        upload_statistics.upload_finished(uploaded_size)
 
 
 class FileShareServer(Server):
@@ -47,15 +357,36 @@ class FileShareServer(Server):
     New clients that wish to download files we're currently sharing will connect to this server's socket, and in return
     we will start a new transfer channel for them which will pass chunks of the file according to their requests.
     """
-    def __init__(self, local_db: DBManager, port=0):
+    MAX_UPLOADS = 16
+    MAX_QUEUED_UPLOADS = 64
+
+    def __init__(self, local_db: DBManager, port=0, max_uploads: int = None, max_queued_uploads: int = None):
+        """
+        :param max_uploads: The amount of upload slots (MAX_UPLOADS by default).
+        :param max_queued_uploads: The amount of uploads which may wait for a slot (MAX_QUEUED_UPLOADS by default) -
+        downloaders are told that we're busy once the queue is full.
+        """
         super().__init__(port)
         self._db = local_db
+        self._upload_statistics = UploadStatistics(
+            self.MAX_UPLOADS if max_uploads is None else max_uploads,
+            self.MAX_QUEUED_UPLOADS if max_queued_uploads is None else max_queued_uploads)
+        self._peer_table = PeerTable()
+        self._open_files = OpenFilesCache()
 
     def _receive_new_client(self, client: socket.socket, client_address: tuple[str, int], finished_socket: socket.socket):
-        new_transfer_thread = Thread(target=transfer_file_chunk_to_client, args=(client, self._db, finished_socket))
+        new_transfer_thread = Thread(target=transfer_file_chunk_to_client,
+                                     args=(client, self._db, finished_socket, self._upload_statistics,
+                                           self._peer_table, self._open_files))
         new_transfer_thread.start()
         return new_transfer_thread
 
+    def main_loop(self):
+        try:
+            super().main_loop()
+        finally:
+            self._open_files.close()
+
     def _remove_old_clients(self):
         """
         Filters out all finished threads from the list of running threads.
@@ -65,4 +396,11 @@ class FileShareServer(Server):
 
     @property
     def sharing_port(self):
-        return self._socket.getsockname()[1]
\ No newline at end of file
+        return self._socket.getsockname()[1]
+
+    @property
+    def load_report(self) -> LoadReportMessage:
+        """
+        A report of the current upload load of the server, to be sent to the metadata server.
+        """
+        return self._upload_statistics.load_report()
@@ -3,13 +3,25 @@ This module contains the implementation of the local downloading logic.
 """
 
 import time
+import random
 import logging
+from math import ceil
 from socket import socket
-from threading import Thread, Event
-from typing import Optional
-from p2p_fileshare.framework.channel import Channel, TimeoutException
+from threading import Thread, Event, Lock, Condition
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from p2p_fileshare.framework.channel import Channel, TimeoutException, SocketClosedException, BusyException
 from p2p_fileshare.framework.types import FileObject, SharedFile, SharingClientInfo
-from p2p_fileshare.framework.messages import StartFileTransferMessage, SharingInfoRequestMessage, SharingInfoResponseMessage, RTTCheckMessage
+from p2p_fileshare.framework.hashing import calculate_chunk_hash
+from p2p_fileshare.framework.bandwidth import download_limiter
+from p2p_fileshare.framework.buffer_pool import chunk_buffers
+from p2p_fileshare.client.chunk_writer import ChunkWriter, ChunkWriterException
+from p2p_fileshare.framework.chunk_bitmap import ChunkBitmap
+from p2p_fileshare.client.db_manager import DBManager
+from p2p_fileshare.framework.messages import StartFileTransferMessage, SharingInfoRequestMessage, RTTCheckMessage, \
+    SubscribeOriginsMessage, UnsubscribeOriginsMessage, OriginsUpdateMessage, PeerExchangeMessage, Message, \
+    ChunkHashesRequestMessage, RangeRequestMessage, RangeDataResponseMessage
 
 
 logger = logging.getLogger(__name__)
@@ -18,12 +30,92 @@ logger = logging.getLogger(__name__)
 RTTInfo = tuple[SharingClientInfo, tuple[float, float]]
 
 
+class CorruptedChunkException(Exception):
+    pass
+
+
+class ChunkDownloadSlots(object):
+    """
+    A budget of chunk downloads shared by several FileDownloaders. It caps both the total amount of chunks downloaded
+    concurrently and the amount of concurrent sessions with each origin (the same origin may share several of the files
+    being downloaded).
+    All methods of this class are thread safe.
+    """
+    def __init__(self, max_chunk_downloads: int, max_peer_sessions: int):
+        self._max_chunk_downloads = max_chunk_downloads
+        self._max_peer_sessions = max_peer_sessions
+        self._chunk_downloads = 0
+        self._peer_sessions = {}  # type: dict[tuple[str, int], int]
+        self._lock = Lock()
+
+    @property
+    def chunk_downloads(self) -> int:
+        return self._chunk_downloads
+
+    def has_free_slot(self) -> bool:
+        return self._chunk_downloads < self._max_chunk_downloads
+
+    def is_peer_available(self, origin: SharingClientInfo) -> bool:
+        return self._peer_sessions.get((origin.ip, origin.port), 0) < self._max_peer_sessions
+
+    def try_acquire(self, origin: SharingClientInfo) -> bool:
+        """
+        Takes a slot for downloading a chunk from origin, if neither the total budget nor the origin's are used up.
+        """
+        with self._lock:
+            if not self.has_free_slot() or not self.is_peer_available(origin):
+                return False
+            self._chunk_downloads += 1
+            peer = (origin.ip, origin.port)
+            self._peer_sessions[peer] = self._peer_sessions.get(peer, 0) + 1
+            return True
+
+    def release(self, origin: SharingClientInfo):
+        with self._lock:
+            self._chunk_downloads -= 1
+            peer = (origin.ip, origin.port)
+            self._peer_sessions[peer] -= 1
+            if self._peer_sessions[peer] == 0:
+                self._peer_sessions.pop(peer)
+
+
 class FileDownloader(object):
     """
     A class responsible for governing the file downloading operation from different origins.
     The FileDownloader creates and monitors instances of ChunkDownloader until either the requested file is successfully
     downloaded or a fatal error occurs.
+    While downloading, the FileDownloader is subscribed to changes in the file's origins, so that the server pushes new
+    origins to it instead of being polled for them. It also periodically exchanges the origins it knows about with one
+    of the origins it downloads from (peer exchange), so that it keeps finding new origins even when the server is
+    unavailable.
+    Origins learned via peer exchange aren't vouched for by the server, so they're capped separately from the origins
+    handed out by the server (a misbehaving peer can't crowd out the server's origins).
+    Every downloaded chunk is verified against the hashes of the file's chunks (retrieved from the server, or from one
+    of the origins if the server doesn't know them) before it's written. A corrupted chunk is downloaded again from a
+    different origin if possible, and the origin that has sent it is penalized. Nobody can vouch for the chunk hashes
+    but the file's data, so once the download is complete the whole file is verified against its ID. The hashes are
+    dropped if several origins agree on the data of a chunk that doesn't match them, and if they can't be retrieved
+    after MAX_CHUNK_HASHES_ATTEMPTS attempts, only the whole file is verified.
+    Chunks are requested as byte ranges, so a chunk whose download fails halfway through is resumed (possibly from a
+    different origin) rather than downloaded again from its beginning. Origins which don't support range requests
+    (legacy clients) are asked for whole chunks instead.
+    An origin whose upload slots are all taken responds that it's busy. That isn't counted as a failure of the origin -
+    other origins are preferred until the time it has suggested to retry after.
+    The data received by all downloads is limited by the process-wide download bandwidth limiter, which is split between
+    the downloads by their priorities (a download whose priority is twice as high gets twice as much bandwidth).
+    A download can be created without being started (e.g. when it's queued), and can be paused and started again later
+    on - the chunks which were downloaded before it was paused are kept. Downloads which share download_slots share
+    one budget of concurrent chunk downloads and origin sessions.
+    Each chunk is downloaded into a buffer taken from the process-wide pool of chunk buffers, which is released once the
+    chunk is written - a chunk download isn't started until there's room for its buffer in the pool's budget.
+    Chunks are downloaded in order, starting from the read position (the beginning of the file unless the download is
+    read while it's downloaded). The ranges which readers are waiting for are requested as priority hints, whose chunks
+    are downloaded before any other chunk (the most recent hints first). A streaming download moves its read position
+    along with its readers, so that the chunks right after the data being read (the read-ahead window) come next.
     """
+    DEFAULT_PRIORITY = 1
+    READ_AHEAD_SIZE = 16 * 1024 * 1024  # bytes
+    MAX_RANGE_HINTS = 8
     MAX_CHUNK_DOWNLOADERS = 2
     RTT_TIMEOUT = 2
     RTT_TOLERANCE = 0.5
@@ -31,34 +123,229 @@ class FileDownloader(object):
     MIN_ORIGINS_FOR_UPDATE = 10
     MAX_ORIGIN_DOWNLOADER = 2
     MAX_ORIGIN_FAILS = 5
-
-    def __init__(self, file_info: SharedFile, server_channel: Channel, local_path: str):
+    CORRUPTED_CHUNK_PENALTY = 3  # failed attempts
+    MAX_CHUNK_HASHES_ATTEMPTS = 5
+    MAX_CHUNK_HASHES_DISPUTES = 2  # origins that agree on the data of a chunk which doesn't match the chunk hashes
+    ORIGINS_POLL_INTERVAL = 10
+    PEER_EXCHANGE_INTERVAL = 30
+    MAX_SERVER_ORIGINS = 70
+    MAX_PEX_ORIGINS = 30
+    MAX_KNOWN_ORIGINS = MAX_SERVER_ORIGINS + MAX_PEX_ORIGINS
+    MAX_NEW_PEERS_PER_EXCHANGE = 10
+    MAX_RTT_CHECKS = 8  # the amount of origins whose RTT is checked (concurrently) each time
+    WRITE_QUEUE_SIZE = ChunkWriter.DEFAULT_MAX_QUEUED_CHUNKS
+    FSYNC_INTERVAL = ChunkWriter.DEFAULT_FSYNC_INTERVAL
+    SAVE_PROGRESS_INTERVAL = 5  # seconds
+
+    def __init__(self, file_info: SharedFile, server_channel: Channel, local_path: str, local_db: DBManager = None,
+                 downloaded_chunks: bytes = None, priority: float = DEFAULT_PRIORITY,
+                 download_slots: ChunkDownloadSlots = None, on_stopped: Callable[["FileDownloader"], None] = None,
+                 start: bool = True, streaming: bool = False):
+        """
+        :param local_db: If supplied, the progress of the download is kept in the DB so that it could be resumed.
+        :param downloaded_chunks: When resuming a download - the bitmap of the chunks which were previously downloaded.
+        :param priority: The download's share of the download bandwidth, relatively to the other downloads.
+        :param download_slots: If supplied, every chunk download takes one of its slots.
+        :param on_stopped: Called by the download's thread once it stops (either since the download has ended, or since
+        it was paused).
+        :param start: Whether to start downloading right away (otherwise start should be called).
+        :param streaming: Whether to download the chunks near the read position first.
+        """
+        if priority <= 0:
+            raise ValueError(f"The priority must be positive, got {priority}")
+        self._priority = priority
         self._file_info = file_info
         self._server_channel = server_channel
         self._local_path = local_path
+        self._local_db = local_db
+        self._download_slots = download_slots
+        self._on_stopped = on_stopped
+        self._downloaded_chunks = downloaded_chunks
         self._stop_event = Event()
+        self._finished_event = Event()
+        self._is_paused = False
+        self._is_running = False
+        self.streaming = streaming
+        self._read_position = 0
+        self._range_hints = deque(maxlen=self.MAX_RANGE_HINTS)  # type: deque[tuple[int, int]]
+        self._scheduling_event = Event()  # wakes the download's thread up early
+        # notified whenever chunks are downloaded, or the download stops
+        self._chunks_condition = Condition()
         self._is_done = False
+        self._is_corrupted = False
+        self._last_progress_save = 0
+        self._has_unsaved_progress = False
         self._chunk_downloaders = []
         self._origins_stats = {}
+        self._is_subscribed = False
+        self._pending_origin_updates = []  # type: list[OriginsUpdateMessage]
+        self._origin_updates_lock = Lock()
+        self._last_origins_poll = time.time()  # file_info has just been retrieved from the server
+        self._last_peer_exchange = 0
+        self._pex_origins = set()  # type: set[str]
+        self._asked_server_for_hashes = False
+        self._chunk_hashes_attempts = 0
+        self._rejected_chunk_hashes = set()  # type: set[bytes]
+        self._verify_chunks = True
+        # The origins which have sent corrupted data of each chunk, by the hash of the data they've sent
+        self._corrupted_chunk_origins = {}  # type: dict[int, dict[bytes, set[SharingClientInfo]]]
+        self._thread = None  # type: Optional[Thread]
+        self._file_object = None  # type: Optional[FileObject]
+        self._chunk_writer = None  # type: Optional[ChunkWriter]
+        if start:
+            self.start()
+
+    def start(self):
+        """
+        Starts (or resumes) downloading the file. Must not be called while the download is running.
+        """
+        if self._is_running:
+            raise RuntimeError("The download is already running")
+        if self._file_object is not None:
+            self._downloaded_chunks = self._file_object.serialize_downloaded_chunks()
+        self._is_paused = False
+        self._stop_event = Event()
+        self._chunk_downloaders = []
+        for origin_stats in self._origins_stats.values():
+            origin_stats['downloaders'] = 0
+        self._file_object = FileObject(self._local_path, self._file_info, downloaded_chunks=self._downloaded_chunks)
+        self._chunk_writer = ChunkWriter(self._file_object, self.WRITE_QUEUE_SIZE, self.FSYNC_INTERVAL,
+                                         on_durable=self._on_chunks_durable, buffer_pool=chunk_buffers)
         self._thread = Thread(target=self.__start)
-        self._file_object = FileObject(self._local_path, self._file_info)
+        self._is_running = True
         self._thread.start()
 
+    def pause(self):
+        """
+        Stops downloading the file, keeping the chunks downloaded so far (start resumes the download).
+        """
+        if self._finished_event.is_set():
+            return
+        self._is_paused = True
+        self._stop_threads()
+
+    @property
+    def is_paused(self) -> bool:
+        return self._is_paused
+
+    @property
+    def is_running(self) -> bool:
+        """
+        Whether the download's thread is running (a paused download might still be releasing its resources).
+        """
+        return self._is_running
+
     @property
     def progress(self) -> int:
         """
         Retrieve a number between 0 to 100 representing the percentage of the file successfully downloaded until now.
         """
-        return int((len(self._file_object.downloaded_chunks) / self._file_object.amount_of_chunks) * 100)
+        if self._file_object is None:
+            amount_of_chunks = ceil(self._file_info.size / self._file_info.chunk_size)
+            if amount_of_chunks == 0:
+                return 0
+            return int((ChunkBitmap(amount_of_chunks, self._downloaded_chunks).count / amount_of_chunks) * 100)
+        return int((self._file_object.amount_of_downloaded_chunks / self._file_object.amount_of_chunks) * 100)
 
     @property
     def local_path(self):
         return self._local_path
 
+    @property
+    def priority(self) -> float:
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority: float):
+        if priority <= 0:
+            raise ValueError(f"The priority must be positive, got {priority}")
+        self._priority = priority
+        for chunk_downloader in list(self._chunk_downloaders):
+            chunk_downloader.bandwidth_weight = priority
+
     @property
     def file_info(self):
         return self._file_info
 
+    def _on_chunks_durable(self, chunk_nums: list[int]):
+        """
+        Called by the chunk writer's thread once chunks are marked as downloaded.
+        """
+        self._notify_chunk_waiters()
+        self._save_progress()
+
+    def _notify_chunk_waiters(self):
+        with self._chunks_condition:
+            self._chunks_condition.notify_all()
+
+    def prioritize_range(self, offset: int, length: int):
+        """
+        Requests the chunks covering a range of the file to be downloaded before any other chunk.
+        In streaming mode, the read position is moved to the range as well.
+        """
+        chunk_size = self._file_info.chunk_size
+        first_chunk = offset // chunk_size
+        end_chunk = ceil((offset + max(length, 1)) / chunk_size)
+        with self._chunks_condition:
+            if self.streaming:
+                self._read_position = offset
+            if (first_chunk, end_chunk) in self._range_hints:
+                self._range_hints.remove((first_chunk, end_chunk))
+            self._range_hints.append((first_chunk, end_chunk))
+        self._scheduling_event.set()
+
+    def is_chunk_downloaded(self, chunk_num: int) -> bool:
+        file_object = self._file_object
+        return file_object is not None and file_object.is_chunk_downloaded(chunk_num)
+
+    def wait_for_chunk(self, chunk_num: int, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until a chunk is downloaded (and durable), or until the download ends.
+        :return: Whether the chunk is downloaded.
+        """
+        with self._chunks_condition:
+            self._chunks_condition.wait_for(lambda: self.is_chunk_downloaded(chunk_num) or self.is_done(), timeout)
+        return self.is_chunk_downloaded(chunk_num)
+
+    def _claim_chunk(self) -> Optional[int]:
+        """
+        Claims the next chunk to download - the chunks of the most recent priority hints come first, and then the
+        chunks from the read position onwards (the earlier chunks are downloaded last).
+        """
+        with self._chunks_condition:
+            range_hints = list(self._range_hints)
+            start_chunk = self._read_position // self._file_info.chunk_size
+        for first_chunk, end_chunk in reversed(range_hints):
+            chunk_num = self._file_object.get_empty_chunk(first_chunk, end_chunk)
+            if chunk_num is not None:
+                return chunk_num
+        return self._file_object.get_empty_chunk(start_chunk)
+
+    def _save_progress(self, force: bool = False):
+        """
+        Keeps the chunks that were downloaded so far in the local DB, so that the download could be resumed.
+        The progress is saved at most once every SAVE_PROGRESS_INTERVAL seconds (unless forced), a download that is
+        interrupted in between only has to download the chunks of the last few seconds again.
+        """
+        if self._local_db is None:
+            return
+        if not force and time.time() - self._last_progress_save < self.SAVE_PROGRESS_INTERVAL:
+            self._has_unsaved_progress = True
+            return
+        self._last_progress_save = time.time()
+        self._has_unsaved_progress = False
+        self._local_db.update_download(self._file_info.unique_id, self._local_path,
+                                       self._file_object.serialize_downloaded_chunks())
+
+    def _verify_file(self):
+        """
+        Makes sure the downloaded file matches the file ID (the MD5 of the file's data), since chunks might have been
+        corrupted in transit, by an origin, or on the disk while a download was interrupted.
+        """
+        if self._file_object.get_file_hash() != self._file_info.unique_id:
+            logger.error(f"The downloaded file {self._local_path} doesn't match its ID {self._file_info.unique_id}")
+            self._is_corrupted = True
+
     def _update_origin_stat_after_download(self, downloader: "ChunkDownloader"):
         """
         After a single ChunkDownloader has finished operating, update the statistics of its origin so that we can
@@ -68,8 +355,13 @@ class FileDownloader(object):
         :return: None
         """
         logger.debug(f"Updating stats after download: {downloader.origin}")
-        origin_stats = self._origins_stats[downloader.origin]
+        origin_stats = self._origins_stats.get(downloader.origin)
+        if origin_stats is None:
+            return  # the origin has been removed in the meantime
         origin_stats['downloaders'] = origin_stats['downloaders'] - 1
+        if downloader.ranges_unsupported:
+            logger.info(f"{downloader.origin} doesn't support range requests, requesting whole chunks from it")
+            origin_stats['supports_ranges'] = False
         if not downloader.failed:
             origin_stats['failed_attempts'] = 0
             download_time = time.time() - downloader.start_time
@@ -78,6 +370,11 @@ class FileDownloader(object):
                 origin_stats['score'] = (download_time, 1)
             else:
                 origin_stats['score'] = (((score[0] * score[1]) + download_time) / (score[1]+1), score[1] + 1)
+        elif downloader.busy_retry_after is not None:
+            logger.debug(f"{downloader.origin} is busy, preferring other origins for {downloader.busy_retry_after}s")
+            origin_stats['busy_until'] = time.time() + downloader.busy_retry_after
+        elif downloader.corrupted:
+            origin_stats['failed_attempts'] = origin_stats['failed_attempts'] + self.CORRUPTED_CHUNK_PENALTY
         else:
             origin_stats['failed_attempts'] = origin_stats['failed_attempts'] + 1
 
@@ -94,19 +391,45 @@ class FileDownloader(object):
         for chunk_downloader in self._chunk_downloaders:
             if chunk_downloader.finished:
                 downloaders_to_remove.append(chunk_downloader)
-            elif current_time - chunk_downloader.start_time > self.CHUNK_TIMEOUT:
+            elif current_time - chunk_downloader.last_activity_time > self.CHUNK_TIMEOUT:
                 logger.error("Stopping ChunkDownloader {0} due to timeout.".format(chunk_downloader))
                 chunk_downloader.failed = True
                 chunk_downloader.stop()
                 downloaders_to_remove.append(chunk_downloader)
 
         for downloader_to_remove in downloaders_to_remove:
+            self._release_download_slot(downloader_to_remove)
+            if downloader_to_remove.corrupted:
+                self._handle_corrupted_chunk(downloader_to_remove)
             self._update_origin_stat_after_download(downloader_to_remove)
-            if self._origins_stats[downloader_to_remove.origin]['failed_attempts'] >= self.MAX_ORIGIN_FAILS:
+            if self._origins_stats.get(downloader_to_remove.origin, {}).get('failed_attempts', 0) >= \
+                    self.MAX_ORIGIN_FAILS:
                 # Origin fails too frequently, let's stop downloading from this origin for now
                 self._remove_origin(downloader_to_remove)
             self._chunk_downloaders.remove(downloader_to_remove)
 
+    def _release_download_slot(self, chunk_downloader: "ChunkDownloader"):
+        if self._download_slots is not None:
+            self._download_slots.release(chunk_downloader.origin)
+
+    def _handle_corrupted_chunk(self, chunk_downloader: "ChunkDownloader"):
+        """
+        Keeps the origin that has sent the corrupted chunk, so that the chunk would be downloaded from a different
+        origin.
+        If enough origins have sent the same data, it's the chunk hashes that are wrong rather than the origins.
+        """
+        logger.warning(f"Got corrupted data from {chunk_downloader.origin}, downloading chunk "
+                       f"{chunk_downloader.chunk_num} again")
+        chunk_origins = self._corrupted_chunk_origins.setdefault(chunk_downloader.chunk_num, {})
+        data_origins = chunk_origins.setdefault(chunk_downloader.data_hash, set())
+        data_origins.add(chunk_downloader.origin)
+        if len(data_origins) >= self.MAX_CHUNK_HASHES_DISPUTES:
+            logger.warning(f"{len(data_origins)} origins agree on the data of chunk {chunk_downloader.chunk_num}, "
+                           f"dropping the chunk hashes which don't match it")
+            self._rejected_chunk_hashes.add(self._file_object.chunk_hashes)
+            self._file_object.clear_chunk_hashes()
+            self._corrupted_chunk_origins = {}
+
     def _calculate_round_trip_time(self, origin: SharingClientInfo) -> Optional[RTTInfo]:
         """
         Calculate RTT and other network statistics for a single origin.
@@ -133,7 +456,7 @@ class FileDownloader(object):
             else:
                 rtt = (absolute_rtt/2, absolute_rtt/2)
             return origin, rtt
-        except TimeoutException as e:
+        except (TimeoutException, OSError) as e:
             logger.error(e)
             return None
 
@@ -141,26 +464,200 @@ class FileDownloader(object):
     def _weight_rtt(rtt_list: list[RTTInfo]) -> list[tuple[SharingClientInfo, float]]:
         return [(rtt[0], rtt[1][0]/2+rtt[1][1]) for rtt in rtt_list if rtt is not None]
 
+    def _subscribe_to_origins(self):
+        """
+        Subscribes to changes in the origins of the file. If the subscription fails, we'll poll the server instead.
+        """
+        self._server_channel.add_push_handler(OriginsUpdateMessage, self._handle_origins_update)
+        try:
+            self._server_channel.send_msg_and_wait_for_response(SubscribeOriginsMessage(self._file_info.unique_id))
+            self._is_subscribed = True
+        except Exception as e:
+            logger.warning(f"Failed subscribing to origin changes, polling the server instead: {e}")
+            self._server_channel.remove_push_handler(OriginsUpdateMessage, self._handle_origins_update)
+
+    def _unsubscribe_from_origins(self):
+        if not self._is_subscribed:
+            return
+        self._is_subscribed = False
+        self._server_channel.remove_push_handler(OriginsUpdateMessage, self._handle_origins_update)
+        try:
+            self._server_channel.send_message(UnsubscribeOriginsMessage(self._file_info.unique_id))
+        except Exception as e:
+            logger.debug(f"Failed unsubscribing from origin changes: {e}")
+
+    def _handle_origins_update(self, msg: OriginsUpdateMessage):
+        """
+        Called by the server channel's dispatching thread, so the update is only applied later on by our own thread.
+        """
+        if msg.file_unique_id == self._file_info.unique_id:
+            with self._origin_updates_lock:
+                self._pending_origin_updates.append(msg)
+
+    def _apply_origin_updates(self):
+        """
+        Applies the origin changes pushed by the server since the last time this method was called.
+        """
+        with self._origin_updates_lock:
+            updates, self._pending_origin_updates = self._pending_origin_updates, []
+        for update in updates:
+            logger.debug(f"Got origins update: {len(update.added_origins)} added, {len(update.removed_origins)} removed")
+            # an origin that was added again might have a different address, so its old information is dropped as well
+            stale_origins = set(update.removed_origins) | {origin.unique_id for origin in update.added_origins
+                                                           if origin not in self._file_info.origins}
+            self._file_info.origins = [origin for origin in self._file_info.origins
+                                       if origin.unique_id not in stale_origins]
+            for origin in [origin for origin in self._origins_stats if origin.unique_id in stale_origins]:
+                self._origins_stats.pop(origin)
+            self._add_origins([origin for origin in update.added_origins
+                               if origin.unique_id not in update.removed_origins])
+
     def _update_origins(self):
         """
-        If necessary, request a new list of clients that share the file from the server.
+        Applies the origin changes pushed by the server. If we're not subscribed to these changes (or we've run out of
+        usable origins) - request a new list of clients that share the file from the server, if necessary.
         """
+        self._apply_origin_updates()
+        if self._is_subscribed and (self._origins_stats or
+                                    time.time() - self._last_origins_poll < self.ORIGINS_POLL_INTERVAL):
+            return
         if len(self._origins_stats) < self.MIN_ORIGINS_FOR_UPDATE:
             logger.debug("Updating origin list")
-            sharing_info_request = SharingInfoRequestMessage(self._file_info.unique_id)
-            self._server_channel.send_message(sharing_info_request)
-            shared_file = self._server_channel.wait_for_message(SharingInfoResponseMessage).shared_file
-            self._file_info.origins = shared_file.origins
+            self._last_origins_poll = time.time()
+            # The server only returns a sample of the origins, ask for ones we don't know yet
+            known_origins = [origin.unique_id for origin in self._file_info.origins]
+            sharing_info_request = SharingInfoRequestMessage(self._file_info.unique_id,
+                                                             excluded_origins=known_origins)
+            try:
+                shared_file = self._server_channel.send_msg_and_wait_for_response(sharing_info_request).shared_file
+            except Exception as e:
+                # We might still find new origins via peer exchange
+                logger.warning(f"Failed retrieving origins from the server: {e}")
+                return
+            self._add_origins(shared_file.origins)
+
+    def _add_origins(self, origins: list[SharingClientInfo], from_peer_exchange: bool = False):
+        """
+        Adds the origins we don't know about yet (as long as we don't know too many origins of the same source already).
+        :param from_peer_exchange: Whether the origins were learned via peer exchange (rather than from the server).
+        """
+        if not from_peer_exchange:
+            # the server vouches for the origins it hands out, even ones we've learned about via peer exchange
+            self._pex_origins.difference_update(origin.unique_id for origin in origins)
+        known_origins = {origin.unique_id for origin in self._file_info.origins}
+        new_origins = [origin for origin in origins if origin.unique_id not in known_origins]
+        amount_of_pex_origins = len(known_origins & self._pex_origins)
+        if from_peer_exchange:
+            new_origins = new_origins[:min(max(self.MAX_PEX_ORIGINS - amount_of_pex_origins, 0),
+                                           self.MAX_NEW_PEERS_PER_EXCHANGE)]
+            self._pex_origins.update(origin.unique_id for origin in new_origins)
+        else:
+            amount_of_server_origins = len(known_origins) - amount_of_pex_origins
+            new_origins = new_origins[:max(self.MAX_SERVER_ORIGINS - amount_of_server_origins, 0)]
+        self._file_info.origins = self._file_info.origins + new_origins
+
+    def _exchange_peers(self):
+        """
+        Once every PEER_EXCHANGE_INTERVAL seconds, exchanges the origins we know about with a random origin we've
+        successfully reached.
+        """
+        if time.time() - self._last_peer_exchange < self.PEER_EXCHANGE_INTERVAL or not self._origins_stats:
+            return
+        self._last_peer_exchange = time.time()
+        origin = random.choice(list(self._origins_stats))
+        # the message only carries PeerExchangeMessage.MAX_PEERS origins, so the ones we've reached are sent first
+        known_origins = sorted((known_origin for known_origin in self._file_info.origins if known_origin != origin),
+                               key=lambda known_origin: known_origin not in self._origins_stats)
+        if len(known_origins) > PeerExchangeMessage.MAX_PEERS:
+            logger.debug(f"Only sending {PeerExchangeMessage.MAX_PEERS} of the {len(known_origins)} known origins")
+        logger.debug(f"Exchanging peers with {origin.ip}:{origin.port}")
+        try:
+            response = self._send_request_to_origin(origin, PeerExchangeMessage(self._file_info.unique_id,
+                                                                                known_origins))
+        except Exception as e:
+            logger.debug(f"Failed exchanging peers: {e}")
+            return
+        self._add_origins(response.peers, from_peer_exchange=True)
+
+    def _send_request_to_origin(self, origin: SharingClientInfo, request: Message) -> Message:
+        """
+        Sends a single request to the sharing server of an origin and waits for its response.
+        """
+        s = socket()
+        s.settimeout(self.RTT_TIMEOUT)
+        s.connect((origin.ip, origin.port))
+        origin_channel = Channel(s)
+        try:
+            return origin_channel.send_msg_and_wait_for_response(request, timeout=self.RTT_TIMEOUT)
+        finally:
+            origin_channel.close()
+
+    def _fetch_chunk_hashes(self) -> bool:
+        """
+        Retrieves the hashes of the file's chunks, which are required in order to verify the downloaded chunks - first
+        from the server, and if it doesn't know them, from a random origin on every call.
+        Chunks downloaded so far (e.g. by a previous run of the download) are verified once the hashes are retrieved.
+        :return: Whether chunks can be downloaded (the hashes are known, or we've given up on retrieving them).
+        """
+        if self._file_object.has_chunk_hashes or not self._verify_chunks:
+            return True
+        if self._chunk_hashes_attempts >= self.MAX_CHUNK_HASHES_ATTEMPTS:
+            logger.warning("Failed retrieving the chunk hashes, only the whole file will be verified")
+            self._verify_chunks = False
+            return True
+        self._chunk_hashes_attempts += 1
+        request = ChunkHashesRequestMessage(self._file_info.unique_id)
+        chunk_hashes = b""
+        if not self._asked_server_for_hashes:
+            self._asked_server_for_hashes = True
+            try:
+                chunk_hashes = self._server_channel.send_msg_and_wait_for_response(request).chunk_hashes
+            except Exception as e:
+                logger.warning(f"Failed retrieving the chunk hashes from the server: {e}")
+        if not chunk_hashes:
+            self._update_origins()
+            self._base_rate_origins()
+            if not self._origins_stats:
+                return False
+            origin = random.choice(list(self._origins_stats))
+            try:
+                chunk_hashes = self._send_request_to_origin(origin, request).chunk_hashes
+            except Exception as e:
+                logger.debug(f"Failed retrieving the chunk hashes from {origin.ip}:{origin.port}: {e}")
+                return False
+        if chunk_hashes in self._rejected_chunk_hashes:
+            logger.debug("Got chunk hashes which were already rejected")
+            return False
+        try:
+            self._file_object.set_chunk_hashes(chunk_hashes)
+        except ValueError as e:
+            logger.warning(f"Got invalid chunk hashes: {e}")
+            return False
+        corrupted_chunks = self._file_object.verify_downloaded_chunks()
+        if corrupted_chunks:
+            logger.warning(f"{len(corrupted_chunks)} previously downloaded chunks are corrupted, "
+                           f"downloading them again")
+            self._save_progress(force=True)
+        return True
 
     def _base_rate_origins(self):
         """
-        Calculates the RTT to every client which we've yet to run RTT check on.
+        Calculates the RTT to up to MAX_RTT_CHECKS of the clients which we've yet to run RTT check on. The checks run
+        concurrently, so this takes at most about as long as a single check.
+        Origins that can't be reached are forgotten (the server might hand them out again later on).
         """
-        origins_rtt = [self._calculate_round_trip_time(origin) for origin in self._file_info.origins if origin not in
-                       self._origins_stats]
+        unrated_origins = [origin for origin in self._file_info.origins
+                           if origin not in self._origins_stats][:self.MAX_RTT_CHECKS]
+        if not unrated_origins:
+            return
+        with ThreadPoolExecutor(len(unrated_origins)) as executor:
+            origins_rtt = list(executor.map(self._calculate_round_trip_time, unrated_origins))
+        unreachable_origins = {origin for origin, rtt in zip(unrated_origins, origins_rtt) if rtt is None}
+        self._file_info.origins = [origin for origin in self._file_info.origins if origin not in unreachable_origins]
         weighted_origins_rtt = self._weight_rtt(origins_rtt)
         for origin, rtt in weighted_origins_rtt:
-            self._origins_stats[origin] = {'rtt': rtt, 'score': None, 'downloaders': 0, 'failed_attempts': 0}
+            self._origins_stats[origin] = {'rtt': rtt, 'score': None, 'downloaders': 0, 'failed_attempts': 0,
+                                           'supports_ranges': True}
 
     def _remove_origin(self, chunk_downloader: "ChunkDownloader"):
         """
@@ -168,22 +665,34 @@ class FileDownloader(object):
         """
         if chunk_downloader.origin in self._origins_stats:
             self._origins_stats.pop(chunk_downloader.origin)
+        # Forget about the origin altogether, the server might hand it out again later on
+        self._file_info.origins = [origin for origin in self._file_info.origins if origin != chunk_downloader.origin]
 
-    def _choose_origin(self) -> Optional[SharingClientInfo]:
+    def _choose_origin(self, excluded_origins: set[SharingClientInfo] = frozenset()) -> Optional[SharingClientInfo]:
         """
         Retrieves the best origin from which to download the file chunk.
+        :param excluded_origins: Origins which should only be chosen if no other origin is available (e.g. ones that
+        have already sent corrupted data of the chunk).
         """
         logger.debug("Choosing new origin")
         self._update_origins()
         self._base_rate_origins()
+        return self._choose_best_origin(excluded_origins) or self._choose_best_origin(frozenset())
+
+    def _is_origin_available(self, origin: SharingClientInfo, excluded_origins: set[SharingClientInfo]) -> bool:
+        origin_stats = self._origins_stats[origin]
+        return origin_stats['downloaders'] < self.MAX_ORIGIN_DOWNLOADER and origin not in excluded_origins and \
+            origin_stats.get('busy_until', 0) <= time.time() and \
+            (self._download_slots is None or self._download_slots.is_peer_available(origin))
 
+    def _choose_best_origin(self, excluded_origins: set[SharingClientInfo]) -> Optional[SharingClientInfo]:
         logger.debug("Choosing based on score")
         # Getting the best score (the lowest avarage chunk download time)
         scored_origins = [origin for origin in self._origins_stats if self._origins_stats[origin]['score'] is not None]
         scored_origins = sorted(scored_origins, key=lambda origin: self._origins_stats[origin]['score'][0])
 
         for origin in scored_origins:
-            if self._origins_stats[origin]['downloaders'] < self.MAX_ORIGIN_DOWNLOADER:
+            if self._is_origin_available(origin, excluded_origins):
                 return origin
 
         logger.debug("Choosing based on rtt")
@@ -191,7 +700,7 @@ class FileDownloader(object):
         unscored_origins = [(origin, self._origins_stats[origin]['rtt']) for origin in self._origins_stats if self._origins_stats[origin]['score'] is None]
         unscored_origins = sorted(unscored_origins, key=lambda origin: origin[1])
         for origin, rtt in unscored_origins:
-            if self._origins_stats[origin]['downloaders'] < self.MAX_ORIGIN_DOWNLOADER:
+            if self._is_origin_available(origin, excluded_origins):
                 return origin
 
         return None
@@ -201,28 +710,39 @@ class FileDownloader(object):
         Initializes new chunks downloaders if it's necessary.
         Each ChunkDownloader is responsible for downloading a single chunk of the file.
         """
-        if len(self._chunk_downloaders) < self.MAX_CHUNK_DOWNLOADERS:
-            chunk_num = self._file_object.get_empty_chunk()  # find needed chunk
+        if len(self._chunk_downloaders) < self.MAX_CHUNK_DOWNLOADERS and \
+                (self._download_slots is None or self._download_slots.has_free_slot()):
+            chunk_num = self._claim_chunk()  # find needed chunk
             logger.debug(f"Trying to download chunk: {chunk_num}")
             if chunk_num is None:
                 # we're finished
                 return
 
             try:
-                origin = self._choose_origin()
-                if origin is None:
+                corrupted_chunk_origins = self._corrupted_chunk_origins.get(chunk_num, {}).values()
+                origin = self._choose_origin(set().union(*corrupted_chunk_origins))
+                if origin is None or (self._download_slots is not None and
+                                      not self._download_slots.try_acquire(origin)):
+                    # the slots might have been taken by other downloads in the meantime
                     self._file_object.return_failed_chunk(chunk_num)
                     return
             except Exception as e:
                 self._file_object.return_failed_chunk(chunk_num)
                 raise e
-
-            origin = self._choose_origin()
+            chunk_buffer = chunk_buffers.acquire(self._file_object.get_chunk_length(chunk_num), timeout=0)
+            if chunk_buffer is None:
+                logger.debug("The chunk buffers budget is used up, waiting for chunk buffers to be released")
+                if self._download_slots is not None:
+                    self._download_slots.release(origin)
+                self._file_object.return_failed_chunk(chunk_num)
+                return
 
             logger.debug(f"Choose origin {origin} for chunk_num {chunk_num}")
             self._origins_stats[origin]['downloaders'] = self._origins_stats[origin]['downloaders'] + 1
             # Start ChunkDownloader
-            chunk_downloader = ChunkDownloader(self._file_info.unique_id, origin, self._file_object, chunk_num)
+            chunk_downloader = ChunkDownloader(self._file_info.unique_id, origin, self._file_object, self._chunk_writer,
+                                               chunk_num, chunk_buffer,
+                                               self._origins_stats[origin].get('supports_ranges', True), self._priority)
             self._chunk_downloaders.append(chunk_downloader)
             chunk_downloader.start()
 
@@ -230,7 +750,15 @@ class FileDownloader(object):
         return self._stop_event.is_set() or not self._file_object.has_empty_chunks()
 
     def is_done(self):
-        return self._stop_event.is_set()
+        return self._stop_event.is_set() and not self._is_paused
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the download to finish, including releasing all of its resources (writing the queued chunks and
+        closing the file). A queued or paused download has to be started first.
+        :return: Whether the download has finished before the timeout has expired.
+        """
+        return self._finished_event.wait(timeout)
 
     def __start(self):
         """
@@ -238,22 +766,59 @@ class FileDownloader(object):
         All logic within this function must be thread safe.
         """
         try:
+            self._subscribe_to_origins()
             while not self.did_finish_download():
+                if self._chunk_writer.error is not None:
+                    # the chunks can't be written anymore, so the download can't be completed
+                    raise ChunkWriterException(f"Failed writing the file: {self._chunk_writer.error}")
                 # check threads
                 self._check_chunk_downloaders()
-                self._run_chunk_downloaders()
-                time.sleep(1)
+                self._exchange_peers()
+                if self._fetch_chunk_hashes():
+                    self._run_chunk_downloaders()
+                self._scheduling_event.wait(1)
+                self._scheduling_event.clear()
         except Exception as e:
             logger.error(f"Got exception: {e}")
         finally:
-            self.stop()  # let the app know the download failed
+            self._unsubscribe_from_origins()
+            self._stop_threads()  # let the app know the download failed
+            for chunk_downloader in self._chunk_downloaders:
+                self._release_download_slot(chunk_downloader)
+            self._chunk_writer.close()
+            if not self._file_object.has_empty_chunks():
+                self._verify_file()
+            self._file_object.close()
+            if self._local_db is not None:
+                if not self._file_object.has_empty_chunks():
+                    # a corrupted download can't be resumed either, since we can't tell which of its chunks are bad
+                    self._local_db.remove_download(self._file_info.unique_id, self._local_path)
+                elif self._has_unsaved_progress:
+                    self._save_progress(force=True)
+            self._is_running = False
+            if not self._is_paused:
+                self._finished_event.set()
+            self._notify_chunk_waiters()
+            if self._on_stopped is not None:
+                self._on_stopped(self)
 
     def stop(self):
+        """
+        Stops the download for good, stopping the main file downloading thread as well as all chunk downloading threads.
+        """
+        self._is_paused = False
+        self._stop_threads()
+        if not self.is_running:
+            self._finished_event.set()  # the download isn't running, so there's nothing to wait for
+            self._notify_chunk_waiters()
+
+    def _stop_threads(self):
         """
         Stops the main file downloading thread as well as all chunk downloading threads.
         """
         self._stop_event.set()
-        for chunk_downloader in self._chunk_downloaders:
+        self._scheduling_event.set()
+        for chunk_downloader in list(self._chunk_downloaders):
             if chunk_downloader.is_alive():
                 chunk_downloader.stop_event.set()
                 chunk_downloader.join(timeout=1)
@@ -263,24 +828,60 @@ class FileDownloader(object):
     @property
     def failed(self):
         # If the stop event was set and the file wasn't fully downloaded we can determine the download failed
-        return self._stop_event.is_set() and self._file_object.has_empty_chunks()
+        return self._is_corrupted or (self.is_done() and
+                                      (self._file_object is None or self._file_object.has_empty_chunks()))
 
 
 class ChunkDownloader(Thread):
     """
     A class responsible for governing the download of a single file chunk.
+    The downloaded chunk is verified and handed to the ChunkWriter, which marks it as downloaded once it's written to
+    the disk.
+    If use_ranges is set the chunk is requested as a byte range, so the data received before a failure is kept in the
+    FileObject, and the next download of the chunk only requests the rest of it.
+    The data is received through the download bandwidth limiter, with a share of the bandwidth of bandwidth_weight.
+    The chunk is received into chunk_buffer (taken from the pool of chunk buffers, with the chunk's exact length). The
+    buffer is handed to the ChunkWriter along with the chunk, or released if the download fails.
     """
-    def __init__(self, file_id: str, origin: SharingClientInfo, file_object: FileObject, chunk_num: int):
+    WRITE_TIMEOUT = 10
+
+    def __init__(self, file_id: str, origin: SharingClientInfo, file_object: FileObject, chunk_writer: ChunkWriter,
+                 chunk_num: int, chunk_buffer: bytearray, use_ranges: bool = True, bandwidth_weight: float = 1):
         super().__init__()
+        self._bandwidth_weight = bandwidth_weight
         self._file_id = file_id
         self.origin = origin
         self._file_object = file_object
+        self._chunk_writer = chunk_writer
         self._chunk_num = chunk_num
+        self._use_ranges = use_ranges
+        self._chunk_buffer = chunk_buffer
+        self._received_length = 0
         self.stop_event = Event()
         self._channel = None
         self.finished = False
         self.failed = False
+        self.corrupted = False
+        self.data_hash = None  # the hash of corrupted data
+        self.ranges_unsupported = False  # whether the origin has dropped the range request without responding
+        self.busy_retry_after = None  # set if the origin was too busy to send the chunk
         self.start_time = None
+        self.last_activity_time = time.time()  # the last time data was received
+
+    @property
+    def chunk_num(self) -> int:
+        return self._chunk_num
+
+    @property
+    def bandwidth_weight(self) -> float:
+        return self._bandwidth_weight
+
+    @bandwidth_weight.setter
+    def bandwidth_weight(self, bandwidth_weight: float):
+        self._bandwidth_weight = bandwidth_weight
+        channel = self._channel
+        if channel is not None:
+            channel.bandwidth_weight = bandwidth_weight
 
     def _init_downloader(self):
         """
@@ -288,15 +889,53 @@ class ChunkDownloader(Thread):
         """
         s = socket()
         s.connect((self.origin.ip, self.origin.port))
-        self._channel = Channel(s, self.stop_event)
+        self._channel = Channel(s, self.stop_event, recv_limiter=download_limiter,
+                                bandwidth_weight=self._bandwidth_weight)
+
+    def _receive_data(self, data: bytes):
+        """
+        Appends data to the part of the chunk received so far.
+        """
+        if self._received_length + len(data) > len(self._chunk_buffer):
+            raise Exception(f"Got more data than the length of chunk {self._chunk_num}")
+        memoryview(self._chunk_buffer)[self._received_length:self._received_length + len(data)] = data
+        self._received_length += len(data)
 
-    def _get_chunk_data(self) -> bytes:
+    def _get_chunk_data(self):
         """
         Requests and receives the file chunk as a ChunkDataResponseMessage.
         """
         download_message = StartFileTransferMessage(file_id=self._file_id, chunk_num=self._chunk_num)
         chunk_download_response = self._channel.send_msg_and_wait_for_response(download_message)
-        return chunk_download_response.data
+        self._receive_data(chunk_download_response.data)
+
+    def _get_chunk_ranges(self):
+        """
+        Requests the part of the chunk which wasn't received yet, and receives it as RangeDataResponseMessages.
+        """
+        chunk_offset = self._chunk_num * self._file_object.chunk_size
+        chunk_length = len(self._chunk_buffer)
+        partial_data = self._file_object.take_partial_chunk(self._chunk_num)
+        if partial_data:
+            logger.debug(f"Resuming chunk {self._chunk_num} from byte {len(partial_data)}")
+            self._receive_data(partial_data)
+        received_length = self._received_length
+        self._channel.send_message(RangeRequestMessage(self._file_id, chunk_offset + received_length,
+                                                       chunk_length - received_length))
+        got_response = False
+        while received_length < chunk_length:
+            try:
+                response = self._channel.wait_for_message(RangeDataResponseMessage)
+            except (SocketClosedException, ConnectionError):
+                # legacy clients close the connection once they get a message they don't know
+                self.ranges_unsupported = not got_response
+                raise
+            got_response = True
+            if response.offset != chunk_offset + received_length or not response.data:
+                raise Exception(f"Got an unexpected range of chunk {self._chunk_num}")
+            self._receive_data(response.data)
+            received_length = self._received_length
+            self.last_activity_time = time.time()
 
     def run(self):
         """
@@ -305,18 +944,40 @@ class ChunkDownloader(Thread):
         """
         try:
             self.start_time = time.time()
+            self.last_activity_time = self.start_time
             self._init_downloader()
             logger.debug('Starting chunk download')
-            data = self._get_chunk_data()
-            logger.debug(f'Got chunk in size {len(data)}')
-            self._file_object.write_chunk(self._chunk_num, data)  # Make sure there is timeout on this in file object
-            logger.debug(f'Wrote chunk data')
+            if self._use_ranges:
+                self._get_chunk_ranges()
+            else:
+                self._get_chunk_data()
+            logger.debug(f'Got chunk in size {self._received_length}')
+            if self._received_length != len(self._chunk_buffer):
+                raise Exception(f"Got {self._received_length} bytes of chunk {self._chunk_num} instead of "
+                                f"{len(self._chunk_buffer)}")
+            if not self._file_object.is_chunk_valid(self._chunk_num, self._chunk_buffer):
+                self.corrupted = True
+                self.data_hash = calculate_chunk_hash(self._chunk_buffer)
+                raise CorruptedChunkException(f"The data of chunk {self._chunk_num} doesn't match its hash")
+            self._chunk_writer.put(self._chunk_num, self._chunk_buffer, timeout=self.WRITE_TIMEOUT)
+            self._chunk_buffer = None  # it's owned by the chunk writer from now on
+            logger.debug(f'Queued chunk data to be written')
         except Exception as e:
             # Something went wrong - we still need to download this chunk
+            if not self.corrupted:
+                self._file_object.save_partial_chunk(self._chunk_num,
+                                                     bytes(memoryview(self._chunk_buffer)[:self._received_length]))
             self._file_object.return_failed_chunk(self._chunk_num)
             self.failed = True
-            logger.error(f'Failed chunk download: {e}')
+            if isinstance(e, BusyException):
+                self.busy_retry_after = e.retry_after
+                logger.debug(f'Chunk {self._chunk_num} was not downloaded: {e}')
+            else:
+                logger.error(f'Failed chunk download: {e}')
         finally:
+            if self._chunk_buffer is not None:
+                chunk_buffers.release(self._chunk_buffer)
+                self._chunk_buffer = None
             self.stop()
 
     def stop(self):
@@ -331,6 +992,13 @@ class ChunkDownloader(Thread):
             self._channel.close()
         self.finished = True
 
+    def abort(self):
+        """
+        Closes the underlying channel of a hung downloader, causing its blocking operations to fail.
+        """
+        if self._channel is not None:
+            self._channel.close()
+
     def __str__(self):
         return "File ID: {file_id}, origin: {origin}, chunk: {chunk}".format(
             file_id=self._file_id, origin=self.origin, chunk=self._chunk_num
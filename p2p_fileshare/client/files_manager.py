@@ -3,17 +3,24 @@ A module governing file access.
 """
 import logging
 
-from p2p_fileshare.framework.channel import Channel
-from p2p_fileshare.framework.messages import SearchFileMessage, FileListMessage, ShareFileMessage, \
-    SharingInfoRequestMessage, SharingInfoResponseMessage, RemoveShareMessage, SharePortMessage, GeneralSuccessMessage
-from p2p_fileshare.framework.types import SharedFile
+from p2p_fileshare.framework.channel import Channel, SocketClosedException
+from p2p_fileshare.framework.messages import SearchFileMessage, ShareFileMessage, SharingInfoRequestMessage, \
+    RemoveShareMessage, SharePortMessage, ShareFilesBatchMessage, RemoveSharesBatchMessage, \
+    SharingInfoBatchRequestMessage, ChunkHashesMessage, SEARCH_NO_LIMIT, SEARCH_SORT_NONE
+from p2p_fileshare.framework.types import SharedFile, FileObject
+from p2p_fileshare.framework.hashing import calculate_file_hashes
 from p2p_fileshare.client.file_share import FileShareServer
 from p2p_fileshare.client.db_manager import DBManager
 from p2p_fileshare.client.file_transfer import FileDownloader
-from threading import Thread
-from typing import Optional
+from p2p_fileshare.client.download_manager import DownloadManager
+from p2p_fileshare.client.download_reader import DownloadReader
+from p2p_fileshare.client.directory_scanner import ChangedFilesScanner
+from p2p_fileshare.framework import bandwidth
+from p2p_fileshare.framework.buffer_pool import chunk_buffers
+from threading import Thread, Event, Lock
+from typing import Optional, Iterator
 import os
-import hashlib
+import weakref
 
 
 logger = logging.getLogger(__name__)
@@ -25,19 +32,43 @@ class FilesManager(object):
     The FilesManager holds both ongoing shares and downloads as well as handles actions performed via the
     metadata server (such as file search operations).
     """
+    MAX_BATCH_SIZE = 1000
+    LOAD_REPORT_INTERVAL = 10  # seconds
+    DIRECTORY_RESCAN_INTERVAL = 10 * 60  # seconds
+
     def __init__(self, communication_channel: Channel, username: Optional[str]):
         self._communication_channel = communication_channel
-        self._local_db = DBManager(self.generate_db_path(username))
+        # set before anything that might fail, so that __del__ can always clean up
+        self._stop_event = Event()
         self._file_share_server = None  # type: Optional[FileShareServer]
+        # shares are added by directory scans in the background as well
+        self._file_share_start_lock = Lock()
+        self._directory_scan_lock = Lock()
+        # the server pushes messages to us (such as changes in the origins of files we download)
+        self._communication_channel.start_dispatching()
+        self._local_db = DBManager(self.generate_db_path(username))
+        self._local_db.load_shares()
         self._file_share_thread = None
+        self._load_report_thread = None
         self.__initialize_file_share_server()
-        self.downloaders = []
+        self._download_manager = DownloadManager()
+        self.resume_downloads()
+        # the thread must not keep self alive (see __start_file_share), so it only references it while rescanning
+        self._directory_rescan_thread = Thread(target=self._rescan_directories_periodically, daemon=True,
+                                               args=(weakref.ref(self), self._stop_event,
+                                                     self.DIRECTORY_RESCAN_INTERVAL))
+        self._directory_rescan_thread.start()
 
     def __del__(self):
         """
         We need to define this method ourselves to make sure the local sharing server stops once the application dies
         out.
         """
+        self._stop_event.set()
+        # the download manager might not exist if __init__ has failed
+        if getattr(self, "_download_manager", None) is not None:
+            self._download_manager.stop()
+        self._communication_channel.stop_dispatching()
         if self._file_share_server is not None:
             self._file_share_server.stop()
 
@@ -54,33 +85,99 @@ class FilesManager(object):
         self._file_share_thread.start()
         # let the server know our share port so that other clients can communicate with us
         self._communication_channel.send_message(SharePortMessage(self._file_share_server.sharing_port))
+        # the thread must not reference self, otherwise the FilesManager would never be destroyed (and stopped)
+        self._load_report_thread = Thread(target=self._report_load, daemon=True,
+                                          args=(self._communication_channel, self._file_share_server,
+                                                self._stop_event, self.LOAD_REPORT_INTERVAL))
+        self._load_report_thread.start()
+
+    @staticmethod
+    def _report_load(communication_channel: Channel, file_share_server: FileShareServer, stop_event: Event,
+                     interval: float):
+        """
+        Periodically reports the load of the local FileShareServer to the metadata server, so that it could direct
+        downloaders to less loaded origins.
+        """
+        while not stop_event.wait(interval):
+            try:
+                communication_channel.send_message(file_share_server.load_report)
+            except (SocketClosedException, OSError):
+                logger.debug("Failed reporting our load to the metadata server, stopping load reports")
+                return
 
     def __initialize_file_share_server(self):
         if self._local_db.is_there_any_shared_file():
             self.__start_file_share()
 
+    def _ensure_file_share_started(self):
+        with self._file_share_start_lock:
+            if self._file_share_server is None:
+                self.__start_file_share()
+
     @staticmethod
     def _calculate_file_hash(file_path: str) -> str:
         """
         Calculates the hash of a local file's data by reading chunks of it and feeding them to the md5 algorithm.
         :return an hexadecimal representation of the file's hash.
         """
-        current_md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            file_chunk = f.read(1024 * 1024)
-            while len(file_chunk) > 0:
-                current_md5.update(file_chunk)
-                file_chunk = f.read(1024 * 1024)
-        return current_md5.hexdigest()
+        return calculate_file_hashes(file_path, FileObject.CHUNK_SIZE)[0]
+
+    def search_file_page(self, file_name: str, limit: int = SEARCH_NO_LIMIT, offset: int = 0,
+                         sort_by: int = SEARCH_SORT_NONE) -> tuple[list[SharedFile], Optional[int]]:
+        """
+        Retrieves a single page of search results from the metadata server.
+        :param file_name: The name (or a substring) of a the file name
+        :param limit: The maximal amount of files to retrieve (the server may cap it with its own page size).
+        :param offset: The offset of the first file to retrieve (a previously returned next offset).
+        :param sort_by: One of the SEARCH_SORT_* constants.
+        :return: A 2-tuple of (a list of SharedFile objects, the offset of the next page or None if this is the last one)
+        """
+        msg = SearchFileMessage(file_name, limit, offset, sort_by)
+        file_list = self._communication_channel.send_msg_and_wait_for_response(msg)
+        return file_list.files, file_list.next_offset
+
+    def iter_search_results(self, file_name: str, offset: int = 0,
+                            sort_by: int = SEARCH_SORT_NONE) -> Iterator[SharedFile]:
+        """
+        Lazily iterates all the files matching the search, requesting a new page from the server only once the previous
+        one has been consumed.
+        """
+        while offset is not None:
+            files, offset = self.search_file_page(file_name, offset=offset, sort_by=sort_by)
+            yield from files
 
-    def search_file(self, file_name: str) -> list[SharedFile]:
+    def search_file(self, file_name: str, limit: Optional[int] = None, offset: int = 0,
+                    sort_by: int = SEARCH_SORT_NONE) -> list[SharedFile]:
         """
         :param file_name: The name (or a substring) of a the file name
+        :param limit: The maximal amount of files to retrieve, None to retrieve all matching files.
+        :param offset: The amount of matching files to skip.
+        :param sort_by: One of the SEARCH_SORT_* constants.
         :return: A list of SharedFile objects
         """
-        msg = SearchFileMessage(file_name)
-        self._communication_channel.send_message(msg)
-        return self._communication_channel.wait_for_message(FileListMessage).files
+        if limit is None:
+            return list(self.iter_search_results(file_name, offset, sort_by))
+        return self.search_file_page(file_name, limit, offset, sort_by)[0]
+
+    def _create_shared_file(self, file_path: str) -> tuple[SharedFile, bytes]:
+        """
+        Creates the SharedFile object describing a local file, choosing the chunk size of the file.
+        The file is only hashed if it has changed since it was last hashed.
+        :return: A 2-tuple of (the SharedFile, the hashes of the file's chunks).
+        """
+        file_stats = os.stat(file_path)
+        chunk_size = FileObject.choose_chunk_size(file_stats.st_size)
+        file_hash, chunk_hashes = calculate_file_hashes(file_path, chunk_size, self._local_db)
+        return SharedFile(file_hash, os.path.basename(file_path), int(file_stats.st_mtime), file_stats.st_size,
+                          [], chunk_size), chunk_hashes
+
+    def _send_chunk_hashes(self, chunk_hashes: list[tuple[str, bytes, int]]):
+        """
+        Lets the server know the hashes of the chunks of files we've started sharing, so that downloaders could verify
+        the chunks they download.
+        """
+        for unique_id, file_chunk_hashes, _ in chunk_hashes:
+            self._communication_channel.send_message(ChunkHashesMessage(unique_id, file_chunk_hashes))
 
     def share_file(self, file_path: str):
         """
@@ -88,23 +185,180 @@ class FilesManager(object):
         :param file_path: The local path of the file to share.
         :return: None
         """
-        file_stats = os.stat(file_path)
-        file_hash = self._calculate_file_hash(file_path)
-        shared_file = SharedFile(file_hash, os.path.basename(file_path), int(file_stats.st_mtime), file_stats.st_size,
-                                 [])
+        shared_file, chunk_hashes = self._create_shared_file(file_path)
 
-        self._local_db.add_share(file_hash, file_path)
-        if self._file_share_server is None:
-            self.__start_file_share()
+        self._local_db.add_share(shared_file.unique_id, file_path)
+        self._local_db.add_chunk_hashes([(shared_file.unique_id, chunk_hashes, shared_file.chunk_size)])
+        self._ensure_file_share_started()
 
         shared_file_message = ShareFileMessage(shared_file)
-        self._communication_channel.send_message(shared_file_message)
         try:
-            self._communication_channel.wait_for_message(GeneralSuccessMessage)
+            self._communication_channel.send_msg_and_wait_for_response(shared_file_message)
             logger.debug(f"Successfully add new file share")
         except Exception as e:
             logger.debug(f"Failed adding new file share")
+        self._send_chunk_hashes([(shared_file.unique_id, chunk_hashes, shared_file.chunk_size)])
 
+    def _send_batches(self, batch_message_type: type, items: list) -> list[bool]:
+        """
+        Sends the items to the server via batch messages of at most MAX_BATCH_SIZE items each.
+        :return: The status the server has returned for each of the items.
+        """
+        statuses = []
+        for batch_start in range(0, len(items), self.MAX_BATCH_SIZE):
+            batch_message = batch_message_type(items[batch_start:batch_start + self.MAX_BATCH_SIZE])
+            statuses += self._communication_channel.send_msg_and_wait_for_response(batch_message).statuses
+        return statuses
+
+    def share_files(self, file_paths: list[str]) -> list[bool]:
+        """
+        Starts to share multiple files at once. The server is notified of all the files using as few round trips as
+        possible.
+        :param file_paths: The local paths of the files to share.
+        :return: Whether the server has accepted the share of each of the files (in the order of file_paths).
+        """
+        return self._add_shares([(file_path, *self._create_shared_file(file_path)) for file_path in file_paths])
+
+    def _add_shares(self, shares: list[tuple[str, SharedFile, bytes]]) -> list[bool]:
+        """
+        Starts to share files which were already hashed, notifying the server of all of them using batches.
+        :param shares: A list of (file path, SharedFile, hashes of the file's chunks) tuples.
+        :return: Whether the server has accepted the share of each of the files.
+        """
+        chunk_hashes = [(shared_file.unique_id, file_chunk_hashes, shared_file.chunk_size)
+                        for _, shared_file, file_chunk_hashes in shares]
+        self._local_db.add_shares([(shared_file.unique_id, file_path) for file_path, shared_file, _ in shares])
+        self._local_db.add_chunk_hashes(chunk_hashes)
+        self._ensure_file_share_started()
+
+        statuses = self._send_batches(ShareFilesBatchMessage, [shared_file for _, shared_file, _ in shares])
+        self._send_chunk_hashes(chunk_hashes)
+        logger.debug(f"Successfully added {sum(statuses)} out of {len(statuses)} new file shares")
+        return statuses
+
+    def share_directory(self, directory_path: str) -> Thread:
+        """
+        Starts to share all the files in a local directory and in its subdirectories. The directory is scanned in the
+        background, and is rescanned on every start of the client and every DIRECTORY_RESCAN_INTERVAL seconds - so
+        that new and changed files are shared, and files which were removed from the directory stop being shared.
+        :return: The thread scanning the directory.
+        """
+        directory_path = os.path.abspath(directory_path)
+        if not os.path.isdir(directory_path):
+            raise ValueError(f"{directory_path} is not a directory!")
+        self._local_db.add_shared_directory(directory_path)
+        scan_thread = Thread(target=self._scan_shared_directory, args=(directory_path,), daemon=True)
+        scan_thread.start()
+        return scan_thread
+
+    def list_shared_directories(self) -> list[str]:
+        return self._local_db.list_shared_directories()
+
+    def remove_directory_share(self, directory_path: str):
+        """
+        Stops sharing a directory along with all of its files.
+        """
+        directory_path = os.path.abspath(directory_path)
+        with self._directory_scan_lock:
+            directory_files = self._local_db.get_directory_files(directory_path)
+            self._local_db.remove_shared_directory(directory_path)
+            self._remove_stale_shares({file_path: unique_id for file_path, (unique_id, _) in directory_files.items()},
+                                      {})
+
+    def rescan_directories(self):
+        """
+        Rescans all the shared directories (only files that have changed since the previous scan are hashed).
+        """
+        for directory_path in self._local_db.list_shared_directories():
+            self._scan_shared_directory(directory_path)
+
+    @staticmethod
+    def _rescan_directories_periodically(files_manager_ref: weakref.ref, stop_event: Event, interval: float):
+        while True:
+            files_manager = files_manager_ref()
+            if files_manager is None:
+                return
+            try:
+                files_manager.rescan_directories()
+            except Exception as e:
+                logger.warning(f"Failed rescanning the shared directories: {e}")
+            del files_manager
+            if stop_event.wait(interval):
+                return
+
+    def _scan_shared_directory(self, directory_path: str):
+        """
+        Shares the files of a directory which have changed since it was last scanned (in batches, while the scan goes
+        on), and stops sharing the files which were changed or removed since.
+        """
+        with self._directory_scan_lock:
+            known_files = self._local_db.get_directory_files(directory_path)
+            scanner = ChangedFilesScanner(directory_path, {file_path: file_key
+                                                           for file_path, (_, file_key) in known_files.items()})
+            current_files = {file_path: unique_id for file_path, (unique_id, _) in known_files.items()}
+            stale_files = {}
+            batch = []
+            for file_path in scanner:
+                try:
+                    shared_file, chunk_hashes = self._create_shared_file(file_path)
+                except OSError:
+                    logger.debug(f"Failed hashing {file_path}, it would be retried on the next scan")
+                    continue
+                batch.append((file_path, shared_file, chunk_hashes))
+                if file_path in known_files and known_files[file_path][0] != shared_file.unique_id:
+                    stale_files[file_path] = known_files[file_path][0]
+                current_files[file_path] = shared_file.unique_id
+                if len(batch) == self.MAX_BATCH_SIZE:
+                    self._add_directory_shares(directory_path, batch)
+                    batch = []
+            if batch:
+                self._add_directory_shares(directory_path, batch)
+            removed_files = scanner.get_removed_files()
+            self._local_db.remove_directory_files(list(removed_files))
+            stale_files.update({file_path: current_files.pop(file_path) for file_path in removed_files})
+            self._remove_stale_shares(stale_files, current_files)
+
+    def _add_directory_shares(self, directory_path: str, shares: list[tuple[str, SharedFile, bytes]]):
+        self._local_db.add_directory_files(directory_path, [(file_path, shared_file.unique_id)
+                                                            for file_path, shared_file, _ in shares])
+        self._add_shares(shares)
+
+    def _remove_stale_shares(self, stale_files: dict[str, str], current_files: dict[str, str]):
+        """
+        Stops sharing the previous versions of files. Shares whose data is still found in another file of the directory
+        are moved to that file instead, and shares whose data is shared from another path anyway are kept as is.
+        :param stale_files: The unique IDs the files had, by the paths of the files.
+        :param current_files: The unique IDs of the files the directory still has, by the paths of the files.
+        """
+        shared_paths = {unique_id: file_path for file_path, unique_id in self._local_db.list_shares()}
+        current_paths = {unique_id: file_path for file_path, unique_id in current_files.items()}
+        moved_shares, stale_ids = [], []
+        for file_path, unique_id in stale_files.items():
+            if shared_paths.get(unique_id) != file_path:
+                continue
+            if unique_id in current_paths:
+                moved_shares.append((unique_id, current_paths[unique_id]))
+            else:
+                stale_ids.append(unique_id)
+        self._local_db.add_shares(moved_shares)
+        if stale_ids:
+            self.remove_shares(stale_ids)
+
+    def _start_download(self, shared_file: SharedFile, local_path: str, downloaded_chunks: bytes = None):
+        """
+        Starts downloading a file whose sharing information has been retrieved from the server.
+        :param downloaded_chunks: When resuming a download - the bitmap of the chunks which were previously downloaded.
+        """
+        for sc in shared_file.origins:
+            logger.debug(f"Origin: {sc.ip}:{sc.port}")
+
+        if downloaded_chunks is None:
+            self._local_db.add_download(shared_file, local_path)
+        file_downloader = FileDownloader(shared_file, self._communication_channel, local_path, self._local_db,
+                                         downloaded_chunks, download_slots=self._download_manager.download_slots,
+                                         on_stopped=self._download_manager.download_stopped, start=False)
+        self._download_manager.add_download(file_downloader)
+        logger.debug('FileDownloader queued!')
 
     def download_file(self, unique_id: str, local_path: str):
         """
@@ -112,29 +366,135 @@ class FilesManager(object):
         :param unique_id: The unique id identifying the file.
         :param local_path: The path to download the file to.
         """
-        if unique_id+local_path in self.downloaders:
+        if self._download_manager.has_download(unique_id, local_path):
             logger.warning('Given file was already downloaded to given location, please list and remove it first')
         else:
             logger.debug("Sending file info request to server")
             sharing_info_request = SharingInfoRequestMessage(unique_id)
-            self._communication_channel.send_message(sharing_info_request)
-            shared_file = self._communication_channel.wait_for_message(SharingInfoResponseMessage).shared_file
-            for sc in shared_file.origins:
-                logger.debug(f"Origin: {sc.ip}:{sc.port}")
+            shared_file = self._communication_channel.send_msg_and_wait_for_response(sharing_info_request).shared_file
+            self._start_download(shared_file, local_path)
 
-            file_downloader = FileDownloader(shared_file, self._communication_channel, local_path)
-            self.downloaders.append(file_downloader)
-            logger.debug('FileDownloader started!')
+    def get_sharing_info(self, unique_ids: list[str]) -> list[SharedFile]:
+        """
+        Retrieves the sharing information (file metadata and connected origins) of multiple files, using as few round
+        trips as possible.
+        :return: A SharedFile for each of the files found by the server.
+        """
+        shared_files = []
+        for batch_start in range(0, len(unique_ids), self.MAX_BATCH_SIZE):
+            request = SharingInfoBatchRequestMessage(unique_ids[batch_start:batch_start + self.MAX_BATCH_SIZE])
+            shared_files += self._communication_channel.send_msg_and_wait_for_response(request).shared_files
+        return shared_files
+
+    def download_files(self, downloads: list[tuple[str, str]]):
+        """
+        Downloads multiple files, retrieving the sharing information of all of them at once.
+        :param downloads: A list of (unique id, local path) tuples.
+        """
+        shared_files = {shared_file.unique_id: shared_file
+                        for shared_file in self.get_sharing_info([unique_id for unique_id, _ in downloads])}
+        for unique_id, local_path in downloads:
+            if unique_id not in shared_files:
+                logger.warning(f"Found no files with the unique ID {unique_id}, skipping its download")
+                continue
+            self._start_download(shared_files[unique_id], local_path)
+
+    def resume_downloads(self):
+        """
+        Continues the downloads that haven't finished during previous runs of the application (the chunks which were
+        already downloaded are not downloaded again).
+        """
+        unfinished_downloads = self._local_db.list_downloads()
+        if not unfinished_downloads:
+            return
+        try:
+            shared_files = {shared_file.unique_id: shared_file for shared_file in
+                            self.get_sharing_info([shared_file.unique_id for shared_file, _, _ in unfinished_downloads])}
+        except Exception as e:
+            logger.warning(f"Failed retrieving the origins of unfinished downloads: {e}")
+            shared_files = {}
+        for shared_file, local_path, downloaded_chunks in unfinished_downloads:
+            logger.debug(f"Resuming the download of {shared_file.name} into {local_path}")
+            # Files which aren't found by the server are resumed without origins, which would be pushed to us later on
+            self._start_download(shared_files.get(shared_file.unique_id, shared_file), local_path, downloaded_chunks)
 
     def list_downloads(self) -> list[FileDownloader]:
-        return self.downloaders
+        return self._download_manager.list_downloads()
+
+    def get_download_queue_position(self, downloader: FileDownloader) -> Optional[int]:
+        """
+        :return: The amount of queued downloads which would be started before the download, or None if it isn't queued.
+        """
+        return self._download_manager.queue_position(downloader)
 
     def remove_download(self, downloader_id: int):
-        if not (0 <= downloader_id < len(self.downloaders)):
-            logger.warning('Unknown downloader')
-        else:
-            fd = self.downloaders.pop(downloader_id)
-            fd.stop()
+        fd = self._download_manager.remove_download(downloader_id)
+        if fd is not None:
+            self._local_db.remove_download(fd.file_info.unique_id, fd.local_path)
+
+    def open_download(self, downloader_id: int, timeout: Optional[float] = None) -> Optional[DownloadReader]:
+        """
+        Opens a download for reading while it's downloaded. The download is switched to streaming mode, so that the
+        chunks near the data being read are downloaded first.
+        :param timeout: The maximal amount of seconds a single read may block for (None means forever).
+        :return: A file-like object whose reads block until the data they need is downloaded, or None if there's no such
+        download.
+        """
+        downloader = self._download_manager.get_download(downloader_id)
+        if downloader is None:
+            return None
+        downloader.streaming = True
+        return DownloadReader(downloader, timeout)
+
+    def pause_download(self, downloader_id: int):
+        """
+        Pauses a download, letting the next queued download start (the chunks downloaded so far are kept).
+        """
+        self._download_manager.pause_download(downloader_id)
+
+    def resume_download(self, downloader_id: int):
+        """
+        Queues a paused download again.
+        """
+        self._download_manager.resume_download(downloader_id)
+
+    def set_download_priority(self, downloader_id: int, priority: float):
+        """
+        Changes the priority of a download - downloads with higher priorities are started first, and get a larger share
+        of the download bandwidth.
+        """
+        self._download_manager.set_priority(downloader_id, priority)
+
+    @staticmethod
+    def set_bandwidth_limits(upload_rate: int = None, download_rate: int = None):
+        """
+        Limits the total upload and download rates of the application (in bytes per second, 0 means unlimited). Rates
+        which aren't given are left as they are.
+        """
+        bandwidth.set_bandwidth_limits(upload_rate, download_rate)
+
+    @staticmethod
+    def get_bandwidth_limits() -> tuple[int, int]:
+        """
+        :return: The upload and download rate limits (in bytes per second, 0 means unlimited).
+        """
+        return bandwidth.upload_limiter.rate, bandwidth.download_limiter.rate
+
+    @staticmethod
+    def set_chunk_buffers_budget(budget: int):
+        """
+        Limits the total size of the buffers holding chunk data in flight (both downloaded and uploaded), in bytes.
+        """
+        chunk_buffers.set_budget(budget)
+
+    @staticmethod
+    def get_chunk_buffers_usage() -> dict[str, int]:
+        """
+        :return: The budget of the chunk buffers, the size of the buffers in use and of the idle ones kept for reuse (in
+        bytes), and the amount of transfers waiting for a buffer.
+        """
+        return {"budget": chunk_buffers.budget, "used": chunk_buffers.used, "idle": chunk_buffers.idle,
+                "waiting": chunk_buffers.waiters}
 
     def list_shares(self):
         return self._local_db.list_shares()
@@ -145,10 +505,20 @@ class FilesManager(object):
         file from the "shared files" table.
         :param unique_id: A unique ID identifying the file to stop sharing.
         """
-        self._communication_channel.send_message(RemoveShareMessage(unique_id))
         try:
-            self._communication_channel.wait_for_message(GeneralSuccessMessage)
+            self._communication_channel.send_msg_and_wait_for_response(RemoveShareMessage(unique_id))
             logger.debug(f"Successfully removed file share from metadata server")
         except Exception as e:
             logger.debug(f"Failed removing file share from metadata server")
         self._local_db.remove_share(unique_id)
+
+    def remove_shares(self, unique_ids: list[str]) -> list[bool]:
+        """
+        Stops sharing multiple local files at once, both in the metadata server and locally.
+        :param unique_ids: The unique IDs identifying the files to stop sharing.
+        :return: Whether the server has removed the share of each of the files (in the order of unique_ids).
+        """
+        statuses = self._send_batches(RemoveSharesBatchMessage, unique_ids)
+        logger.debug(f"Successfully removed {sum(statuses)} out of {len(statuses)} file shares from metadata server")
+        self._local_db.remove_shares(unique_ids)
+        return statuses
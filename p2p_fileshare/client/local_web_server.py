@@ -5,15 +5,23 @@ localhost:5050 in their browser). All information transfers between the web page
 are done via REST API which is implemented in this module.
 """
 
+import logging
+import mimetypes
+import os
 import sys
-from typing import Optional
-from flask import Flask, request, render_template
+from typing import Iterator, Optional
+from flask import Flask, Response, request, render_template, abort
+from werkzeug.exceptions import HTTPException
+from p2p_fileshare.client.download_reader import DownloadReader
 from p2p_fileshare.client.files_manager import FilesManager
+from p2p_fileshare.framework.messages import SEARCH_SORT_NONE, SEARCH_SORT_NAME, SEARCH_SORT_SIZE, \
+    SEARCH_SORT_MODIFICATION_TIME
 from main import initialize_files_manager
 
 
 app = Flask(__name__)
 files_manager = None  # type: Optional[FilesManager]
+logger = logging.getLogger(__name__)
 
 
 def wrap_response(func):
@@ -28,17 +36,40 @@ def wrap_response(func):
                 response = {}
             response["success"] = True
             return response
+        except HTTPException:
+            raise  # the request itself is invalid, let Flask respond with the appropriate HTTP error
         except Exception as e:
             return {"success": False, "error": e.args}
     inner.__name__ = func.__name__ + "_inner"  # required so that Flask will allow us to wrap our functions
     return inner
 
 
+SEARCH_PAGE_SIZE = 50
+SEARCH_SORT_OPTIONS = {"name": SEARCH_SORT_NAME, "size": SEARCH_SORT_SIZE, "modification_time": SEARCH_SORT_MODIFICATION_TIME}
+MAX_SEARCH_ARGUMENT = 2 ** 32 - 1  # the limit and offset are sent to the server as unsigned 32 bit integers
+
+
+def get_search_argument(name: str, default: int) -> int:
+    """
+    Parses an integral argument of a search request, clamping it to the range the server accepts.
+    Responds with 400 (Bad Request) if the argument isn't an integer.
+    """
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, f"The {name} of a search must be an integer")
+    return min(max(value, 0), MAX_SEARCH_ARGUMENT)
+
+
 @app.route('/search/<filename>')
 @wrap_response
 def search_file(filename):
-    result = files_manager.search_file(filename)
-    response = {"files": []}
+    limit = get_search_argument('limit', SEARCH_PAGE_SIZE)
+    offset = get_search_argument('offset', 0)
+    sort_by = SEARCH_SORT_OPTIONS.get(request.args.get('sort'), SEARCH_SORT_NONE)
+    result, next_offset = files_manager.search_file_page(filename, limit, offset, sort_by)
+    response = {"files": [], "next_offset": next_offset}
     for file in result:
         response["files"].append({
             "description": f"Name: {file.name}, modification time: {file.modification_time}, size: {file.size}",
@@ -50,7 +81,10 @@ def search_file(filename):
 @wrap_response
 def share_file():
     file_path = request.args.get('local_path')
-    files_manager.share_file(file_path)
+    if os.path.isdir(file_path):
+        files_manager.share_directory(file_path)
+    else:
+        files_manager.share_file(file_path)
 
 
 @app.route('/download')
@@ -67,22 +101,125 @@ def list_downloads():
     downloaders = files_manager.list_downloads()
     response = {"downloads": []}
     for downloader in downloaders:
+        queue_position = files_manager.get_download_queue_position(downloader)
         response["downloads"].append({
             "local_path": downloader.local_path,
             "name": downloader.file_info.name,
             "progress": "{}%".format(downloader.progress),
             "done": downloader.is_done(),
-            "failed": downloader.failed
+            "failed": downloader.failed,
+            "paused": downloader.is_paused and queue_position is None,
+            "priority": downloader.priority,
+            "queue_position": queue_position
         })
     return response
 
 
+@app.route('/pause-download/<download_id>')
+@wrap_response
+def pause_download(download_id):
+    files_manager.pause_download(int(download_id))
+
+
+@app.route('/resume-download/<download_id>')
+@wrap_response
+def resume_download(download_id):
+    files_manager.resume_download(int(download_id))
+
+
+@app.route('/download-priority/<download_id>')
+@wrap_response
+def set_download_priority(download_id):
+    files_manager.set_download_priority(int(download_id), float(request.args.get('priority')))
+
+
+@app.route('/bandwidth')
+@wrap_response
+def bandwidth_limits():
+    """
+    Changes the upload and download rate limits (in bytes per second, 0 means unlimited) if they're given, and responds
+    with the current limits.
+    """
+    upload_rate = request.args.get('upload')
+    download_rate = request.args.get('download')
+    files_manager.set_bandwidth_limits(None if upload_rate is None else int(upload_rate),
+                                       None if download_rate is None else int(download_rate))
+    upload_rate, download_rate = files_manager.get_bandwidth_limits()
+    return {"upload": upload_rate, "download": download_rate}
+
+
 @app.route('/remove-download/<download_id>')
 @wrap_response
 def remove_download(download_id):
     files_manager.remove_download(int(download_id))
 
 
+@app.route('/buffers')
+@wrap_response
+def chunk_buffers_usage():
+    """
+    Changes the budget of the chunk buffers (in bytes) if it's given, and responds with the current usage.
+    """
+    budget = request.args.get('budget')
+    if budget is not None:
+        files_manager.set_chunk_buffers_budget(int(budget))
+    return files_manager.get_chunk_buffers_usage()
+
+
+STREAM_READ_TIMEOUT = 60  # the maximal amount of seconds a stream waits for a chunk before giving up
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def stream_range(reader: DownloadReader, start: int, length: int) -> Iterator[bytes]:
+    """
+    Yields a range of a download, blocking until each part of it is downloaded. The whole range is requested from the
+    downloader up front, so that its chunks are downloaded before the rest of the file.
+    """
+    with reader:
+        reader.prioritize_range(start, length)
+        reader.seek(start)
+        remaining = length
+        while remaining > 0:
+            try:
+                data = reader.read(min(remaining, STREAM_BLOCK_SIZE))
+            except (TimeoutError, IOError) as e:
+                # the status was already sent, so all we can do is cutting the response short
+                logger.warning(f"Stopped streaming {remaining} bytes short: {e}")
+                return
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+@app.route('/stream/<download_id>')
+def stream_download(download_id):
+    """
+    Serves the local copy of a download, even while it's being downloaded (e.g. to play a media file in the browser).
+    Supports a single byte range (responding with 206 Partial Content), whose reads block until its chunks are
+    downloaded.
+    """
+    reader = files_manager.open_download(int(download_id), STREAM_READ_TIMEOUT)
+    if reader is None:
+        abort(404, "Unknown download")
+    size = reader.size
+    headers = {"Accept-Ranges": "bytes"}
+    start, end = 0, size
+    status = 200
+    if request.range is not None and len(request.range.ranges) == 1:  # multiple ranges are ignored, as RFC 9110 allows
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            reader.close()
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}", **headers})
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    mimetype = mimetypes.guess_type(reader.name)[0] or "application/octet-stream"
+    return Response(stream_range(reader, start, end - start), status, headers, mimetype=mimetype,
+                    direct_passthrough=True)
+
+
 @app.route('/list-shares')
 @wrap_response
 def list_shares():
@@ -1,3 +1,4 @@
+import os
 import sys
 import traceback
 from socket import socket
@@ -15,9 +16,13 @@ COMMAND_PROMPT = """
 Enter a command, one of the following:
 1. search <file name or substring of it>
 2. download <file ID> <Local path> (ID retrieved from search command)
-3. share <local file path>
+3. share <local file or directory path>
 4. list-downloads
 5. remove-download <Downloader ID> (ID retrieved from list-downloads command)
+6. bandwidth <upload limit> <download limit> (bytes per second, 0 for unlimited)
+7. priority <Downloader ID> <priority> (higher priority downloads start first and get more bandwidth, default 1)
+8. pause-download <Downloader ID>
+9. resume-download <Downloader ID>
 0. exit
 """
 
@@ -43,17 +48,35 @@ def perform_command(user_input: str, files_manager: FilesManager):
         files_manager.download_file(unique_id, local_path)
     elif user_input.startswith("share "):
         file_path = user_input.split(" ")[1]
-        files_manager.share_file(file_path)
+        if os.path.isdir(file_path):
+            files_manager.share_directory(file_path)
+        else:
+            files_manager.share_file(file_path)
     elif user_input.startswith("list-downloads"):
         downloaders = files_manager.list_downloads()
         for fd_id in range(len(downloaders)):
+            queue_position = files_manager.get_download_queue_position(downloaders[fd_id])
             if downloaders[fd_id].is_done():
                 print(f"{fd_id}: Done")
+            elif queue_position is not None:
+                print(f"{fd_id}: Queued ({queue_position} ahead)")
+            elif downloaders[fd_id].is_paused:
+                print(f"{fd_id}: Paused")
             else:
                 print(f"{fd_id}: In progress")
     elif user_input.startswith("remove-download "):
         downloader_id = int(user_input.split(" ")[1])
         files_manager.remove_download(downloader_id)
+    elif user_input.startswith("pause-download "):
+        files_manager.pause_download(int(user_input.split(" ")[1]))
+    elif user_input.startswith("resume-download "):
+        files_manager.resume_download(int(user_input.split(" ")[1]))
+    elif user_input.startswith("bandwidth "):
+        upload_rate, download_rate = user_input.split(" ")[1:]
+        files_manager.set_bandwidth_limits(int(upload_rate), int(download_rate))
+    elif user_input.startswith("priority "):
+        downloader_id, priority = user_input.split(" ")[1:]
+        files_manager.set_download_priority(int(downloader_id), float(priority))
     elif user_input.startswith("exit"):
         return True
     return False
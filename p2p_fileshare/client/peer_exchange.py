@@ -0,0 +1,52 @@
+"""
+This module contains the peer table used for peer exchange (PEX).
+Downloaders periodically send the origins they know about to the origins they download from, and get back the origins
+those have learned about from other downloaders. This way origins propagate within a swarm without the metadata server.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterable
+from p2p_fileshare.framework.types import SharingClientInfo
+
+
+class PeerTable(object):
+    """
+    Keeps the most recently reported origins of every file, bounded both in the amount of origins kept per file and in
+    the time an origin is kept since it was last reported.
+    All methods of this class are thread safe.
+    """
+    MAX_PEERS_PER_FILE = 100
+    PEER_TTL = 10 * 60  # seconds
+
+    def __init__(self):
+        self._peers = {}  # type: dict[str, OrderedDict[str, tuple[float, SharingClientInfo]]]
+        self._lock = Lock()
+
+    def add_peers(self, file_unique_id: str, peers: Iterable[SharingClientInfo]):
+        with self._lock:
+            file_peers = self._peers.setdefault(file_unique_id, OrderedDict())
+            for peer in peers:
+                if peer.port is None:
+                    continue  # can't be downloaded from
+                file_peers[peer.unique_id] = (time.time(), peer)
+                file_peers.move_to_end(peer.unique_id)
+            while len(file_peers) > self.MAX_PEERS_PER_FILE:
+                file_peers.popitem(last=False)
+
+    def get_peers(self, file_unique_id: str, excluded_peers: Iterable[str] = ()) -> list[SharingClientInfo]:
+        """
+        :param excluded_peers: The unique IDs of peers which should not be returned.
+        :return: The peers of the file, most recently reported first.
+        """
+        excluded_peers = set(excluded_peers)
+        with self._lock:
+            file_peers = self._peers.get(file_unique_id)
+            if file_peers is None:
+                return []
+            expiry_time = time.time() - self.PEER_TTL
+            while file_peers and next(iter(file_peers.values()))[0] < expiry_time:
+                file_peers.popitem(last=False)
+            if not file_peers:
+                self._peers.pop(file_unique_id)
+            return [peer for _, peer in reversed(file_peers.values()) if peer.unique_id not in excluded_peers]
@@ -1,7 +1,7 @@
-function searchFile() {
+function searchFile(offset = 0) {
     const filename = document.getElementById("file_search").value;
     let request = new XMLHttpRequest();
-    request.open("GET", "/search/" + filename, false);
+    request.open("GET", "/search/" + encodeURIComponent(filename) + "?offset=" + offset, false);
     request.send(null);
     let responseJSON = JSON.parse(request.responseText);
     if (!responseJSON["success"])
@@ -14,6 +14,13 @@ function searchFile() {
             "<input type='button' value='download' class=\"btn btn-success\" onclick='downloadFile(\""
             + files[i]["unique_id"] + "\")'>" + "<br/>";
     }
+    if (offset > 0)
+        searchResultContent += "<input type='button' value='first page' class=\"btn btn-secondary\" " +
+            "onclick='searchFile(0)'>";
+    if (responseJSON["next_offset"] !== null)
+        // there are more matching files, let the user request the next page
+        searchResultContent += "<input type='button' value='next page' class=\"btn btn-secondary\" " +
+            "onclick='searchFile(" + responseJSON["next_offset"] + ")'>";
     searchResultDiv.innerHTML = searchResultContent;
 }
 
@@ -50,7 +57,8 @@ function listDownloads() {
 
         currentDownloadsContent += downloads[i]["name"] + " -> " + downloads[i]["local_path"] +
             "<input type='button' value='stop' class=\"btn btn-warning\" onclick='removeDownload(" + i + ")'" +
-            disabledAttribute + ">" + status + "<br/>";
+            disabledAttribute + ">" +
+            "<a href='/stream/" + i + "' target='_blank' class=\"btn btn-info\">open</a>" + status + "<br/>";
     }
     currentDownloadsDiv.innerHTML = currentDownloadsContent;
     if (isThereADownloadInProgress)
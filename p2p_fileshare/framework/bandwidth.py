@@ -0,0 +1,118 @@
+"""
+This module contains the bandwidth limiters shared by the whole process - one limits the rate of the data received by
+downloads, and the other limits the rate of the data sent by uploads. Both are unlimited by default, and their rates
+can be changed at any time (e.g. by the user).
+"""
+import time
+from threading import Condition
+
+
+class _Waiter(object):
+    """
+    A consumer waiting for tokens, along with the tokens it has been given so far.
+    """
+    def __init__(self, weight: float, tokens: float):
+        self.weight = weight
+        self.tokens = tokens
+
+
+class BandwidthLimiter(object):
+    """
+    A token bucket limiting the rate of the data passing through it - tokens (bytes) are added to the bucket at a
+    constant rate, up to BURST_DURATION seconds' worth of them, and passing data takes tokens out of it.
+    While consumers wait for tokens, the new tokens are split between them by their weights, so that a consumer whose
+    weight is twice as large gets twice as much bandwidth.
+    All methods of this class are thread safe.
+    """
+    BURST_DURATION = 0.5  # seconds
+    MAX_WAIT_INTERVAL = 0.1  # seconds, so that waiters notice changes in the weights of the other waiters
+
+    def __init__(self, rate: int = 0):
+        """
+        :param rate: The maximal rate, in bytes per second (0 means unlimited).
+        """
+        self._rate = rate
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._waiters = []  # type: list[_Waiter]
+        self._condition = Condition()
+
+    @property
+    def rate(self) -> int:
+        return self._rate
+
+    def set_rate(self, rate: int):
+        """
+        :param rate: The new maximal rate, in bytes per second (0 means unlimited).
+        """
+        if rate < 0:
+            raise ValueError(f"The rate must not be negative, got {rate}")
+        with self._condition:
+            self._refill()
+            self._rate = rate
+            self._tokens = min(self._tokens, self._max_tokens)
+            self._condition.notify_all()
+
+    @property
+    def _max_tokens(self) -> float:
+        return self._rate * self.BURST_DURATION
+
+    def _refill(self):
+        """
+        Adds the tokens accumulated since the last refill. Must be called while holding the lock.
+        """
+        now = time.monotonic()
+        new_tokens = (now - self._last_refill) * self._rate
+        self._last_refill = now
+        if self._waiters:
+            total_weight = sum(waiter.weight for waiter in self._waiters)
+            for waiter in self._waiters:
+                waiter.tokens += new_tokens * waiter.weight / total_weight
+        else:
+            self._tokens = min(self._tokens + new_tokens, self._max_tokens)
+
+    def consume(self, amount: int, weight: float = 1) -> float:
+        """
+        Takes tokens for amount bytes, waiting for them if there aren't enough.
+        :param weight: The share of the bandwidth the consumer gets relatively to the other waiting consumers.
+        :return: The amount of seconds spent waiting.
+        """
+        if weight <= 0:
+            raise ValueError(f"The weight must be positive, got {weight}")
+        with self._condition:
+            if self._rate == 0:
+                return 0
+            self._refill()
+            if not self._waiters and self._tokens >= amount:
+                self._tokens -= amount
+                return 0
+            start_time = time.monotonic()
+            waiter = _Waiter(weight, self._tokens)
+            self._tokens = 0
+            self._waiters.append(waiter)
+            try:
+                while self._rate != 0 and waiter.tokens < amount:
+                    total_weight = sum(other_waiter.weight for other_waiter in self._waiters)
+                    missing_time = (amount - waiter.tokens) * total_weight / (self._rate * weight)
+                    self._condition.wait(min(missing_time, self.MAX_WAIT_INTERVAL))
+                    self._refill()
+            finally:
+                self._waiters.remove(waiter)
+                # the tokens given beyond the amount are returned to the bucket
+                self._tokens = min(self._tokens + max(waiter.tokens - amount, 0), self._max_tokens)
+            return time.monotonic() - start_time
+
+
+upload_limiter = BandwidthLimiter()
+download_limiter = BandwidthLimiter()
+
+
+def set_bandwidth_limits(upload_rate: int = None, download_rate: int = None):
+    """
+    Changes the rates of the process-wide limiters (in bytes per second, 0 means unlimited). Rates which aren't given
+    are left as they are.
+    """
+    if upload_rate is not None:
+        upload_limiter.set_rate(upload_rate)
+    if download_rate is not None:
+        download_limiter.set_rate(download_rate)
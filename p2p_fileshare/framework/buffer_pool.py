@@ -0,0 +1,138 @@
+"""
+This module contains the pool of the buffers holding chunk data in flight, shared by the whole process - the chunks
+being downloaded (until they're written to the disk) and the chunks being uploaded. The pool keeps the total size of its
+buffers within a budget, so the memory used for chunk data doesn't grow with the amount of concurrent transfers.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Condition
+from typing import Iterator, Optional
+
+
+class BufferPool(object):
+    """
+    Hands out reusable buffers (bytearrays of the requested size), keeping the total size of the buffers it has
+    allocated (both in use and idle) within a budget. Once the budget is used up, acquiring a buffer waits until enough
+    buffers are released, and idle buffers of other sizes are dropped to make room for new ones.
+    A buffer larger than the whole budget is only handed out when no other buffer is in use.
+    All methods of this class are thread safe.
+    """
+    DEFAULT_BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, budget: int = DEFAULT_BUDGET):
+        self._budget = budget
+        self._used = 0  # the size of the buffers in use
+        self._idle_size = 0
+        self._idle_buffers = defaultdict(list)  # type: dict[int, list[bytearray]]
+        self._waiters = 0
+        self._condition = Condition()
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    @property
+    def used(self) -> int:
+        """
+        The total size of the buffers in use.
+        """
+        return self._used
+
+    @property
+    def idle(self) -> int:
+        """
+        The total size of the buffers kept for reuse.
+        """
+        return self._idle_size
+
+    @property
+    def waiters(self) -> int:
+        """
+        The amount of threads waiting for a buffer.
+        """
+        return self._waiters
+
+    def set_budget(self, budget: int):
+        if budget <= 0:
+            raise ValueError(f"The budget must be positive, got {budget}")
+        with self._condition:
+            self._budget = budget
+            self._drop_idle_buffers(self._used + self._idle_size - budget)
+            self._condition.notify_all()
+
+    def _drop_idle_buffers(self, size: int):
+        """
+        Drops idle buffers until at least size bytes are freed (or there are no more idle buffers).
+        Must be called while holding the lock.
+        """
+        for buffer_size in list(self._idle_buffers):
+            buffers = self._idle_buffers[buffer_size]
+            while buffers and size > 0:
+                buffers.pop()
+                self._idle_size -= buffer_size
+                size -= buffer_size
+            if not buffers:
+                self._idle_buffers.pop(buffer_size)
+
+    def _try_take(self, size: int) -> Optional[bytearray]:
+        """
+        Must be called while holding the lock.
+        """
+        if self._idle_buffers.get(size):
+            buffer = self._idle_buffers[size].pop()
+            self._idle_size -= size
+        elif self._used + size <= self._budget or self._used == 0:
+            self._drop_idle_buffers(self._used + self._idle_size + size - self._budget)
+            buffer = bytearray(size)
+        else:
+            return None
+        self._used += size
+        return buffer
+
+    def acquire(self, size: int, timeout: Optional[float] = None) -> Optional[bytearray]:
+        """
+        Takes a buffer of the given size, waiting while the budget is used up. The buffer's initial content is
+        undefined.
+        :return: The buffer, or None if the timeout has expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._waiters += 1
+            try:
+                buffer = self._try_take(size)
+                while buffer is None:
+                    remaining_time = None if deadline is None else deadline - time.monotonic()
+                    if remaining_time is not None and remaining_time <= 0:
+                        return None
+                    self._condition.wait(remaining_time)
+                    buffer = self._try_take(size)
+                return buffer
+            finally:
+                self._waiters -= 1
+
+    def release(self, buffer: bytearray):
+        """
+        Returns a buffer taken by acquire to the pool. The buffer mustn't be used afterwards.
+        """
+        with self._condition:
+            self._used -= len(buffer)
+            if self._used + self._idle_size + len(buffer) <= self._budget:
+                self._idle_buffers[len(buffer)].append(buffer)
+                self._idle_size += len(buffer)
+            self._condition.notify_all()
+
+    @contextmanager
+    def buffer(self, size: int, timeout: Optional[float] = None) -> Iterator[Optional[bytearray]]:
+        """
+        Same as acquire, releasing the buffer (if it was acquired) once the context exits.
+        """
+        buffer = self.acquire(size, timeout)
+        try:
+            yield buffer
+        finally:
+            if buffer is not None:
+                self.release(buffer)
+
+
+chunk_buffers = BufferPool()
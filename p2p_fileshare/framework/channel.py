@@ -4,10 +4,13 @@ This module is a wrapper for reliable communication with an endpoint.
 import logging
 import time
 
-from p2p_fileshare.framework.messages import Message, GeneralErrorMessage
+from p2p_fileshare.framework.messages import Message, GeneralErrorMessage, BusyMessage
+from p2p_fileshare.framework.bandwidth import BandwidthLimiter
 from socket import socket
 from struct import pack, unpack
-from threading import Event
+from threading import Event, Lock, RLock, Thread
+from queue import Queue, Empty
+from typing import Callable, Optional
 import select
 
 
@@ -26,6 +29,15 @@ class StopEventSignaledException(Exception):
     pass
 
 
+class BusyException(Exception):
+    """
+    Raised when the endpoint is too busy to handle a request (see BusyMessage).
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f"The endpoint is busy, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
 class Channel(object):
     """
     An object wrapping an underlying socket and allowing communication with a remote endpoint via messages (objects
@@ -34,24 +46,141 @@ class Channel(object):
     The protocol used by the channel in order to transfer messages via a TCP stream is as follows:
         4 bytes of data - N
         N bytes of data - Message.
+
+    A channel whose endpoint may push messages at any time (rather than only responding to requests) should start
+    dispatching - from then on a dedicated thread reads all incoming messages, passing pushed messages to their
+    registered handlers and keeping the rest for the threads waiting for responses.
+
+    The data sent and received by a channel may be metered by bandwidth limiters, in which case it's passed in blocks of
+    at most LIMITED_BLOCK_SIZE bytes (the time spent waiting for the limiter doesn't count towards the timeouts).
     """
     DEFAULT_TIMEOUT = 10
+    DISPATCH_POLL_INTERVAL = 1
+    LIMITED_BLOCK_SIZE = 64 * 1024
 
-    def __init__(self, endpoint_socket: socket, stop_event: Event = None):
+    def __init__(self, endpoint_socket: socket, stop_event: Event = None, send_limiter: BandwidthLimiter = None,
+                 recv_limiter: BandwidthLimiter = None, bandwidth_weight: float = 1):
+        """
+        :param bandwidth_weight: The share of the bandwidth of the limiters the channel gets, relatively to the other
+        channels waiting for them.
+        """
         self._socket = endpoint_socket
+        self._send_limiter = send_limiter
+        self._recv_limiter = recv_limiter
+        self.bandwidth_weight = bandwidth_weight
         self._is_socket_closed = False
         if stop_event is None:
             stop_event = Event()
         self._stop_event = stop_event
+        self._request_lock = RLock()
+        # The amount of requests which have timed out, whose responses might still be received
+        self._late_responses = 0
+        self._send_lock = RLock()
+        self._push_handlers = {}  # type: dict[type, list[Callable[[Message], None]]]
+        self._push_handlers_lock = Lock()
+        self._responses = None  # type: Optional[Queue]
+        self._dispatch_thread = None
+        self._stop_dispatching_event = Event()
+
+    def add_push_handler(self, message_type: type, handler: Callable[[Message], None]):
+        """
+        Registers a handler to be called (from the dispatching thread) for every received message of message_type.
+        """
+        with self._push_handlers_lock:
+            self._push_handlers.setdefault(message_type, []).append(handler)
+
+    def remove_push_handler(self, message_type: type, handler: Callable[[Message], None]):
+        with self._push_handlers_lock:
+            handlers = self._push_handlers.get(message_type, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def start_dispatching(self):
+        """
+        Starts the thread reading all incoming messages. Once called, messages should no longer be received via
+        recv_message (but only via wait_for_message and send_msg_and_wait_for_response).
+        """
+        self._responses = Queue()
+        self._dispatch_thread = Thread(target=self.__dispatch, daemon=True)
+        self._dispatch_thread.start()
+
+    def stop_dispatching(self):
+        """
+        Stops the dispatching thread (which references the channel, and so keeps its socket from being closed once it's
+        no longer used).
+        """
+        self._stop_dispatching_event.set()
+
+    def __dispatch(self):
+        """
+        The main loop of the dispatching thread.
+        Handlers are called synchronously, so they shouldn't block (or wait for responses via this channel).
+        """
+        error = SocketClosedException()
+        try:
+            while not self._stop_event.is_set() and not self._stop_dispatching_event.is_set():
+                rlist, _, _ = select.select([self._socket], [], [], self.DISPATCH_POLL_INTERVAL)
+                if not rlist:
+                    continue
+                msg = self.recv_message()
+                if msg is None:
+                    break  # the stop event was set
+                with self._push_handlers_lock:
+                    handlers = list(self._push_handlers.get(type(msg), []))
+                if not handlers:
+                    self._responses.put(msg)
+                for handler in handlers:
+                    try:
+                        handler(msg)
+                    except Exception as e:
+                        logger.error(f"Push handler of {type(msg).__name__} has failed: {e}")
+        except Exception as e:
+            error = e
+        # let the waiting threads know the channel is no longer usable
+        self._responses.put(error)
+
+    def _next_message(self, timeout: float) -> Message:
+        """
+        Retrieves the next message which isn't handled by a push handler.
+        """
+        if self._responses is None:
+            return self.recv_message(timeout)
+        try:
+            msg = self._responses.get(timeout=max(timeout, 0))
+        except Empty:
+            raise TimeoutException
+        if isinstance(msg, Exception):
+            self._responses.put(msg)  # the next waiting thread should get it as well
+            raise msg
+        return msg
 
     def send_msg_and_wait_for_response(self, message: Message, timeout: float = DEFAULT_TIMEOUT):
         """
         Sends a message and wait for the server's response.
+        Multiple threads may use this method concurrently - each request is paired with its own response.
         :param message: The message to send.
         :return: A Message object containing the server's response.
         """
-        self.send_message(message)
-        return self.wait_for_message(message.matching_response_type, timeout=timeout)
+        with self._request_lock:
+            deadline = time.time() + timeout
+            self.send_message(message)
+            try:
+                # Responses arrive in the order of the requests, so late responses precede the response to this request
+                self._skip_late_responses(deadline)
+                return self.wait_for_message(message.matching_response_type, timeout=deadline - time.time())
+            except TimeoutException:
+                self._late_responses += 1
+                raise
+
+    def _skip_late_responses(self, deadline: float):
+        """
+        Receives and discards the responses to the requests that have previously timed out.
+        Must be called while holding the request lock.
+        """
+        while self._late_responses > 0:
+            msg = self._next_message(deadline - time.time())
+            self._late_responses -= 1
+            logger.debug(f"Discarding a late response of type {type(msg).__name__}")
 
     def _get_data_from_sock(self, data_len, timeout: float):
         """
@@ -68,12 +197,17 @@ class Channel(object):
 
             rlist, _, _ = select.select([self._socket], [], [], remaining_time)
             if rlist:
-                new_data = self._socket.recv(data_len-len(received_data))
+                if self._recv_limiter is None:
+                    new_data = self._socket.recv(data_len-len(received_data))
+                else:
+                    new_data = self._socket.recv(min(data_len - len(received_data), self.LIMITED_BLOCK_SIZE))
                 if len(new_data) == 0:
                     logger.debug('Got 0 bytes from socket, socket is closed')
                     self._is_socket_closed = True
                     raise SocketClosedException()
                 received_data += new_data
+                if self._recv_limiter is not None:
+                    start_time += self._recv_limiter.consume(len(new_data), self.bandwidth_weight)
             remaining_time = timeout - (time.time() - start_time)
         if len(received_data) == data_len:
             return received_data
@@ -90,7 +224,15 @@ class Channel(object):
             data_len = len(data)
             len_data = pack("I", data_len)
             full_message = len_data + data
-            self._socket.send(full_message)
+            with self._send_lock:
+                if self._send_limiter is None:
+                    self._socket.sendall(full_message)
+                else:
+                    full_message = memoryview(full_message)
+                    for block_start in range(0, len(full_message), self.LIMITED_BLOCK_SIZE):
+                        block = full_message[block_start: block_start + self.LIMITED_BLOCK_SIZE]
+                        self._send_limiter.consume(len(block), self.bandwidth_weight)
+                        self._socket.sendall(block)
         except Exception as e:
             if self._stop_event.is_set():
                 pass
@@ -124,18 +266,20 @@ class Channel(object):
         :param expected_msg_type: The expected message type.
         :param timeout: The timeout of this method.
         :return: The message received.
-        :raises: TimeoutException in case of a timeout.
+        :raises: TimeoutException in case of a timeout, BusyException if the endpoint is too busy to respond.
         """
         # TODO: handle error message (so that if something failed the endpoint will know)
         start_time = time.time()
         while not self._stop_event.is_set() and time.time() - start_time < timeout:
-            new_msg = self.recv_message(timeout - (time.time() - start_time))
+            new_msg = self._next_message(timeout - (time.time() - start_time))
             if new_msg is None:
                 raise Exception("recv_message returned None")
             if isinstance(new_msg, expected_msg_type):
                 return new_msg
             elif isinstance(new_msg, GeneralErrorMessage):
                 raise Exception(new_msg.error_info)
+            elif isinstance(new_msg, BusyMessage):
+                raise BusyException(new_msg.retry_after)
             else:
                 logger.error(f'Expected msg type {expected_msg_type.type()}, got {new_msg.type()}, ignoring message!')
         raise TimeoutException
@@ -0,0 +1,151 @@
+"""
+This module contains the bitmap used to keep track of the state of a file's chunks.
+A bitmap takes a single bit per chunk (instead of the dozens of bytes an int in a set takes), so even the bitmaps of
+huge files are small enough to be kept in memory, persisted and sent as is. Bit N is the (N % 8) bit of the (N // 8)
+byte, so the serialized bitmap of a file is the same on every platform.
+"""
+import re
+from threading import Lock
+from typing import Iterator, Optional
+
+
+# The amount of set bits in each byte value, used to count the set bits of a whole bitmap at once (via bytes.translate)
+_POPCOUNT_TABLE = bytes(bin(value).count("1") for value in range(256))
+# Bytes which have at least a single clear bit
+_NOT_FULL_BYTE = re.compile(b"[^\xff]")
+
+
+class ChunkBitmap(object):
+    """
+    A fixed size bitmap of chunks, which keeps the amount of its set bits so that it can be retrieved in O(1).
+    All methods of this class are thread safe.
+    """
+    def __init__(self, amount_of_chunks: int, data: bytes = None):
+        """
+        :param data: The initial bitmap (as returned by to_bytes). Bits beyond amount_of_chunks are ignored, and so are
+        missing bytes (their chunks are considered clear).
+        """
+        self._amount_of_chunks = amount_of_chunks
+        self._bits = bytearray(self.size_in_bytes(amount_of_chunks))
+        if data:
+            data = data[:len(self._bits)]
+            self._bits[:len(data)] = data
+            if amount_of_chunks % 8 and len(data) == len(self._bits):
+                self._bits[-1] &= (1 << (amount_of_chunks % 8)) - 1
+        self._count = sum(self._bits.translate(_POPCOUNT_TABLE))
+        self._lock = Lock()
+
+    @staticmethod
+    def size_in_bytes(amount_of_chunks: int) -> int:
+        return (amount_of_chunks + 7) // 8
+
+    def __len__(self) -> int:
+        return self._amount_of_chunks
+
+    def __contains__(self, chunk_num: int) -> bool:
+        return 0 <= chunk_num < self._amount_of_chunks and bool(self._bits[chunk_num // 8] & (1 << (chunk_num % 8)))
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Iterates the set chunks, in ascending order.
+        """
+        bits = bytes(self._bits)
+        for byte_index, byte in enumerate(bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield byte_index * 8 + bit
+
+    @property
+    def count(self) -> int:
+        """
+        The amount of set chunks.
+        """
+        return self._count
+
+    def is_full(self) -> bool:
+        return self._count == self._amount_of_chunks
+
+    def set(self, chunk_num: int) -> bool:
+        """
+        :return: Whether the chunk was clear.
+        """
+        with self._lock:
+            return self._set(chunk_num)
+
+    def clear(self, chunk_num: int) -> bool:
+        """
+        :return: Whether the chunk was set.
+        """
+        with self._lock:
+            return self._clear(chunk_num)
+
+    def claim(self, start: int = 0, end: Optional[int] = None) -> Optional[int]:
+        """
+        Atomically finds a clear chunk and sets it, so that concurrent callers never get the same chunk.
+        :param start: Chunks from this one onwards are preferred, earlier chunks are only claimed if all of them are set.
+        :param end: If given, only the chunks from start up to end (exclusive) may be claimed.
+        :return: The claimed chunk, or None if all of the chunks are set.
+        """
+        with self._lock:
+            chunk_num = self._find_clear(start)
+            if end is not None:
+                if chunk_num is not None and chunk_num >= end:
+                    chunk_num = None
+            elif chunk_num is None and start > 0:
+                chunk_num = self._find_clear(0)
+            if chunk_num is not None:
+                self._set(chunk_num)
+            return chunk_num
+
+    def find_clear(self, start: int = 0) -> Optional[int]:
+        """
+        :return: The first clear chunk from start onwards, or None if there is none.
+        """
+        with self._lock:
+            return self._find_clear(start)
+
+    def to_bytes(self) -> bytes:
+        with self._lock:
+            return bytes(self._bits)
+
+    def _set(self, chunk_num: int) -> bool:
+        self._check_chunk_num(chunk_num)
+        mask = 1 << (chunk_num % 8)
+        if self._bits[chunk_num // 8] & mask:
+            return False
+        self._bits[chunk_num // 8] |= mask
+        self._count += 1
+        return True
+
+    def _clear(self, chunk_num: int) -> bool:
+        self._check_chunk_num(chunk_num)
+        mask = 1 << (chunk_num % 8)
+        if not self._bits[chunk_num // 8] & mask:
+            return False
+        self._bits[chunk_num // 8] &= ~mask & 0xff
+        self._count -= 1
+        return True
+
+    def _find_clear(self, start: int) -> Optional[int]:
+        if start >= self._amount_of_chunks or self._count == self._amount_of_chunks:
+            return None
+        # the bits of the first byte which come before start are ignored
+        first_byte = self._bits[start // 8] | ((1 << (start % 8)) - 1)
+        if first_byte != 0xff:
+            chunk_num = (start // 8) * 8 + _lowest_clear_bit(first_byte)
+        else:
+            match = _NOT_FULL_BYTE.search(self._bits, start // 8 + 1)
+            if match is None:
+                return None
+            chunk_num = match.start() * 8 + _lowest_clear_bit(self._bits[match.start()])
+        return chunk_num if chunk_num < self._amount_of_chunks else None
+
+    def _check_chunk_num(self, chunk_num: int):
+        if not 0 <= chunk_num < self._amount_of_chunks:
+            raise IndexError(f"Chunk {chunk_num} is out of range (the file has {self._amount_of_chunks} chunks)")
+
+
+def _lowest_clear_bit(byte: int) -> int:
+    inverted = ~byte & 0xff
+    return (inverted & -inverted).bit_length() - 1
@@ -53,15 +53,26 @@ class AbstractDBManager(ABC):
             self.create_empty_db()
         else:
             assert isfile(self.db_path), "Fatal error: DB path is a directory!"
+            self.upgrade_db()
         self.lock_path = f"{self.db_path}.lock"
 
     def create_empty_db(self):
         with db_cursor(self.db_path) as cursor:
             self._create_empty_db(cursor)
 
+    def upgrade_db(self):
+        with db_cursor(self.db_path) as cursor:
+            self._upgrade_db(cursor)
+
     @abstractmethod
     def _create_empty_db(self, cursor):
         """
         Initializes the DB with the required tables for the application to function properly.
         """
         pass
+
+    def _upgrade_db(self, cursor):
+        """
+        Adds the tables and columns required by the application to a DB that was created by an older version of it.
+        """
+        pass
@@ -0,0 +1,145 @@
+"""
+This module contains the hashing functions used to identify files and to verify their data.
+A file is identified by the MD5 of its whole data, and each of its chunks is verified by the MD5 of the chunk's data.
+The hashes of all the chunks of a file are kept together as a single bytes object (CHUNK_HASH_SIZE bytes per chunk),
+so that they can be stored and sent as is.
+The chunks of a file are hashed in parallel by a pool of threads (hashlib releases the GIL while hashing large
+buffers), while the MD5 of the whole file - which can only be calculated sequentially - is calculated by the thread
+reading the file. The hashes of the chunks can also be combined into a tree root hash, which doesn't need that
+sequential pass.
+Hashing a large file means reading all of it, so the hashes of local files can be kept in a HashCache and reused for
+as long as the file doesn't change.
+"""
+import hashlib
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from typing import Iterable, Optional
+
+
+CHUNK_HASH_SIZE = 16
+# (absolute path, inode, size, modification time in nanoseconds) - any change to a file's data changes its key
+FileKey = tuple[str, int, int, int]
+HASHING_THREADS = os.cpu_count() or 1
+# the maximal amount of data read ahead of the chunks being hashed
+MAX_PENDING_HASHING_BYTES = 256 * 1024 * 1024
+
+_hashing_pool = None  # type: Optional[ThreadPoolExecutor]
+_hashing_pool_lock = Lock()
+
+
+def _get_hashing_pool() -> ThreadPoolExecutor:
+    """
+    The pool is shared by all hashing operations, so that hashing many files at once doesn't exceed HASHING_THREADS.
+    """
+    global _hashing_pool
+    with _hashing_pool_lock:
+        if _hashing_pool is None:
+            _hashing_pool = ThreadPoolExecutor(HASHING_THREADS, thread_name_prefix="hashing")
+        return _hashing_pool
+
+
+class HashCache(ABC):
+    """
+    A persistent cache of the hashes of local files, keyed by FileKey.
+    """
+    @abstractmethod
+    def get_cached_hashes(self, file_key: FileKey, chunk_size: int) -> Optional[tuple[str, bytes]]:
+        """
+        :return: The (file hash, chunk hashes) cached for the file, or None if the file wasn't hashed in its current
+        state (using the given chunk size).
+        """
+        pass
+
+    @abstractmethod
+    def cache_hashes(self, file_key: FileKey, chunk_size: int, file_hash: str, chunk_hashes: bytes):
+        pass
+
+
+def get_file_key(file_path: str) -> FileKey:
+    file_stats = os.stat(file_path)
+    return os.path.abspath(file_path), file_stats.st_ino, file_stats.st_size, file_stats.st_mtime_ns
+
+
+def calculate_chunk_hash(chunk_data: bytes) -> bytes:
+    return hashlib.md5(chunk_data).digest()
+
+
+def get_chunk_hash(chunk_hashes: bytes, chunk_num: int) -> bytes:
+    """
+    Retrieves the hash of a single chunk out of the hashes of all the chunks of a file.
+    """
+    return chunk_hashes[chunk_num * CHUNK_HASH_SIZE: (chunk_num + 1) * CHUNK_HASH_SIZE]
+
+
+def calculate_root_hash(chunk_hashes: bytes) -> str:
+    """
+    Combines the hashes of a file's chunks into a single hash - each level of the tree hashes pairs of the hashes of
+    the level below it (an odd hash out is moved up as is), up to a single root hash.
+    The root hash of a file which has a single chunk is the MD5 of the file, just like its legacy hash.
+    :return: An hexadecimal representation of the root hash.
+    """
+    level = [get_chunk_hash(chunk_hashes, chunk_num) for chunk_num in range(len(chunk_hashes) // CHUNK_HASH_SIZE)]
+    if not level:
+        return hashlib.md5(b"").hexdigest()
+    while len(level) > 1:
+        level = [hashlib.md5(b"".join(level[i:i + 2])).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+
+def hash_chunks(chunks: Iterable[bytes], with_chunk_hashes: bool = True, with_file_hash: bool = True) -> \
+        tuple[Optional[str], bytes]:
+    """
+    Calculates both the hash of a file and the hashes of its chunks, given the data of all of its chunks in order.
+    The chunks are hashed by the hashing pool, while the hash of the file is calculated by the calling thread.
+    :param with_chunk_hashes: Whether to calculate the hashes of the chunks as well (they're empty otherwise).
+    :param with_file_hash: Whether to calculate the hash of the whole file (it's None otherwise).
+    :return: A 2-tuple of (an hexadecimal representation of the file's hash, the hashes of the file's chunks).
+    """
+    file_md5 = hashlib.md5() if with_file_hash else None
+    chunk_hashes = []
+    pending_hashes = deque()  # type: deque[tuple[Future, int]]
+    pending_bytes = 0
+    for chunk_data in chunks:
+        if with_chunk_hashes:
+            pending_hashes.append((_get_hashing_pool().submit(calculate_chunk_hash, chunk_data), len(chunk_data)))
+            pending_bytes += len(chunk_data)
+        if file_md5 is not None:
+            file_md5.update(chunk_data)
+        # the hashes are collected in order, waiting for the oldest chunks when too much data is held
+        while pending_hashes and (pending_hashes[0][0].done() or pending_bytes > MAX_PENDING_HASHING_BYTES):
+            future, chunk_length = pending_hashes.popleft()
+            chunk_hashes.append(future.result())
+            pending_bytes -= chunk_length
+    chunk_hashes += [future.result() for future, _ in pending_hashes]
+    return file_md5.hexdigest() if file_md5 is not None else None, b"".join(chunk_hashes)
+
+
+def calculate_file_hashes(file_path: str, chunk_size: int, hash_cache: HashCache = None,
+                          legacy_hash: bool = True) -> tuple[str, bytes]:
+    """
+    Calculates both the hash of a local file and the hashes of its chunks, reading the file only once.
+    :param hash_cache: If given, the hashes are taken from it when the file hasn't changed since it was last hashed
+    (without reading the file at all), and are kept in it otherwise.
+    :param legacy_hash: Whether the file is identified by the MD5 of its whole data (as all files have been so far), or
+    by the root hash of its chunks (which is calculated in parallel only).
+    :return: A 2-tuple of (an hexadecimal representation of the file's hash, the hashes of the file's chunks).
+    """
+    if hash_cache is not None:
+        # the key is taken before the file is read, so that changes made while it's read make the cached hashes stale
+        file_key = get_file_key(file_path)
+        cached_hashes = hash_cache.get_cached_hashes(file_key, chunk_size)
+        if cached_hashes is not None:
+            file_hash, chunk_hashes = cached_hashes
+            return file_hash if legacy_hash else calculate_root_hash(chunk_hashes), chunk_hashes
+    with open(file_path, 'rb') as f:
+        file_hash, chunk_hashes = hash_chunks(iter(partial(f.read, chunk_size), b""), with_file_hash=legacy_hash)
+    if not legacy_hash:
+        return calculate_root_hash(chunk_hashes), chunk_hashes
+    if hash_cache is not None:
+        hash_cache.cache_hashes(file_key, chunk_size, file_hash, chunk_hashes)
+    return file_hash, chunk_hashes
@@ -5,7 +5,8 @@ import time
 import struct
 from struct import pack, unpack
 from socket import inet_aton, inet_ntoa
-from p2p_fileshare.framework.types import SharedFile, SharingClientInfo
+from typing import Optional
+from p2p_fileshare.framework.types import SharedFile, SharingClientInfo, LEGACY_CHUNK_SIZE
 
 UNIQUE_ID_LENGTH = 32
 
@@ -24,6 +25,36 @@ REMOVE_SHARE_MESSAGE_TYPE = 10
 SHARE_PORT_MESSAGE_TYPE = 11
 RTT_CHECK_MESSAGE_TYPE = 12
 RTT_RESPONSE_MESSAGE_TYPE = 13
+SHARE_FILES_BATCH_MESSAGE_TYPE = 14
+REMOVE_SHARES_BATCH_MESSAGE_TYPE = 15
+BATCH_STATUS_MESSAGE_TYPE = 16
+SHARING_INFO_BATCH_REQUEST_MESSAGE_TYPE = 17
+SHARING_INFO_BATCH_RESPONSE_MESSAGE_TYPE = 18
+LOAD_REPORT_MESSAGE_TYPE = 19
+SUBSCRIBE_ORIGINS_MESSAGE_TYPE = 20
+UNSUBSCRIBE_ORIGINS_MESSAGE_TYPE = 21
+ORIGINS_UPDATE_MESSAGE_TYPE = 22
+PEER_EXCHANGE_MESSAGE_TYPE = 23
+CHUNK_HASHES_MESSAGE_TYPE = 24
+CHUNK_HASHES_REQUEST_MESSAGE_TYPE = 25
+RANGE_REQUEST_MESSAGE_TYPE = 26
+RANGE_DATA_RESPONSE_MESSAGE_TYPE = 27
+BUSY_MESSAGE_TYPE = 28
+SHARING_CLIENT_INFO_LENGTH = UNIQUE_ID_LENGTH + 6
+
+SEARCH_SORT_NONE = 0
+SEARCH_SORT_NAME = 1
+SEARCH_SORT_SIZE = 2
+SEARCH_SORT_MODIFICATION_TIME = 3
+SEARCH_NO_LIMIT = 0
+
+# Version 2 of the protocol supports files larger than 4 GiB. Sizes and chunk numbers are serialized as 64-bit values,
+# yet a value which fits in the original 32-bit field is serialized exactly as version 1 serializes it (only larger
+# values are serialized as LARGE_VALUE_MARKER followed by the whole 64-bit value), so both versions understand each
+# other as long as no large file is involved.
+LEGACY_PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 2
+LARGE_VALUE_MARKER = 0xffffffff
 
 
 def get_message_type_object(message_type):
@@ -40,10 +71,89 @@ def get_message_type_object(message_type):
                      REMOVE_SHARE_MESSAGE_TYPE: RemoveShareMessage,
                      SHARE_PORT_MESSAGE_TYPE: SharePortMessage,
                      RTT_CHECK_MESSAGE_TYPE: RTTCheckMessage,
-                     RTT_RESPONSE_MESSAGE_TYPE: RTTResponseMessage}
+                     RTT_RESPONSE_MESSAGE_TYPE: RTTResponseMessage,
+                     SHARE_FILES_BATCH_MESSAGE_TYPE: ShareFilesBatchMessage,
+                     REMOVE_SHARES_BATCH_MESSAGE_TYPE: RemoveSharesBatchMessage,
+                     BATCH_STATUS_MESSAGE_TYPE: BatchStatusMessage,
+                     SHARING_INFO_BATCH_REQUEST_MESSAGE_TYPE: SharingInfoBatchRequestMessage,
+                     SHARING_INFO_BATCH_RESPONSE_MESSAGE_TYPE: SharingInfoBatchResponseMessage,
+                     LOAD_REPORT_MESSAGE_TYPE: LoadReportMessage,
+                     SUBSCRIBE_ORIGINS_MESSAGE_TYPE: SubscribeOriginsMessage,
+                     UNSUBSCRIBE_ORIGINS_MESSAGE_TYPE: UnsubscribeOriginsMessage,
+                     ORIGINS_UPDATE_MESSAGE_TYPE: OriginsUpdateMessage,
+                     PEER_EXCHANGE_MESSAGE_TYPE: PeerExchangeMessage,
+                     CHUNK_HASHES_MESSAGE_TYPE: ChunkHashesMessage,
+                     CHUNK_HASHES_REQUEST_MESSAGE_TYPE: ChunkHashesRequestMessage,
+                     RANGE_REQUEST_MESSAGE_TYPE: RangeRequestMessage,
+                     RANGE_DATA_RESPONSE_MESSAGE_TYPE: RangeDataResponseMessage,
+                     BUSY_MESSAGE_TYPE: BusyMessage}
     return message_types.get(message_type, None)
 
 
+def serialize_sharing_client(sharing_client: SharingClientInfo) -> bytes:
+    """
+    Serializes a SharingClientInfo into SHARING_CLIENT_INFO_LENGTH bytes (a non-existing port is serialized to 0).
+    """
+    port = sharing_client.port if sharing_client.port is not None else 0
+    return sharing_client.unique_id.encode("utf-8") + inet_aton(sharing_client.ip) + pack("H", port)
+
+
+def deserialize_sharing_client(data: bytes, offset: int) -> SharingClientInfo:
+    client_id = data[offset: offset + UNIQUE_ID_LENGTH].decode("utf-8")
+    ip = inet_ntoa(data[offset + UNIQUE_ID_LENGTH: offset + UNIQUE_ID_LENGTH + 4])
+    port = unpack("H", data[offset + UNIQUE_ID_LENGTH + 4: offset + SHARING_CLIENT_INFO_LENGTH])[0]
+    if port == 0:
+        port = None
+    return SharingClientInfo(client_id, (ip, port))
+
+
+def pack_large_value(value: int) -> bytes:
+    """
+    Serializes a 64-bit size or chunk number (see PROTOCOL_VERSION).
+    """
+    if value < LARGE_VALUE_MARKER:
+        return pack("I", value)
+    return pack("I", LARGE_VALUE_MARKER) + pack("Q", value)
+
+
+def unpack_large_value(data: bytes, offset: int) -> tuple[int, int]:
+    """
+    Deserializes a value serialized by pack_large_value, starting at offset.
+    :return: A 2-tuple of (the value, the offset right after the serialized value).
+    """
+    value = struct.unpack_from("I", data, offset)[0]
+    if value != LARGE_VALUE_MARKER:
+        return value, offset + 4
+    return struct.unpack_from("Q", data, offset + 4)[0], offset + 12
+
+
+def is_legacy_file(shared_file: SharedFile) -> bool:
+    """
+    Whether clients which only know LEGACY_PROTOCOL_VERSION can handle the file.
+    """
+    return shared_file.size < LARGE_VALUE_MARKER and shared_file.chunk_size == LEGACY_CHUNK_SIZE
+
+
+def serialize_chunk_sizes(files: list[SharedFile]) -> bytes:
+    """
+    Serializes the chunk sizes of files. They're appended to the end of the messages containing the files, so that
+    legacy clients (which don't know about chunk sizes) simply ignore them.
+    """
+    return pack(f"{len(files)}I", *[shared_file.chunk_size for shared_file in files])
+
+
+def deserialize_chunk_sizes(data: bytes, offset: int, files: list[SharedFile]):
+    """
+    Sets the chunk sizes of files deserialized from a message, which are serialized starting at offset (the files of a
+    message sent by a legacy client have the legacy chunk size).
+    """
+    chunk_sizes = [LEGACY_CHUNK_SIZE] * len(files)
+    if len(data) >= offset + 4 * len(files):
+        chunk_sizes = struct.unpack_from(f"{len(files)}I", data, offset)
+    for shared_file, chunk_size in zip(files, chunk_sizes):
+        shared_file.chunk_size = chunk_size
+
+
 class Message(object):
     """
     The base message class.
@@ -106,23 +216,33 @@ class FileMessage(Message):
     A message used to de/serialize a SharedFile object.
     This is useful in order to pass information about shared files from different endpoints in the application.
     NOTE: This message ignores the origins of the SharedFile object and instead always passes an empty list (both in
-    the serialization and the deserialization process).
+    the serialization and the deserialization process). The chunk size of the file isn't serialized either - it's
+    serialized by the message containing the file (see serialize_chunk_sizes).
     """
     def __init__(self, file: SharedFile):
         self.file = file
 
     @classmethod
-    def deserialize(cls, data):
-        name_len = struct.unpack("I", data[:4])[0]
-        name = data[4:4 + name_len].decode("utf-8")
-        modification_time, size = struct.unpack("II", data[4 + name_len:12 + name_len])
-        unique_id = data[12 + name_len: 44 + name_len].decode('utf-8')  # unique id is 32 bytes long
-        next_msg_offset = 44 + name_len
-        return FileMessage(SharedFile(unique_id, name, modification_time, size, [])), next_msg_offset
+    def deserialize(cls, data, offset: int = 0):
+        """
+        Deserializes a single file starting at offset, without copying the rest of the buffer.
+        :return: A 2-tuple of (the FileMessage, the offset right after the serialized file).
+        """
+        name_len = struct.unpack_from("I", data, offset)[0]
+        offset += 4
+        name = bytes(data[offset:offset + name_len]).decode("utf-8")
+        offset += name_len
+        modification_time = struct.unpack_from("I", data, offset)[0]
+        size, offset = unpack_large_value(data, offset + 4)
+        unique_id = bytes(data[offset:offset + UNIQUE_ID_LENGTH]).decode('utf-8')
+        next_msg_offset = offset + UNIQUE_ID_LENGTH
+        return FileMessage(SharedFile(unique_id, name, modification_time, size, [], LEGACY_CHUNK_SIZE)), next_msg_offset
 
     def serialize(self):
-        data = struct.pack("I", len(self.file.name)) + self.file.name.encode("utf-8") + \
-               struct.pack("II", self.file.modification_time, self.file.size) + bytes(self.file.unique_id, 'utf-8')
+        name_data = self.file.name.encode("utf-8")
+        data = struct.pack("I", len(name_data)) + name_data + \
+               struct.pack("I", self.file.modification_time) + pack_large_value(self.file.size) + \
+               bytes(self.file.unique_id, 'utf-8')
         return data
 
     @classmethod
@@ -133,28 +253,28 @@ class FileMessage(Message):
 class FileListMessage(Message):
     """
     A messages containing multiple SharedFiles.
+    When the files are a single page of a larger result set, next_offset holds the offset that should be requested in
+    order to receive the following page (None if this is the last page).
     """
-    def __init__(self, files: list[SharedFile]):
+    def __init__(self, files: list[SharedFile], next_offset: Optional[int] = None):
         self.files = files
+        self.next_offset = next_offset
 
     @classmethod
     def deserialize(cls, data):
-        amount_of_files = struct.unpack("I", data[4:8])[0]
+        amount_of_files, next_offset = struct.unpack_from("II", data, 4)
         files = []
-        data_index = 8
+        data_index = 12
         for i in range(amount_of_files):
-            file_msg, file_len = FileMessage.deserialize(data[data_index:])
+            file_msg, data_index = FileMessage.deserialize(data, data_index)
             files.append(file_msg.file)
-            data_index += file_len
-        return FileListMessage(files)
+        deserialize_chunk_sizes(data, data_index, files)
+        return FileListMessage(files, next_offset or None)
 
     def serialize(self):
-        msg_type_data = struct.pack("I", self.type())
-        amount_of_files = struct.pack("I", len(self.files))
-        files_data = bytes()
-        for file in self.files:
-            files_data += FileMessage(file).serialize()
-        return msg_type_data + amount_of_files + files_data
+        header = struct.pack("III", self.type(), len(self.files), self.next_offset or 0)
+        return b"".join([header] + [FileMessage(file).serialize() for file in self.files] +
+                        [serialize_chunk_sizes(self.files)])
 
     @classmethod
     def type(cls):
@@ -165,16 +285,22 @@ class SearchFileMessage(Message):
     """
     This message can be used as a request to retrieve information about a file using a string representing a part of the
     filename.
+    The results are paginated - the responder returns at most limit files (SEARCH_NO_LIMIT lets the responder choose its
+    own page size), starting at offset, ordered according to sort_by (one of the SEARCH_SORT_* constants).
     """
-    def __init__(self, name: str):
+    def __init__(self, name: str, limit: int = SEARCH_NO_LIMIT, offset: int = 0, sort_by: int = SEARCH_SORT_NONE):
         self.name = name
+        self.limit = limit
+        self.offset = offset
+        self.sort_by = sort_by
 
     @classmethod
     def deserialize(cls, data):
-        return SearchFileMessage(data[4:].decode('utf-8'))
+        limit, offset, sort_by = unpack("III", data[4:16])
+        return SearchFileMessage(data[16:].decode('utf-8'), limit, offset, sort_by)
 
     def serialize(self):
-        return struct.pack("I", self.type()) + bytes(self.name, "utf-8")
+        return struct.pack("IIII", self.type(), self.limit, self.offset, self.sort_by) + bytes(self.name, "utf-8")
 
     @classmethod
     def type(cls):
@@ -194,37 +320,48 @@ class ShareFileMessage(Message):
 
     @classmethod
     def deserialize(cls, data):
-        file_message, file_msg_len = FileMessage.deserialize(data[4:])
+        file_message, offset = FileMessage.deserialize(data, 4)
         shared_file = file_message.file
+        deserialize_chunk_sizes(data, offset, [shared_file])
         return ShareFileMessage(shared_file)
 
     def serialize(self):
         file_message = FileMessage(self.file)
-        return pack("I", self.type()) + file_message.serialize()
+        return pack("I", self.type()) + file_message.serialize() + serialize_chunk_sizes([self.file])
 
     @classmethod
     def type(cls):
         return SHARE_FILE_MESSAGE_TYPE
 
+    @property
+    def matching_response_type(self):
+        return GeneralSuccessMessage
+
 
 class ClientIdMessage(Message):
     """
     This message is used by the server to identify the client of its unique ID, to be used in all connections from now
     on.
+    The message also carries the protocol version of its sender (clients which don't send it use
+    LEGACY_PROTOCOL_VERSION).
     """
     NO_ID_MAGIC = 'ff' * 16
 
-    def __init__(self, unique_id: str):
+    def __init__(self, unique_id: str, protocol_version: int = PROTOCOL_VERSION):
         self.unique_id = unique_id or self.NO_ID_MAGIC
+        self.protocol_version = protocol_version
 
     @classmethod
     def deserialize(cls, data: bytes):
         unique_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
-        return ClientIdMessage(unique_id)
+        protocol_version = LEGACY_PROTOCOL_VERSION
+        if len(data) >= 8 + UNIQUE_ID_LENGTH:
+            protocol_version = unpack("I", data[4 + UNIQUE_ID_LENGTH: 8 + UNIQUE_ID_LENGTH])[0]
+        return ClientIdMessage(unique_id, protocol_version)
 
     def serialize(self):
         unique_id_data = self.unique_id.encode("utf-8")
-        return pack("I", self.type()) + unique_id_data
+        return pack("I", self.type()) + unique_id_data + pack("I", self.protocol_version)
 
     @classmethod
     def type(cls):
@@ -235,18 +372,30 @@ class SharingInfoRequestMessage(Message):
     """
     This message is used by the client to retrieve information about clients that share a specific file.
     It is used by clients to initialize file download.
+    The responder returns at most max_origins origins (0 lets the responder choose its own bound), none of which is in
+    excluded_origins - a client that wants more origins than it has received should request again, excluding the ones
+    it already knows.
     """
-    def __init__(self, file_unique_id: str):
+    def __init__(self, file_unique_id: str, max_origins: int = 0, excluded_origins: list[str] = None):
         self.file_unique_id = file_unique_id
+        self.max_origins = max_origins
+        self.excluded_origins = excluded_origins or []
 
     @classmethod
     def deserialize(cls, data: bytes):
         unique_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
-        return SharingInfoRequestMessage(unique_id)
+        if len(data) == 4 + UNIQUE_ID_LENGTH:
+            return SharingInfoRequestMessage(unique_id)  # sent by a client that doesn't know about origin sampling
+        max_origins, amount_of_excluded_origins = unpack("II", data[4 + UNIQUE_ID_LENGTH: 12 + UNIQUE_ID_LENGTH])
+        index = 12 + UNIQUE_ID_LENGTH
+        excluded_origins = [data[index + i * UNIQUE_ID_LENGTH: index + (i + 1) * UNIQUE_ID_LENGTH].decode("utf-8")
+                            for i in range(amount_of_excluded_origins)]
+        return SharingInfoRequestMessage(unique_id, max_origins, excluded_origins)
 
     def serialize(self):
         unique_id_data = self.file_unique_id.encode("utf-8")
-        return pack("I", self.type()) + unique_id_data
+        return pack("I", self.type()) + unique_id_data + pack("II", self.max_origins, len(self.excluded_origins)) + \
+            "".join(self.excluded_origins).encode("utf-8")
 
     @classmethod
     def type(cls):
@@ -269,12 +418,12 @@ class StartFileTransferMessage(Message):
     @classmethod
     def deserialize(cls, data: bytes):
         file_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
-        chunk_num = unpack("I", data[4 + UNIQUE_ID_LENGTH: 8 + UNIQUE_ID_LENGTH])[0]
+        chunk_num, _ = unpack_large_value(data, 4 + UNIQUE_ID_LENGTH)
         return StartFileTransferMessage(file_id=file_id, chunk_num=chunk_num)
 
     def serialize(self):
         file_id_data = self._file_id.encode("utf-8")
-        chunk_num = pack("I", self._chunk_num)
+        chunk_num = pack_large_value(self._chunk_num)
         return pack("I", self.type()) + file_id_data + chunk_num
 
     @classmethod
@@ -288,12 +437,17 @@ class StartFileTransferMessage(Message):
 
 class SharingInfoResponseMessage(Message):
     """
-    A response to SharingInfoRequestMessage, containing information about all the clients that share a specific file.
+    A response to SharingInfoRequestMessage, containing information about the clients that share a specific file.
+    The origins might be a sample of all the file's origins, in which case total_origins holds the amount of all the
+    origins known to the responder.
     NOTE: This message serializes a non-existing port to 0 and deserialize the sharing port 0 as a non-existent sharing
     port.
     """
-    def __init__(self, shared_file: SharedFile):
+    def __init__(self, shared_file: SharedFile, total_origins: Optional[int] = None):
         self.shared_file = shared_file
+        if total_origins is None:
+            total_origins = len(shared_file.origins)
+        self.total_origins = total_origins
 
     @classmethod
     def deserialize(cls, data: bytes):
@@ -301,35 +455,33 @@ class SharingInfoResponseMessage(Message):
         name_len = unpack("I", data[4 + UNIQUE_ID_LENGTH: 8 + UNIQUE_ID_LENGTH])[0]
         name = data[8 + UNIQUE_ID_LENGTH: 8 + UNIQUE_ID_LENGTH + name_len].decode("utf-8")
         modification_time = unpack("I", data[8 + UNIQUE_ID_LENGTH + name_len: 12 + UNIQUE_ID_LENGTH + name_len])[0]
-        size = unpack("I", data[12 + UNIQUE_ID_LENGTH + name_len: 16 + UNIQUE_ID_LENGTH + name_len])[0]
-        amount_of_sharing_clients = unpack("I", data[16 + UNIQUE_ID_LENGTH + name_len: 20 + UNIQUE_ID_LENGTH + name_len])[0]
+        size, index = unpack_large_value(data, 12 + UNIQUE_ID_LENGTH + name_len)
+        amount_of_sharing_clients = unpack("I", data[index: index + 4])[0]
 
         sharing_clients = []
-        index = 20 + UNIQUE_ID_LENGTH + name_len
+        index += 4
         for _ in range(amount_of_sharing_clients):
-            client_id = data[index: index + UNIQUE_ID_LENGTH].decode("utf-8")
-            ip = inet_ntoa(data[index + UNIQUE_ID_LENGTH: index + UNIQUE_ID_LENGTH + 4])
-            port = unpack("H", data[index + UNIQUE_ID_LENGTH + 4: index + UNIQUE_ID_LENGTH + 6])[0]
-            if port == 0:
-                port = None
-            sharing_clients.append(SharingClientInfo(client_id, (ip, port)))
-            index += UNIQUE_ID_LENGTH + 6
-        return SharingInfoResponseMessage(SharedFile(unique_id, name, modification_time, size, sharing_clients))
+            sharing_clients.append(deserialize_sharing_client(data, index))
+            index += SHARING_CLIENT_INFO_LENGTH
+        total_origins = None
+        if len(data) >= index + 4:
+            total_origins = unpack("I", data[index: index + 4])[0]
+        shared_file = SharedFile(unique_id, name, modification_time, size, sharing_clients)
+        deserialize_chunk_sizes(data, index + 4, [shared_file])
+        return SharingInfoResponseMessage(shared_file, total_origins)
 
     def serialize(self):
         unique_id_data = self.shared_file.unique_id.encode("utf-8")
-        name_len = struct.pack("I", len(self.shared_file.name))
+        name_data = self.shared_file.name.encode("utf-8")
+        name_len = struct.pack("I", len(name_data))
         modification_time = struct.pack("I", self.shared_file.modification_time)
-        size = struct.pack("I", self.shared_file.size)
+        size = pack_large_value(self.shared_file.size)
         amount_of_sharing_clients_data = pack("I", len(self.shared_file.origins))
-        sharing_clients_data = bytes()
-        for sharing_client in self.shared_file.origins:
-            sharing_clients_data += sharing_client.unique_id.encode("utf-8")
-            sharing_clients_data += inet_aton(sharing_client.ip)
-            port = sharing_client.port if sharing_client.port is not None else 0
-            sharing_clients_data += pack("H", port)
-        data = pack("I", self.type()) + unique_id_data + name_len + self.shared_file.name.encode("utf-8") +\
-               modification_time + size + amount_of_sharing_clients_data + sharing_clients_data
+        sharing_clients_data = b"".join(serialize_sharing_client(sharing_client)
+                                        for sharing_client in self.shared_file.origins)
+        data = pack("I", self.type()) + unique_id_data + name_len + name_data +\
+               modification_time + size + amount_of_sharing_clients_data + sharing_clients_data + \
+               pack("I", self.total_origins) + serialize_chunk_sizes([self.shared_file])
         return data
 
     @classmethod
@@ -349,13 +501,13 @@ class ChunkDataResponseMessage(Message):
     @classmethod
     def deserialize(cls, data: bytes):
         file_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
-        chunk_num = unpack("I", data[4 + UNIQUE_ID_LENGTH: 8 + UNIQUE_ID_LENGTH])[0]
-        chunk_data = data[8 + UNIQUE_ID_LENGTH:]
+        chunk_num, data_offset = unpack_large_value(data, 4 + UNIQUE_ID_LENGTH)
+        chunk_data = data[data_offset:]
         return ChunkDataResponseMessage(file_id=file_id, chunk_num=chunk_num, data=chunk_data)
 
     def serialize(self):
         file_id_data = self._file_id.encode("utf-8")
-        chunk_num = pack("I", self._chunk_num)
+        chunk_num = pack_large_value(self._chunk_num)
         return pack("I", self.type()) + file_id_data + chunk_num + self.data
 
     @classmethod
@@ -383,6 +535,10 @@ class RemoveShareMessage(Message):
     def type(cls):
         return REMOVE_SHARE_MESSAGE_TYPE
 
+    @property
+    def matching_response_type(self):
+        return GeneralSuccessMessage
+
 
 class SharePortMessage(Message):
     """
@@ -451,4 +607,436 @@ class RTTResponseMessage(Message):
 
     @classmethod
     def type(cls):
-        return RTT_RESPONSE_MESSAGE_TYPE
\ No newline at end of file
+        return RTT_RESPONSE_MESSAGE_TYPE
+
+
+class BatchStatusMessage(Message):
+    """
+    A response to a batch request, containing whether the action requested succeeded for each of the batch's items (in
+    the same order as the items in the request).
+    The statuses are serialized as a bit vector - one bit per item.
+    """
+    def __init__(self, statuses: list[bool]):
+        self.statuses = statuses
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        amount_of_statuses = unpack("I", data[4:8])[0]
+        status_bits = data[8:]
+        return BatchStatusMessage([bool(status_bits[index // 8] & (1 << (index % 8)))
+                                   for index in range(amount_of_statuses)])
+
+    def serialize(self):
+        status_bits = bytearray((len(self.statuses) + 7) // 8)
+        for index, status in enumerate(self.statuses):
+            if status:
+                status_bits[index // 8] |= 1 << (index % 8)
+        return pack("II", self.type(), len(self.statuses)) + bytes(status_bits)
+
+    @classmethod
+    def type(cls):
+        return BATCH_STATUS_MESSAGE_TYPE
+
+
+class ShareFilesBatchMessage(Message):
+    """
+    A message used by the client to notify the metadata server it is now sharing multiple files, all of which are
+    applied by the server at once.
+    """
+    def __init__(self, files: list[SharedFile]):
+        self.files = files
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        amount_of_files = unpack("I", data[4:8])[0]
+        files = []
+        data_index = 8
+        for _ in range(amount_of_files):
+            file_msg, data_index = FileMessage.deserialize(data, data_index)
+            files.append(file_msg.file)
+        deserialize_chunk_sizes(data, data_index, files)
+        return ShareFilesBatchMessage(files)
+
+    def serialize(self):
+        header = pack("II", self.type(), len(self.files))
+        return b"".join([header] + [FileMessage(file).serialize() for file in self.files] +
+                        [serialize_chunk_sizes(self.files)])
+
+    @classmethod
+    def type(cls):
+        return SHARE_FILES_BATCH_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return BatchStatusMessage
+
+
+class RemoveSharesBatchMessage(Message):
+    """
+    This message is used by the client to let the server know it is no longer sharing multiple of its files.
+    """
+    def __init__(self, unique_ids: list[str]):
+        self.unique_ids = unique_ids
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        amount_of_ids = unpack("I", data[4:8])[0]
+        return RemoveSharesBatchMessage([data[8 + index * UNIQUE_ID_LENGTH: 8 + (index + 1) * UNIQUE_ID_LENGTH].decode(
+            "utf-8") for index in range(amount_of_ids)])
+
+    def serialize(self):
+        return pack("II", self.type(), len(self.unique_ids)) + "".join(self.unique_ids).encode("utf-8")
+
+    @classmethod
+    def type(cls):
+        return REMOVE_SHARES_BATCH_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return BatchStatusMessage
+
+
+class SharingInfoBatchRequestMessage(Message):
+    """
+    Same as SharingInfoRequestMessage, but used to retrieve the sharing information of multiple files at once.
+    """
+    def __init__(self, file_unique_ids: list[str]):
+        self.file_unique_ids = file_unique_ids
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        amount_of_ids = unpack("I", data[4:8])[0]
+        return SharingInfoBatchRequestMessage([data[8 + index * UNIQUE_ID_LENGTH: 8 + (index + 1) * UNIQUE_ID_LENGTH]
+                                              .decode("utf-8") for index in range(amount_of_ids)])
+
+    def serialize(self):
+        return pack("II", self.type(), len(self.file_unique_ids)) + "".join(self.file_unique_ids).encode("utf-8")
+
+    @classmethod
+    def type(cls):
+        return SHARING_INFO_BATCH_REQUEST_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return SharingInfoBatchResponseMessage
+
+
+class SharingInfoBatchResponseMessage(Message):
+    """
+    A response to SharingInfoBatchRequestMessage, containing the sharing information of every requested file that was
+    found (files that weren't found are omitted).
+    Clients often share many files, so each sharing client is serialized only once, in a table that precedes the files,
+    and each file references its origins by their indices in that table.
+    """
+    def __init__(self, shared_files: list[SharedFile]):
+        self.shared_files = shared_files
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        amount_of_origins = unpack("I", data[4:8])[0]
+        origins = [deserialize_sharing_client(data, 8 + index * SHARING_CLIENT_INFO_LENGTH)
+                   for index in range(amount_of_origins)]
+        index = 8 + amount_of_origins * SHARING_CLIENT_INFO_LENGTH
+        amount_of_files = unpack("I", data[index:index + 4])[0]
+        index += 4
+        shared_files = []
+        for _ in range(amount_of_files):
+            file_message, index = FileMessage.deserialize(data, index)
+            amount_of_file_origins = unpack("I", data[index:index + 4])[0]
+            origin_indices = struct.unpack_from(f"{amount_of_file_origins}I", data, index + 4)
+            index += 4 + 4 * amount_of_file_origins
+            file_message.file.origins = [origins[origin_index] for origin_index in origin_indices]
+            shared_files.append(file_message.file)
+        deserialize_chunk_sizes(data, index, shared_files)
+        return SharingInfoBatchResponseMessage(shared_files)
+
+    def serialize(self):
+        origin_indices = {}  # type: dict[SharingClientInfo, int]
+        files_data = []
+        for shared_file in self.shared_files:
+            file_origin_indices = [origin_indices.setdefault(origin, len(origin_indices))
+                                   for origin in shared_file.origins]
+            files_data.append(FileMessage(shared_file).serialize())
+            files_data.append(pack(f"I{len(file_origin_indices)}I", len(file_origin_indices), *file_origin_indices))
+        origins_data = [serialize_sharing_client(origin) for origin in origin_indices]
+        return b"".join([pack("II", self.type(), len(origin_indices))] + origins_data +
+                        [pack("I", len(self.shared_files))] + files_data + [serialize_chunk_sizes(self.shared_files)])
+
+    @classmethod
+    def type(cls):
+        return SHARING_INFO_BATCH_RESPONSE_MESSAGE_TYPE
+
+
+class LoadReportMessage(Message):
+    """
+    This message is periodically sent by a sharing client to the server, letting it know how loaded its sharing server
+    currently is (so that the server can direct downloaders towards less loaded origins).
+    """
+    def __init__(self, active_uploads: int, upload_rate: int, available_slots: int):
+        """
+        :param active_uploads: The amount of chunk transfers currently performed by the client.
+        :param upload_rate: The recent upload throughput of the client, in bytes per second.
+        :param available_slots: The amount of additional transfers the client is willing to serve right now.
+        """
+        self.active_uploads = active_uploads
+        self.upload_rate = upload_rate
+        self.available_slots = available_slots
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        active_uploads, available_slots, upload_rate = unpack("IIQ", data[4: 20])
+        return LoadReportMessage(active_uploads, upload_rate, available_slots)
+
+    def serialize(self):
+        return pack("I", self.type()) + pack("IIQ", self.active_uploads, self.available_slots, self.upload_rate)
+
+    @classmethod
+    def type(cls):
+        return LOAD_REPORT_MESSAGE_TYPE
+
+
+class SubscribeOriginsMessage(Message):
+    """
+    This message is used by a downloading client to subscribe to changes in the origins of a file.
+    From then on the server pushes an OriginsUpdateMessage whenever a client starts or stops sharing the file (until
+    the client unsubscribes or disconnects).
+    """
+    def __init__(self, file_unique_id: str):
+        self.file_unique_id = file_unique_id
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        return SubscribeOriginsMessage(data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8"))
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_unique_id.encode("utf-8")
+
+    @classmethod
+    def type(cls):
+        return SUBSCRIBE_ORIGINS_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return GeneralSuccessMessage
+
+
+class UnsubscribeOriginsMessage(Message):
+    """
+    This message is used to cancel a subscription made via SubscribeOriginsMessage. The server doesn't respond to it.
+    """
+    def __init__(self, file_unique_id: str):
+        self.file_unique_id = file_unique_id
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        return UnsubscribeOriginsMessage(data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8"))
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_unique_id.encode("utf-8")
+
+    @classmethod
+    def type(cls):
+        return UNSUBSCRIBE_ORIGINS_MESSAGE_TYPE
+
+
+class OriginsUpdateMessage(Message):
+    """
+    This message is pushed by the server to the clients subscribed to a file, whenever origins of the file are added (a
+    connected client has started sharing it, or a client sharing it has connected) or removed.
+    """
+    def __init__(self, file_unique_id: str, added_origins: list[SharingClientInfo], removed_origins: list[str]):
+        """
+        :param added_origins: The new origins of the file.
+        :param removed_origins: The unique IDs of the origins that no longer share the file.
+        """
+        self.file_unique_id = file_unique_id
+        self.added_origins = added_origins
+        self.removed_origins = removed_origins
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        file_unique_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
+        offset = 4 + UNIQUE_ID_LENGTH
+        amount_of_added_origins, amount_of_removed_origins = unpack("II", data[offset: offset + 8])
+        offset += 8
+        added_origins = []
+        for _ in range(amount_of_added_origins):
+            added_origins.append(deserialize_sharing_client(data, offset))
+            offset += SHARING_CLIENT_INFO_LENGTH
+        removed_origins = [data[offset + index * UNIQUE_ID_LENGTH: offset + (index + 1) * UNIQUE_ID_LENGTH].decode(
+            "utf-8") for index in range(amount_of_removed_origins)]
+        return OriginsUpdateMessage(file_unique_id, added_origins, removed_origins)
+
+    def serialize(self):
+        return b"".join([pack("I", self.type()), self.file_unique_id.encode("utf-8"),
+                         pack("II", len(self.added_origins), len(self.removed_origins))] +
+                        [serialize_sharing_client(origin) for origin in self.added_origins] +
+                        [origin_id.encode("utf-8") for origin_id in self.removed_origins])
+
+    @classmethod
+    def type(cls):
+        return ORIGINS_UPDATE_MESSAGE_TYPE
+
+
+class PeerExchangeMessage(Message):
+    """
+    This message is exchanged directly between a downloading client and a sharing client (without the server).
+    The downloader sends the origins of a file it knows about, and the sharing client responds with the origins of the
+    file it has learned about from other downloaders (excluding the ones it was sent), so that swarms keep growing and
+    healing even when the metadata server is slow or unavailable.
+    At most MAX_PEERS peers are carried by the message, the rest are silently dropped (so senders should list their most
+    useful peers first).
+    """
+    MAX_PEERS = 50
+
+    def __init__(self, file_unique_id: str, peers: list[SharingClientInfo]):
+        self.file_unique_id = file_unique_id
+        self.peers = peers[:self.MAX_PEERS]
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        file_unique_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
+        offset = 4 + UNIQUE_ID_LENGTH
+        amount_of_peers = min(unpack("I", data[offset: offset + 4])[0], cls.MAX_PEERS)
+        offset += 4
+        return PeerExchangeMessage(file_unique_id, [deserialize_sharing_client(data, offset + index *
+                                                                               SHARING_CLIENT_INFO_LENGTH)
+                                                    for index in range(amount_of_peers)])
+
+    def serialize(self):
+        return b"".join([pack("I", self.type()), self.file_unique_id.encode("utf-8"), pack("I", len(self.peers))] +
+                        [serialize_sharing_client(peer) for peer in self.peers])
+
+    @classmethod
+    def type(cls):
+        return PEER_EXCHANGE_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return PeerExchangeMessage
+
+
+class ChunkHashesMessage(Message):
+    """
+    This message holds the hashes of all the chunks of a file (see the hashing module).
+    It's sent by a sharing client to the server once it starts sharing the file, and is used as the response to
+    ChunkHashesRequestMessage (in which case empty hashes mean the hashes of the file's chunks are unknown).
+    """
+    def __init__(self, file_unique_id: str, chunk_hashes: bytes):
+        self.file_unique_id = file_unique_id
+        self.chunk_hashes = chunk_hashes
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        file_unique_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
+        return ChunkHashesMessage(file_unique_id, data[4 + UNIQUE_ID_LENGTH:])
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_unique_id.encode("utf-8") + self.chunk_hashes
+
+    @classmethod
+    def type(cls):
+        return CHUNK_HASHES_MESSAGE_TYPE
+
+
+class ChunkHashesRequestMessage(Message):
+    """
+    This message is used by a downloading client to request the hashes of a file's chunks, either from the server or
+    directly from one of the file's origins.
+    """
+    def __init__(self, file_unique_id: str):
+        self.file_unique_id = file_unique_id
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        return ChunkHashesRequestMessage(data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8"))
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_unique_id.encode("utf-8")
+
+    @classmethod
+    def type(cls):
+        return CHUNK_HASHES_REQUEST_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return ChunkHashesMessage
+
+
+class RangeRequestMessage(Message):
+    """
+    This message is used by the client to request a range of a file's data from a sharing client (e.g. the rest of a
+    chunk whose beginning was received from a different origin). Unlike StartFileTransferMessage, the range is given in
+    bytes, so it doesn't depend on the chunk size of the file.
+    The sharing client responds with consecutive RangeDataResponseMessages, each containing the next part of the range,
+    so that the data received before a failure isn't lost.
+    """
+    def __init__(self, file_id: str, offset: int, length: int):
+        self.file_id = file_id
+        self.offset = offset
+        self.length = length
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        file_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
+        offset, index = unpack_large_value(data, 4 + UNIQUE_ID_LENGTH)
+        length, _ = unpack_large_value(data, index)
+        return RangeRequestMessage(file_id, offset, length)
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_id.encode("utf-8") + pack_large_value(self.offset) + \
+            pack_large_value(self.length)
+
+    @classmethod
+    def type(cls):
+        return RANGE_REQUEST_MESSAGE_TYPE
+
+    @property
+    def matching_response_type(self):
+        return RangeDataResponseMessage
+
+
+class RangeDataResponseMessage(Message):
+    """
+    A response to RangeRequestMessage, containing a part of the requested range which starts at offset.
+    """
+    def __init__(self, file_id: str, offset: int, data: bytes):
+        self.file_id = file_id
+        self.offset = offset
+        self.data = data
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        file_id = data[4: 4 + UNIQUE_ID_LENGTH].decode("utf-8")
+        offset, index = unpack_large_value(data, 4 + UNIQUE_ID_LENGTH)
+        return RangeDataResponseMessage(file_id, offset, data[index:])
+
+    def serialize(self):
+        return pack("I", self.type()) + self.file_id.encode("utf-8") + pack_large_value(self.offset) + self.data
+
+    @classmethod
+    def type(cls):
+        return RANGE_DATA_RESPONSE_MESSAGE_TYPE
+
+
+class BusyMessage(Message):
+    """
+    This message is sent by a sharing client instead of the requested data when all of its upload slots are taken and
+    its upload queue is full, so that the downloader would request the data from a different origin meanwhile.
+    """
+    def __init__(self, retry_after: int):
+        """
+        :param retry_after: The amount of seconds after which the sharing client expects to have a free upload slot.
+        """
+        self.retry_after = retry_after
+
+    @classmethod
+    def deserialize(cls, data: bytes):
+        return BusyMessage(unpack("I", data[4: 8])[0])
+
+    def serialize(self):
+        return pack("I", self.type()) + pack("I", self.retry_after)
+
+    @classmethod
+    def type(cls):
+        return BUSY_MESSAGE_TYPE
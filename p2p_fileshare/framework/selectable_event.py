@@ -2,21 +2,20 @@
 This module implements the functionality needed to generate selectable "events" that can be used to wait on both network
 as well as non network operations.
 
-This functionality is implemented by connecting a new socket to a listening socket and using the new socket pair
- as the "event provider" and "event consumer". The client side can signal the event by sending a one byte message, and
- the server side can consume the event by using select on the socket and then reading a single byte.
+This functionality is implemented by creating a pair of connected sockets and using them as the "event provider" and
+ "event consumer". The client side can signal the event by sending a one byte message, and the server side can consume
+ the event by using select on the socket and then reading a single byte.
 """
 import socket
 
 
-def generate_socket_pair(listening_socket: socket.socket) -> tuple[socket.socket, socket.socket]:
+def generate_socket_pair() -> tuple[socket.socket, socket.socket]:
     """
     Creates a socket-pair (provider + consumer) and returns them as (provider, consumer).
+    NOTE: The pair must not be created by connecting to a server's listening socket, since accepting the consumer from
+    it might accept a real client which is concurrently connecting to the server instead.
     """
-    provider_socket = socket.socket()
-    provider_socket.connect(("127.0.0.1", listening_socket.getsockname()[1]))
-    consuming_socket, _ = listening_socket.accept()
-
+    provider_socket, consuming_socket = socket.socketpair()
     return provider_socket, consuming_socket
 
 
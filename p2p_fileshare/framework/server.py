@@ -32,7 +32,7 @@ class Server(ABC):
         self._socket.listen(MAX_PENDING_CLIENTS)
         logger.debug(f"Starting server at address: {self._socket.getsockname()}")
         self._selectable_sockets = {self._socket: self._accept_new_client}  # type: dict[socket.socket, Callable]
-        stop_event_provider, stop_event_consumer = generate_socket_pair(self._socket)
+        stop_event_provider, stop_event_consumer = generate_socket_pair()
         self._stop_provider = stop_event_provider
         self._selectable_sockets[stop_event_consumer] = self._stop
         self._items = []  # type is decided by derived class
@@ -53,7 +53,7 @@ class Server(ABC):
         """
         new_client, client_address = self._socket.accept()
         logger.debug(f"Accepted new client: {client_address}")
-        finished_provider, finished_consumer = generate_socket_pair(self._socket)
+        finished_provider, finished_consumer = generate_socket_pair()
         new_item = self._receive_new_client(new_client, client_address, finished_provider)
         self._items.append(new_item)
         self._selectable_sockets[finished_consumer] = lambda: self.remove_client(finished_consumer, new_item)
@@ -74,6 +74,10 @@ class Server(ABC):
         """
         raise StopException
 
+    @property
+    def port(self) -> int:
+        return self._socket.getsockname()[1]
+
     def stop(self):
         signal(self._stop_provider)
         logger.debug("Server's stop event was set!")
@@ -0,0 +1,151 @@
+"""
+This module contains the storage engine used to access the data of shared and downloaded files.
+A single file descriptor is kept open for the lifetime of the storage, and all accesses are positional (pread/pwrite),
+so that multiple threads can read and write different chunks of the same file concurrently without sharing a seek
+position.
+"""
+import os
+from contextlib import contextmanager
+from threading import Lock, Condition
+
+
+class FileStorage(object):
+    """
+    Positional access to the data of a single file.
+    All methods of this class are thread safe.
+    """
+    PREALLOCATE_BLOCKS = True
+
+    def __init__(self, file_path: str, writable: bool = False):
+        """
+        :param writable: Whether the storage would be written to (the file is created if it doesn't exist).
+        """
+        self._fd = None
+        flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+        self._fd = os.open(file_path, flags | getattr(os, "O_BINARY", 0), 0o666)
+        # Used to emulate positional access on platforms that don't support it (e.g. Windows)
+        self._seek_lock = Lock()
+        # The descriptor must not be closed while it's used, otherwise its number might be reused by a different file
+        self._active_operations = 0
+        self._active_operations_condition = Condition()
+
+    @contextmanager
+    def _file_descriptor(self) -> int:
+        with self._active_operations_condition:
+            if self._fd is None:
+                raise ValueError("I/O operation on a closed storage")
+            self._active_operations += 1
+            fd = self._fd
+        try:
+            yield fd
+        finally:
+            with self._active_operations_condition:
+                self._active_operations -= 1
+                self._active_operations_condition.notify_all()
+
+    def preallocate(self, size: int):
+        """
+        Sets the size of the file without writing any data into it.
+        The file is extended sparsely, and its blocks are reserved in advance if the OS and the file system support it
+        (so that the download won't run out of disk space halfway through, and the file will be less fragmented).
+        Data that is already present in the file (within the new size) is kept.
+        """
+        with self._file_descriptor() as fd:
+            os.ftruncate(fd, size)
+            if self.PREALLOCATE_BLOCKS and size > 0 and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    pass  # not supported by the file system, the file will remain sparse
+
+    @property
+    def size(self) -> int:
+        with self._file_descriptor() as fd:
+            return os.fstat(fd).st_size
+
+    def read(self, offset: int, size: int) -> bytes:
+        """
+        Reads up to size bytes at the offset (less bytes are returned only if the end of the file is reached).
+        """
+        parts = []
+        with self._file_descriptor() as fd:
+            while size > 0:
+                data = self._pread(fd, size, offset)
+                if not data:
+                    break  # end of file
+                parts.append(data)
+                offset += len(data)
+                size -= len(data)
+        return b"".join(parts)
+
+    def read_into(self, offset: int, buffer: memoryview) -> int:
+        """
+        Reads up to len(buffer) bytes at the offset into the buffer (less bytes are read only if the end of the file is
+        reached), without allocating a copy of the data where the OS supports it.
+        :return: The amount of bytes read.
+        """
+        bytes_read = 0
+        with self._file_descriptor() as fd:
+            while bytes_read < len(buffer):
+                part_size = self._preadv(fd, buffer[bytes_read:], offset + bytes_read)
+                if part_size == 0:
+                    break  # end of file
+                bytes_read += part_size
+        return bytes_read
+
+    def write(self, offset: int, data: bytes):
+        """
+        Writes all of data at the offset.
+        """
+        data = memoryview(data)
+        with self._file_descriptor() as fd:
+            while len(data) > 0:
+                bytes_written = self._pwrite(fd, data, offset)
+                offset += bytes_written
+                data = data[bytes_written:]
+
+    def _pread(self, fd: int, size: int, offset: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(fd, size, offset)
+        with self._seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+    def _preadv(self, fd: int, buffer: memoryview, offset: int) -> int:
+        if hasattr(os, "preadv"):
+            return os.preadv(fd, [buffer], offset)
+        data = self._pread(fd, len(buffer), offset)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _pwrite(self, fd: int, data: memoryview, offset: int) -> int:
+        if hasattr(os, "pwrite"):
+            return os.pwrite(fd, data, offset)
+        with self._seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+    def sync(self):
+        """
+        Makes sure all the data written so far is durable.
+        """
+        with self._file_descriptor() as fd:
+            os.fsync(fd)
+
+    def close(self):
+        """
+        Closes the file once all the operations currently performed on it are finished.
+        """
+        with self._active_operations_condition:
+            fd, self._fd = self._fd, None
+            self._active_operations_condition.wait_for(lambda: self._active_operations == 0)
+        if fd is not None:
+            os.close(fd)
+
+    @property
+    def closed(self) -> bool:
+        return self._fd is None
+
+    def __del__(self):
+        if self._fd is not None:
+            self.close()
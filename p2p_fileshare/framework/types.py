@@ -2,14 +2,20 @@
 A module containing different types used by the application
 """
 from typing import Optional
+from threading import Lock
 from math import ceil
+from p2p_fileshare.framework.storage import FileStorage
+from p2p_fileshare.framework.chunk_bitmap import ChunkBitmap
+from p2p_fileshare.framework.hashing import CHUNK_HASH_SIZE, HashCache, calculate_chunk_hash, get_chunk_hash, \
+    calculate_file_hashes, hash_chunks
 import os
-import hashlib
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+LEGACY_CHUNK_SIZE = 1024 * 1024 * 3  # 3 MB, the chunk size of every file shared before chunk sizes were chosen per file
+
 
 class SharingClientInfo(object):
     """
@@ -31,13 +37,19 @@ class SharingClientInfo(object):
 class SharedFile(object):
     """
     This class contains the metadata of a shared file.
+    The chunk size of a file is chosen once the file is shared (see FileObject.choose_chunk_size), and is kept along
+    with the rest of its metadata, since the chunk numbers and hashes of the file depend on it.
     """
-    def __init__(self, unique_id: str, name: str, modification_time: int, size: int, origins: list[SharingClientInfo]):
+    def __init__(self, unique_id: str, name: str, modification_time: int, size: int, origins: list[SharingClientInfo],
+                 chunk_size: Optional[int] = None):
         self.unique_id = unique_id
         self.name = name
         self.modification_time = modification_time
         self.size = size
         self.origins = origins
+        if chunk_size is None:
+            chunk_size = FileObject.choose_chunk_size(size)
+        self.chunk_size = chunk_size
 
 
 class FileObject(object):
@@ -46,33 +58,75 @@ class FileObject(object):
     It can be used by both the sharing client to transfer chunks of it to the downloading client,
     and by the downloading client to receive and write chunks into its own local copy of the file.
     """
-    CHUNK_SIZE = 1024 * 1024 * 3  # 3 MB
+    CHUNK_SIZE = LEGACY_CHUNK_SIZE  # the chunk size of all but the largest files
+    MAX_CHUNK_SIZE = LEGACY_CHUNK_SIZE * 16
+    MAX_AMOUNT_OF_CHUNKS = 2048
+
+    @classmethod
+    def choose_chunk_size(cls, file_size: int) -> int:
+        """
+        Chooses the chunk size of a newly shared file - the chunk size is doubled until the file has at most
+        MAX_AMOUNT_OF_CHUNKS chunks (up to MAX_CHUNK_SIZE), so that the per-chunk overhead of large files stays low.
+        """
+        chunk_size = cls.CHUNK_SIZE
+        while ceil(file_size / chunk_size) > cls.MAX_AMOUNT_OF_CHUNKS and chunk_size * 2 <= cls.MAX_CHUNK_SIZE:
+            chunk_size *= 2
+        return chunk_size
 
-    def __init__(self, file_path: str, files_data: SharedFile = None, is_local: bool = False):
+    def __init__(self, file_path: str, files_data: SharedFile = None, is_local: bool = False,
+                 downloaded_chunks: bytes = None, hash_cache: HashCache = None):
+        """
+        :param hash_cache: The cache to take the hash of a local file from (and to keep it in).
+        :param downloaded_chunks: When resuming a download - a bitmap of the chunks which were previously downloaded
+        (as returned by serialize_downloaded_chunks). These are only trusted if the file is still intact.
+        """
         self._file_path = file_path
         self._files_data = {}
+        previous_chunks = None
         self._chunk_num = None
-        self._downloaded_chunks = set()  # amount of chunks already present in the file
+        self._chunk_hashes = None  # type: Optional[bytes]
         if is_local:
-            self._get_file_data()
+            self._storage = FileStorage(file_path)
+            self._get_file_data(hash_cache)
         elif files_data is not None:
             self._get_data_from_shared_file(files_data)
-            self._write_empty_file()
+            if downloaded_chunks is not None and self._is_partial_download_intact():
+                previous_chunks = downloaded_chunks
+            self._storage = FileStorage(file_path, writable=True)
+            self._storage.preallocate(self._files_data['size'])
         else:
             raise ValueError('Bad usage: file is not local and file data was not supplied!')
-        self._chunks = set([chunk_num for chunk_num in range(self.amount_of_chunks)])
+        self._downloaded_chunks = ChunkBitmap(self.amount_of_chunks, previous_chunks)  # chunks present in the file
+        # chunks which are either downloaded or currently being downloaded
+        self._claimed_chunks = ChunkBitmap(self.amount_of_chunks, self._downloaded_chunks.to_bytes())
+        # the data received so far of chunks whose download has failed halfway through, so that it can be resumed
+        self._partial_chunks = {}  # type: dict[int, bytes]
+        self._partial_chunks_lock = Lock()
+
+    def _is_partial_download_intact(self) -> bool:
+        """
+        Whether the local file still looks like a partial download of the file (a download is preallocated to the full
+        size of the file on its start).
+        """
+        return os.path.isfile(self._file_path) and os.path.getsize(self._file_path) == self._files_data['size']
 
-    def _write_empty_file(self):
+    def serialize_downloaded_chunks(self) -> bytes:
         """
-        Write null-bytes into the file according to its expected size.
-        This is necessary since we want to later overwrite these bytes in place.
+        :return: A bitmap of the chunks downloaded so far - one bit per chunk.
+        """
+        return self._downloaded_chunks.to_bytes()
+
+    def close(self):
         """
-        bytes_written = 0
-        with open(self._file_path, 'wb') as f:
-            while bytes_written < self._files_data['size']:
-                bytes_to_write = min(self.CHUNK_SIZE, self._files_data['size'] - bytes_written)
-                f.write(bytes(bytes_to_write))
-                bytes_written += bytes_to_write
+        Closes the underlying storage of the file. The object can't be used afterwards.
+        """
+        self._storage.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @property
     def amount_of_chunks(self):
@@ -80,75 +134,169 @@ class FileObject(object):
         Total amount of chunks in the file.
         """
         if self._chunk_num is None:
-            self._chunk_num = ceil(self._files_data['size'] / self.CHUNK_SIZE)
+            self._chunk_num = ceil(self._files_data['size'] / self.chunk_size)
         return self._chunk_num
 
     @property
-    def downloaded_chunks(self):
-        return self._downloaded_chunks
+    def chunk_size(self) -> int:
+        return self._files_data['chunk_size']
 
-    def _get_file_data(self):
+    def get_chunk_length(self, chunk_num: int) -> int:
+        """
+        The amount of bytes in the chunk (all the chunks but the last one are full).
+        """
+        return min(self.chunk_size, self._files_data['size'] - chunk_num * self.chunk_size)
+
+    @property
+    def downloaded_chunks(self) -> set[int]:
+        return set(self._downloaded_chunks)
+
+    @property
+    def amount_of_downloaded_chunks(self) -> int:
+        return self._downloaded_chunks.count
+
+    def _get_file_data(self, hash_cache: Optional[HashCache]):
         file_stats = os.stat(self._file_path)
         self._files_data['name'] = os.path.basename(self._file_path)
         self._files_data['modification_time'] = int(file_stats.st_mtime)
         self._files_data['size'] = file_stats.st_size
-        self._files_data['unique_id'] = self.get_file_hash()
+        self._files_data['chunk_size'] = self.choose_chunk_size(file_stats.st_size)
+        self._files_data['unique_id'] = calculate_file_hashes(self._file_path, self.chunk_size, hash_cache)[0]
 
     def _get_data_from_shared_file(self, files_data: SharedFile):
         self._files_data['name'] = files_data.name
         self._files_data['modification_time'] = files_data.modification_time
         self._files_data['size'] = files_data.size
+        self._files_data['chunk_size'] = files_data.chunk_size
         self._files_data['unique_id'] = files_data.unique_id
 
     def get_file_hash(self) -> str:
         """
-        Calculates the hash of a local file's data by reading chunks of it and feeding them to the md5 algorithm.
+        Calculates the hash of the file's current data (always reading it, e.g. to verify a finished download).
         :return an hexadecimal representation of the file's hash.
         """
-        current_md5 = hashlib.md5()
-        for i in range(self.amount_of_chunks):
-            chunk_data = self.read_chunk(i)
-            current_md5.update(chunk_data)
-        return current_md5.hexdigest()
+        return hash_chunks((self.read_chunk(i) for i in range(self.amount_of_chunks)), with_chunk_hashes=False)[0]
 
     def read_chunk(self, chunk_num: int) -> bytes:
         assert chunk_num < self.amount_of_chunks
-        chunk_data = None
-        try:
-            with open(self._file_path, 'rb+') as f:
-                f.seek(self.CHUNK_SIZE * chunk_num)
-                chunk_data = f.read(self.CHUNK_SIZE)
-        finally:
-            assert chunk_data is not None
-            return chunk_data
+        return self._storage.read(self.chunk_size * chunk_num, self.chunk_size)
 
     def write_chunk(self, chunk_num: int, chunk_data: bytes):
         """
-        Writes chunk_data into the local file at chunk_num * CHUNK_SIZE offset.
+        Writes chunk_data into the local file at chunk_num * chunk_size offset, and marks the chunk as downloaded.
         NOTE: This function merely overwrites existing data in the file, and does not increase the file size.
         """
-        assert chunk_num < self.amount_of_chunks
-        assert len(chunk_data) <= self.CHUNK_SIZE
-        with open(self._file_path, 'r+b') as f:
-            f.seek(self.CHUNK_SIZE * chunk_num)
-            f.write(chunk_data)
-        self._downloaded_chunks.add(chunk_num)
-        logger.debug(f'Wrote chunk {chunk_num} to file {self._file_path}')
+        assert len(chunk_data) <= self.chunk_size
+        self.write_chunks(chunk_num, chunk_data)
+        self.mark_downloaded([chunk_num])
+
+    def write_chunks(self, first_chunk_num: int, chunks_data: bytes):
+        """
+        Writes the data of consecutive chunks, starting at first_chunk_num, using a single write.
+        The chunks are not marked as downloaded (so that the caller can first make sure they are durable).
+        """
+        assert first_chunk_num + ceil(len(chunks_data) / self.chunk_size) <= self.amount_of_chunks
+        self._storage.write(self.chunk_size * first_chunk_num, chunks_data)
+        logger.debug(f'Wrote {len(chunks_data)} bytes starting at chunk {first_chunk_num} to file {self._file_path}')
+
+    def mark_downloaded(self, chunk_nums: list[int]):
+        for chunk_num in chunk_nums:
+            self._claimed_chunks.set(chunk_num)
+            self._downloaded_chunks.set(chunk_num)
+        with self._partial_chunks_lock:
+            for chunk_num in chunk_nums:
+                self._partial_chunks.pop(chunk_num, None)
+
+    def save_partial_chunk(self, chunk_num: int, data: bytes):
+        """
+        Keeps the beginning of a chunk whose download has failed, so that the next download of the chunk (possibly
+        from a different origin) would only request the rest of it.
+        """
+        with self._partial_chunks_lock:
+            if data and chunk_num not in self._downloaded_chunks:
+                self._partial_chunks[chunk_num] = data
+
+    def take_partial_chunk(self, chunk_num: int) -> bytes:
+        """
+        :return: The beginning of the chunk which was received so far (empty if there's none).
+        """
+        with self._partial_chunks_lock:
+            return self._partial_chunks.pop(chunk_num, b"")
+
+    def sync(self):
+        """
+        Makes sure all the chunks written so far are durable.
+        """
+        self._storage.sync()
+
+    def set_chunk_hashes(self, chunk_hashes: bytes):
+        """
+        Sets the expected hashes of the file's chunks, so that the data of downloaded chunks could be verified.
+        :raises: ValueError if the amount of hashes doesn't match the amount of chunks in the file.
+        """
+        if len(chunk_hashes) != self.amount_of_chunks * CHUNK_HASH_SIZE:
+            raise ValueError(f"Expected {self.amount_of_chunks} chunk hashes, "
+                             f"got {len(chunk_hashes) / CHUNK_HASH_SIZE}")
+        self._chunk_hashes = chunk_hashes
+
+    def clear_chunk_hashes(self):
+        """
+        Forgets the hashes of the file's chunks (e.g. once they turn out to be wrong).
+        """
+        self._chunk_hashes = None
+
+    @property
+    def chunk_hashes(self) -> Optional[bytes]:
+        return self._chunk_hashes
+
+    @property
+    def has_chunk_hashes(self) -> bool:
+        return self._chunk_hashes is not None
+
+    def is_chunk_valid(self, chunk_num: int, chunk_data: bytes) -> bool:
+        """
+        Returns whether the data of a chunk matches its expected hash (any data is valid if the hashes are unknown).
+        """
+        if self._chunk_hashes is None:
+            return True
+        return calculate_chunk_hash(chunk_data) == get_chunk_hash(self._chunk_hashes, chunk_num)
+
+    def verify_downloaded_chunks(self) -> list[int]:
+        """
+        Reads the chunks marked as downloaded (e.g. by a previous run of a resumed download) and verifies their data.
+        Corrupted chunks are returned to the chunks that are yet to be downloaded.
+        :return: The corrupted chunks.
+        """
+        corrupted_chunks = [chunk_num for chunk_num in self._downloaded_chunks
+                            if not self.is_chunk_valid(chunk_num, self.read_chunk(chunk_num))]
+        for chunk_num in corrupted_chunks:
+            self._downloaded_chunks.clear(chunk_num)
+            self._claimed_chunks.clear(chunk_num)
+        return corrupted_chunks
 
     def get_shared_file(self):
         return SharedFile(self._files_data['unique_id'],  self._files_data['name'],
-                          self._files_data['modification_time'], self._files_data['size'], [])
+                          self._files_data['modification_time'], self._files_data['size'], [],
+                          self._files_data['chunk_size'])
+
+    def get_empty_chunk(self, start: int = 0, end: Optional[int] = None) -> Optional[int]:
+        """
+        Claims the first chunk which is neither downloaded nor claimed already, so that concurrent downloaders never get
+        the same chunk. A claimed chunk must either be marked as downloaded or returned (via return_failed_chunk).
+        :param start: Chunks from this one onwards are preferred (earlier chunks are claimed once they're all claimed).
+        :param end: If given, only the chunks from start up to end (exclusive) may be claimed.
+        """
+        return self._claimed_chunks.claim(start, end)
 
-    def get_empty_chunk(self) -> Optional[int]:
-        if len(self._chunks) > 0:
-            return self._chunks.pop()
-        return None
+    def is_chunk_downloaded(self, chunk_num: int) -> bool:
+        return chunk_num in self._downloaded_chunks
 
     def has_empty_chunks(self) -> bool:
         """
         Returns whether the files has been completely downloaded.
         """
-        return len(self._downloaded_chunks) != self.amount_of_chunks
+        return not self._downloaded_chunks.is_full()
 
     def return_failed_chunk(self, chunk_num: int):
-        self._chunks.add(chunk_num)
+        if chunk_num not in self._downloaded_chunks:
+            self._claimed_chunks.clear(chunk_num)
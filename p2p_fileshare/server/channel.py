@@ -3,17 +3,22 @@ A module containing the communication channel logic.
 Each communication channel represents a single channel between the server and a client.
 All actions in the channel must be made in a thread-safe way to ensure no data corruption is taking place.
 """
-from threading import Thread
+from threading import Thread, Event
 from select import select
 from logging import getLogger
 from p2p_fileshare.server.db_manager import DBManager
+from p2p_fileshare.server.search_cache import SearchCache
+from p2p_fileshare.server.origin_selection import OriginSelector
+from p2p_fileshare.server.subscriptions import SubscriptionManager, Subscriber
 from p2p_fileshare.framework.channel import Channel, SocketClosedException
 from p2p_fileshare.framework.messages import Message, SearchFileMessage, FileListMessage, ShareFileMessage, \
     ClientIdMessage, SharingInfoRequestMessage, SharingInfoResponseMessage, GeneralSuccessMessage, GeneralErrorMessage, \
-    RemoveShareMessage, SharePortMessage
-from p2p_fileshare.framework.types import SharingClientInfo
+    RemoveShareMessage, SharePortMessage, ShareFilesBatchMessage, RemoveSharesBatchMessage, BatchStatusMessage, \
+    SharingInfoBatchRequestMessage, SharingInfoBatchResponseMessage, LoadReportMessage, SubscribeOriginsMessage, \
+    UnsubscribeOriginsMessage, ChunkHashesMessage, ChunkHashesRequestMessage, LEGACY_PROTOCOL_VERSION, is_legacy_file
+from p2p_fileshare.framework.types import SharingClientInfo, SharedFile
 from p2p_fileshare.framework.selectable_event import signal
-from typing import Callable
+from typing import Callable, Optional
 import time
 import hashlib
 import socket
@@ -26,11 +31,26 @@ class ClientChannel(object):
     """
     A class governing the interactions with a single client from the perspective of the metadata server.
     """
+    MAX_SEARCH_PAGE_SIZE = 500
+
     def __init__(self, client_channel: Channel, db: DBManager, get_all_clients_func: Callable,
-                 finished_socket: socket.socket):
+                 finished_socket: socket.socket, search_cache: SearchCache, origin_selector: OriginSelector,
+                 subscription_manager: SubscriptionManager, server_stopping: Event):
+        """
+        :param server_stopping: Set once the server is stopping, in which case disconnecting clients don't update the
+        server's state (their DB might not be available anymore).
+        """
         self._channel = client_channel
         self._db = db
+        self._search_cache = search_cache
+        self._origin_selector = origin_selector
+        self._subscription_manager = subscription_manager
+        self._subscriber = Subscriber(client_channel)
+        self._server_stopping = server_stopping
         self._client_id = None
+        # until the client identifies itself, only what the oldest clients understand is sent to it
+        self._protocol_version = LEGACY_PROTOCOL_VERSION
+        self._is_connected = True
         self._thread = Thread(target=self.__start)
         self._thread.start()
         self._get_all_clients_func = get_all_clients_func
@@ -47,19 +67,84 @@ class ClientChannel(object):
             while True:
                 # infinite wait - once the channel is closed the select will be triggered, once we'll attempt to read
                 # an exception will be thrown forcing us to exit.
-                rlist, _, _ = select([self._channel], [], [])
-                if rlist:
+                rlist, _, _ = select([self._channel, self._subscriber], [], [])
+                if self._subscriber in rlist:
+                    self._subscriber.send_pending_updates()
+                if self._channel in rlist:
                     try:
                         msg = self._channel.recv_message()
                     except SocketClosedException as e:
                         logger.debug('Socket closed')
                         break
                     logger.debug(f"received message: {msg}")
-                    response = self._do_action(msg)
+                    try:
+                        response = self._do_action(msg)
+                    except Exception as e:
+                        logger.error(f"Failed handling {type(msg).__name__}: {e}")
+                        # only requests are answered, any other message would be taken as a response to the client's
+                        # next request
+                        response = GeneralErrorMessage(f"Failed handling the request: {e}") \
+                            if msg.matching_response_type is not None else None
+                    if self._client_id is not None:
+                        self._origin_selector.record_activity(self._client_id)
                     if response is not None:
                         self._channel.send_message(response)
         finally:
-            signal(self._finished_socket)
+            try:
+                self.__disconnect()
+            finally:
+                # the server must always be able to remove the channel
+                signal(self._finished_socket)
+
+    def __disconnect(self):
+        """
+        Removes the client from the server's state once it has disconnected.
+        """
+        # From now on this client's files should not be found by searches
+        self._is_connected = False
+        self._subscription_manager.unsubscribe_all(self._subscriber)
+        self._subscriber.close()
+        if self._client_id is None:
+            return
+        self._origin_selector.forget(self._client_id)
+        if self._server_stopping.is_set():
+            return
+        try:
+            self.__invalidate_client_searches()
+            self.__publish_removed_origin(self._db.get_shared_file_ids(self._client_id))
+        except Exception as e:
+            logger.error(f"Failed updating the shares of disconnected client {self._client_id}: {e}")
+
+    def __invalidate_client_searches(self):
+        """
+        Invalidates the cached searches that might be affected by this client connecting / disconnecting.
+        """
+        if self._client_id is not None:
+            self._search_cache.invalidate_file_names(self._db.get_shared_file_names(self._client_id))
+
+    def __origin_info(self) -> Optional[SharingClientInfo]:
+        """
+        The information other clients need in order to download files from this client, or None if this client can't
+        serve downloads yet.
+        """
+        if self._client_id is None or self._client_share_port is None:
+            return None
+        return SharingClientInfo(self._client_id, (self._channel.getpeername()[0], self._client_share_port))
+
+    def __publish_added_origin(self, file_ids: list[str]):
+        """
+        Lets the subscribers of the files know this client has become one of their origins.
+        """
+        origin_info = self.__origin_info()
+        if origin_info is not None:
+            self._subscription_manager.publish(file_ids, added_origins=[origin_info])
+
+    def __publish_removed_origin(self, file_ids: list[str]):
+        """
+        Lets the subscribers of the files know this client is no longer one of their origins.
+        """
+        if self._client_id is not None and self._client_share_port is not None:
+            self._subscription_manager.publish(file_ids, removed_origins=[self._client_id])
 
     def __get_connected_sharing_clients(self, file_unique_id: str) -> list[SharingClientInfo]:
         """
@@ -75,6 +160,58 @@ class ClientChannel(object):
                 for current_client in current_clients if
                 current_client[0] in sharing_clients and current_client[1] is not None]
 
+    def __get_files_sharing_info(self, file_ids: list[str]) -> list[SharedFile]:
+        """
+        Retrieves the information of multiple files, along with a sample of the clients that both share them and are
+        currently connected, using a constant amount of queries.
+        """
+        shared_files = self._db.get_shared_files_info(file_ids)
+        files_sharing_clients = self._db.find_files_sharing_clients(file_ids)
+        current_clients = {current_client[0]: SharingClientInfo(current_client[0], (current_client[1], current_client[2]))
+                           for current_client in self._get_all_clients_func() if current_client[1] is not None}
+        for shared_file in shared_files:
+            shared_file.origins = self._origin_selector.sample(
+                [current_clients[sharing_client] for sharing_client in
+                 files_sharing_clients.get(shared_file.unique_id, []) if sharing_client in current_clients])
+        return shared_files
+
+    def __supports_file(self, shared_file: SharedFile) -> bool:
+        """
+        Whether the client's protocol version can handle the file (legacy clients can't handle files larger than 4 GiB).
+        """
+        return self._protocol_version > LEGACY_PROTOCOL_VERSION or is_legacy_file(shared_file)
+
+    def __search_file(self, msg: SearchFileMessage) -> FileListMessage:
+        """
+        Retrieves a single page of the files matching the search which are shared by at least one connected client.
+        """
+        response = self.__search_all_files(msg)
+        if self._protocol_version > LEGACY_PROTOCOL_VERSION:
+            return response
+        return FileListMessage([file for file in response.files if is_legacy_file(file)], response.next_offset)
+
+    def __search_all_files(self, msg: SearchFileMessage) -> FileListMessage:
+        """
+        Retrieves a single page of the files matching the search, regardless of the client's protocol version.
+        One extra file is requested from the DB in order to know whether there's a following page.
+        """
+        page_size = min(msg.limit or self.MAX_SEARCH_PAGE_SIZE, self.MAX_SEARCH_PAGE_SIZE)
+        cache_key = (msg.name, page_size, msg.offset, msg.sort_by)
+        cached_response = self._search_cache.lookup(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        cache_generation = self._search_cache.generation
+        connected_clients = [client[0] for client in self._get_all_clients_func() if client[0] is not None]
+        matching_files = self._db.search_file(msg.name, connected_clients, page_size + 1, msg.offset, msg.sort_by)
+        next_offset = None
+        if len(matching_files) > page_size:
+            matching_files = matching_files[:page_size]
+            next_offset = msg.offset + page_size
+        response = FileListMessage(matching_files, next_offset)
+        self._search_cache.store(cache_key, response, cache_generation)
+        return response
+
     def _do_action(self, msg: Message):
         """
         Perform an action according to the incoming message and returns an appropriate response message.
@@ -82,19 +219,27 @@ class ClientChannel(object):
         :return:
         """
         if isinstance(msg, SearchFileMessage):
-            matching_files = self._db.search_file(msg.name)
-            matching_files = [matching_file for matching_file in matching_files
-                              if self.__get_connected_sharing_clients(matching_file.unique_id)]
-            return FileListMessage(matching_files)
+            return self.__search_file(msg)
         if isinstance(msg, SharePortMessage):
             self._client_share_port = msg.share_port
+            if self._client_id is not None:
+                self.__publish_added_origin(self._db.get_shared_file_ids(self._client_id))
         if isinstance(msg, ShareFileMessage):
             if self._db.new_share(msg.file, self._client_id):
+                self._search_cache.invalidate_file_names([msg.file.name])
+                self.__publish_added_origin([msg.file.unique_id])
                 return GeneralSuccessMessage('File shared successfully!')
             return GeneralErrorMessage('File is already shared!')
+        if isinstance(msg, ShareFilesBatchMessage):
+            statuses = self._db.new_shares(msg.files, self._client_id)
+            new_files = [file for file, status in zip(msg.files, statuses) if status]
+            self._search_cache.invalidate_file_names([file.name for file in new_files])
+            self.__publish_added_origin([file.unique_id for file in new_files])
+            return BatchStatusMessage(statuses)
         if isinstance(msg, ClientIdMessage):
             unique_id = msg.unique_id
-            logger.debug(f"new client unique id is {unique_id}")
+            logger.debug(f"new client unique id is {unique_id} (protocol version {msg.protocol_version})")
+            self._protocol_version = msg.protocol_version
             if unique_id == msg.NO_ID_MAGIC:
                 unique_id = hashlib.md5(bytes(str(time.time()), 'utf-8')).hexdigest()
                 self._db.add_new_client(unique_id)
@@ -103,19 +248,50 @@ class ClientChannel(object):
             else:
                 self._db.add_new_client(unique_id)
                 self._client_id = unique_id
+                self.__invalidate_client_searches()
         if isinstance(msg, SharingInfoRequestMessage):
             shared_file = self._db.get_shared_file_info(msg.file_unique_id)
             if shared_file is None:
                 return GeneralErrorMessage('Found no files with the unique ID specified!')
+            if not self.__supports_file(shared_file):
+                return GeneralErrorMessage('The file is too large for the protocol version of the client!')
 
             connected_sharing_clients = self.__get_connected_sharing_clients(msg.file_unique_id)
-            shared_file.origins = connected_sharing_clients
-            return SharingInfoResponseMessage(shared_file)
+            shared_file.origins = self._origin_selector.sample(connected_sharing_clients, msg.max_origins,
+                                                               msg.excluded_origins)
+            return SharingInfoResponseMessage(shared_file, len(connected_sharing_clients))
         if isinstance(msg, RemoveShareMessage):
+            shared_file = self._db.get_shared_file_info(msg.unique_id)
             if self._db.remove_share(msg.unique_id, self._client_id):
+                self._search_cache.invalidate_file_names([shared_file.name])
+                self.__publish_removed_origin([msg.unique_id])
                 return GeneralSuccessMessage('Share was deleted successfully!')
             else:
                 return GeneralErrorMessage('Failed to delete share: No such share was found!')
+        if isinstance(msg, SharingInfoBatchRequestMessage):
+            return SharingInfoBatchResponseMessage([shared_file for shared_file in
+                                                    self.__get_files_sharing_info(msg.file_unique_ids)
+                                                    if self.__supports_file(shared_file)])
+        if isinstance(msg, RemoveSharesBatchMessage):
+            file_names = self._db.get_file_names(msg.unique_ids)
+            statuses = self._db.remove_shares(msg.unique_ids, self._client_id)
+            self._search_cache.invalidate_file_names(file_names)
+            self.__publish_removed_origin([unique_id for unique_id, status in zip(msg.unique_ids, statuses) if status])
+            return BatchStatusMessage(statuses)
+        if isinstance(msg, LoadReportMessage):
+            if self._client_id is not None:
+                self._origin_selector.record_load(self._client_id, msg)
+        if isinstance(msg, SubscribeOriginsMessage):
+            if self._subscription_manager.subscribe(msg.file_unique_id, self._subscriber):
+                return GeneralSuccessMessage('Subscribed successfully!')
+            return GeneralErrorMessage('Too many subscriptions!')
+        if isinstance(msg, UnsubscribeOriginsMessage):
+            self._subscription_manager.unsubscribe(msg.file_unique_id, self._subscriber)
+        if isinstance(msg, ChunkHashesMessage):
+            if self._client_id is not None:
+                self._db.add_chunk_hashes(msg.file_unique_id, msg.chunk_hashes, self._client_id)
+        if isinstance(msg, ChunkHashesRequestMessage):
+            return ChunkHashesMessage(msg.file_unique_id, self._db.get_chunk_hashes(msg.file_unique_id) or b"")
 
         return None
 
@@ -129,3 +305,11 @@ class ClientChannel(object):
     @property
     def is_active(self):
         return self._thread.is_alive()
+
+    @property
+    def is_connected(self):
+        """
+        Whether the client is still connected (a disconnected client might remain active for a short while, until its
+        thread finishes cleaning up).
+        """
+        return self._is_connected
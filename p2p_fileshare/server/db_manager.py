@@ -4,8 +4,10 @@ This modules governs DB-related actions.
 import logging
 import sqlite3
 from typing import Optional
-from p2p_fileshare.framework.types import SharedFile
+from p2p_fileshare.framework.types import SharedFile, LEGACY_CHUNK_SIZE
 from p2p_fileshare.framework.db import AbstractDBManager, db_func
+from p2p_fileshare.framework.messages import SEARCH_SORT_NONE, SEARCH_SORT_NAME, SEARCH_SORT_SIZE, \
+    SEARCH_SORT_MODIFICATION_TIME
 
 
 logger = logging.getLogger(__file__)
@@ -17,17 +19,52 @@ class DBManager(AbstractDBManager):
                        "unique_id text, PRIMARY KEY('unique_id'));")
         cursor.execute("CREATE TABLE origins (unique_id text, PRIMARY KEY('unique_id'))")
         cursor.execute("CREATE TABLE shares (file text , origin text, PRIMARY KEY ('file', 'origin'))")
+        self._upgrade_db(cursor)
+
+    def _upgrade_db(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS chunk_hashes (file text, origin text, chunk_hashes blob, "
+                       "PRIMARY KEY ('file', 'origin'))")
+        cursor.execute("PRAGMA table_info(files)")
+        if "chunk_size" not in [column[1] for column in cursor.fetchall()]:
+            # files shared before chunk sizes were kept have a null chunk size, meaning the legacy chunk size
+            cursor.execute("ALTER TABLE files ADD COLUMN chunk_size integer")
+
+    FILE_COLUMNS = "files.file_name, files.modification_time, files.size, files.unique_id, files.chunk_size"
+
+    @staticmethod
+    def _file_from_row(row: tuple) -> SharedFile:
+        """
+        Creates a SharedFile (without origins) out of a row of FILE_COLUMNS.
+        """
+        file_name, modification_time, size, unique_id, chunk_size = row
+        return SharedFile(unique_id, file_name, modification_time, size, [], chunk_size or LEGACY_CHUNK_SIZE)
+
+    SEARCH_SORT_COLUMNS = {SEARCH_SORT_NONE: 'files.rowid', SEARCH_SORT_NAME: 'files.file_name',
+                           SEARCH_SORT_SIZE: 'files.size', SEARCH_SORT_MODIFICATION_TIME: 'files.modification_time'}
 
     @db_func
-    def search_file(self, cursor: sqlite3.Cursor, filename: str) -> list[SharedFile]:
+    def search_file(self, cursor: sqlite3.Cursor, filename: str, origins: list[str], limit: int, offset: int = 0,
+                    sort_by: int = SEARCH_SORT_NONE) -> list[SharedFile]:
         """
         Searches for a single file via its filename.
-        Every file containing the requested filename as a substring will be retrieved.
+        Every file containing the requested filename as a substring, and which is shared by at least one of the origins
+        supplied, will be retrieved.
+        The results are paginated: at most limit files are returned, starting at offset (in the order set by sort_by).
         :return: A list of the files (each represented by a SharedFile object).
         """
-        cursor.execute(f"SELECT * FROM files where file_name like '%{filename}%';")
+        order_column = self.SEARCH_SORT_COLUMNS.get(sort_by, self.SEARCH_SORT_COLUMNS[SEARCH_SORT_NONE])
+        # The filename is matched literally, so LIKE's wildcards in it must be escaped
+        escaped_filename = filename.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        # The connection only lives for the duration of this call, and so does this temporary table
+        cursor.execute("CREATE TEMP TABLE search_origins (unique_id text, PRIMARY KEY('unique_id'));")
+        cursor.executemany("INSERT OR IGNORE INTO search_origins values (?);", [(origin,) for origin in origins])
+        cursor.execute(f"SELECT {self.FILE_COLUMNS} FROM files "
+                       "WHERE files.file_name like ? ESCAPE '\\' AND EXISTS (SELECT 1 FROM shares JOIN search_origins "
+                       "ON shares.origin = search_origins.unique_id WHERE shares.file = files.unique_id) "
+                       f"ORDER BY {order_column}, files.rowid LIMIT ? OFFSET ?;",
+                       (f'%{escaped_filename}%', limit, offset))
         result = cursor.fetchall()
-        return [SharedFile(line[3], line[0], line[1], line[2], []) for line in result]
+        return [self._file_from_row(line) for line in result]
 
     @staticmethod
     def _does_file_exist(cursor: sqlite3.Cursor, unique_id: str) -> int:
@@ -40,7 +77,9 @@ class DBManager(AbstractDBManager):
         If the new file doesn't exist in the files table, adds it.
         """
         if not DBManager._does_file_exist(cursor, new_file.unique_id):
-            cursor.execute(f"INSERT INTO files values ('{new_file.name}', {new_file.modification_time}, {new_file.size}, '{new_file.unique_id}');")
+            cursor.execute("INSERT INTO files values (?, ?, ?, ?, ?);", (new_file.name, new_file.modification_time,
+                                                                          new_file.size, new_file.unique_id,
+                                                                          new_file.chunk_size))
 
     @staticmethod
     def _is_file_already_shared(cursor: sqlite3.Cursor, file_id: str, origin_id: str):
@@ -61,6 +100,50 @@ class DBManager(AbstractDBManager):
             logger.warning(f"A client tried to share the same file twice. Client id {origin_id}, file id {new_file.unique_id}")
             return False
 
+    @staticmethod
+    def _create_ids_table(cursor: sqlite3.Cursor, table_name: str, unique_ids: list[str]):
+        """
+        Creates a temporary table holding a set of unique IDs, to be used in set-based queries (no matter how many IDs
+        there are).
+        The table is dropped once the cursor's connection is closed.
+        """
+        cursor.execute(f"CREATE TEMP TABLE {table_name} (unique_id text, PRIMARY KEY('unique_id'));")
+        cursor.executemany(f"INSERT OR IGNORE INTO {table_name} values (?);", [(unique_id,) for unique_id in unique_ids])
+
+    @staticmethod
+    def _get_origin_shares(cursor: sqlite3.Cursor, unique_ids: list[str], origin_id: str) -> set[str]:
+        """
+        :return: The subset of the file IDs supplied which are currently shared by the origin.
+        """
+        DBManager._create_ids_table(cursor, "requested_files", unique_ids)
+        cursor.execute("select shares.file from shares join requested_files on shares.file = requested_files.unique_id "
+                       "where shares.origin = ?", (origin_id,))
+        return {line[0] for line in cursor.fetchall()}
+
+    @db_func
+    def new_shares(self, cursor: sqlite3.Cursor, new_files: list[SharedFile], origin_id: str) -> list[bool]:
+        """
+        Same as new_share, but adds multiple shares in a single transaction.
+        :return: Whether the addition of each of the new shares was successful.
+        """
+        shared_files = self._get_origin_shares(cursor, [new_file.unique_id for new_file in new_files], origin_id)
+        statuses = []
+        added_files = []
+        for new_file in new_files:
+            statuses.append(new_file.unique_id not in shared_files)
+            if statuses[-1]:
+                shared_files.add(new_file.unique_id)
+                added_files.append(new_file)
+        cursor.executemany("INSERT OR IGNORE INTO files values (?, ?, ?, ?, ?);",
+                           [(new_file.name, new_file.modification_time, new_file.size, new_file.unique_id,
+                             new_file.chunk_size) for new_file in added_files])
+        cursor.executemany("INSERT INTO shares values (?, ?);", [(new_file.unique_id, origin_id)
+                                                                 for new_file in added_files])
+        if len(added_files) != len(new_files):
+            logger.warning(f"A client tried to share {len(new_files) - len(added_files)} files twice. "
+                           f"Client id {origin_id}")
+        return statuses
+
     @staticmethod
     def _does_client_exist(cursor: sqlite3.Cursor, unique_id: str):
         """
@@ -92,11 +175,67 @@ class DBManager(AbstractDBManager):
         if not self._is_file_already_shared(cursor, file_unique_id, origin):
             return False
         cursor.execute(f"delete from shares where file='{file_unique_id}' and origin='{origin}'")
+        cursor.execute("delete from chunk_hashes where file = ? and origin = ?", (file_unique_id, origin))
         if not self._does_anyone_share_file(cursor, file_unique_id):
             # No client is sharing the file, remove it from files table
             cursor.execute(f"delete from files where unique_id='{file_unique_id}'")
         return True
 
+    @db_func
+    def remove_shares(self, cursor: sqlite3.Cursor, file_unique_ids: list[str], origin: str) -> list[bool]:
+        """
+        Same as remove_share, but removes multiple shares in a single transaction.
+        :return: Whether each of the shares was removed successfully (False if it didn't exist).
+        """
+        shared_files = self._get_origin_shares(cursor, file_unique_ids, origin)
+        statuses = []
+        for file_unique_id in file_unique_ids:
+            statuses.append(file_unique_id in shared_files)
+            shared_files.discard(file_unique_id)
+        cursor.execute("delete from shares where origin = ? and file in (select unique_id from requested_files)",
+                       (origin,))
+        cursor.execute("delete from chunk_hashes where origin = ? and file in (select unique_id from requested_files)",
+                       (origin,))
+        # Files no client is sharing anymore should be removed from the files table
+        cursor.execute("delete from files where unique_id in (select unique_id from requested_files) and not exists "
+                       "(select 1 from shares where shares.file = files.unique_id)")
+        return statuses
+
+    @db_func
+    def add_chunk_hashes(self, cursor: sqlite3.Cursor, file_unique_id: str, chunk_hashes: bytes,
+                         origin_id: str) -> bool:
+        """
+        Keeps the hashes of a file's chunks, as reported by one of its origins (for as long as the origin shares the
+        file).
+        @returns True if the hashes were kept, False if the origin doesn't share the file.
+        """
+        if not self._is_file_already_shared(cursor, file_unique_id, origin_id):
+            return False
+        cursor.execute("insert or replace into chunk_hashes values (?, ?, ?)",
+                       (file_unique_id, origin_id, chunk_hashes))
+        return True
+
+    @db_func
+    def get_chunk_hashes(self, cursor: sqlite3.Cursor, file_unique_id: str) -> Optional[bytes]:
+        """
+        The server can't verify the hashes reported by origins (it doesn't have the file's data), so a single origin
+        mustn't decide them - the hashes reported by the largest amount of the file's origins are returned.
+        """
+        cursor.execute("select chunk_hashes from chunk_hashes where file = ? group by chunk_hashes "
+                       "order by count(*) desc limit 1", (file_unique_id,))
+        result = cursor.fetchone()
+        return result[0] if result is not None else None
+
+    @db_func
+    def get_file_names(self, cursor: sqlite3.Cursor, file_unique_ids: list[str]) -> list[str]:
+        """
+        Retrieves the names of the files identified by the unique IDs supplied (IDs of unknown files are ignored).
+        """
+        self._create_ids_table(cursor, "requested_files", file_unique_ids)
+        cursor.execute("select files.file_name from files join requested_files on "
+                       "files.unique_id = requested_files.unique_id")
+        return [line[0] for line in cursor.fetchall()]
+
     @db_func
     def find_sharing_clients(self, cursor: sqlite3.Cursor, file_unique_id: str):
         """
@@ -106,15 +245,55 @@ class DBManager(AbstractDBManager):
         cursor.execute(f"select origin from shares where file = '{file_unique_id}'")
         return [line[0] for line in cursor.fetchall()]
 
+    @db_func
+    def get_shared_file_names(self, cursor: sqlite3.Cursor, origin_id: str) -> list[str]:
+        """
+        Retrieves the names of all the files shared by a single client.
+        """
+        cursor.execute("select files.file_name from files join shares on files.unique_id = shares.file "
+                       "where shares.origin = ?", (origin_id,))
+        return [line[0] for line in cursor.fetchall()]
+
+    @db_func
+    def get_shared_file_ids(self, cursor: sqlite3.Cursor, origin_id: str) -> list[str]:
+        """
+        Retrieves the unique IDs of all the files shared by a single client.
+        """
+        cursor.execute("select file from shares where origin = ?", (origin_id,))
+        return [line[0] for line in cursor.fetchall()]
+
     @db_func
     def get_shared_file_info(self, cursor: sqlite3.Cursor, file_id: str) -> Optional[SharedFile]:
         """
         Searches for a single file via its unique ID.
         :return: The SharedFIle requested.
         """
-        cursor.execute(f"SELECT * FROM files where unique_id like '%{file_id}%';")
+        cursor.execute(f"SELECT {self.FILE_COLUMNS} FROM files where unique_id like '%{file_id}%';")
         result = cursor.fetchall()
         if len(result) == 1:
-            result = result[0]
-            return SharedFile(result[3], result[0], result[1], result[2], [])
+            return self._file_from_row(result[0])
         return None
+
+    @db_func
+    def get_shared_files_info(self, cursor: sqlite3.Cursor, file_ids: list[str]) -> list[SharedFile]:
+        """
+        Same as get_shared_file_info, but retrieves multiple files at once (files which aren't found are omitted).
+        """
+        self._create_ids_table(cursor, "requested_files", file_ids)
+        cursor.execute(f"SELECT {self.FILE_COLUMNS} FROM files "
+                       "JOIN requested_files ON files.unique_id = requested_files.unique_id;")
+        return [self._file_from_row(line) for line in cursor.fetchall()]
+
+    @db_func
+    def find_files_sharing_clients(self, cursor: sqlite3.Cursor, file_ids: list[str]) -> dict[str, list[str]]:
+        """
+        Same as find_sharing_clients, but retrieves the clients of multiple files at once.
+        :return: A dictionary mapping each file's unique id to the list of the clients that share it.
+        """
+        self._create_ids_table(cursor, "requested_files", file_ids)
+        cursor.execute("select shares.file, shares.origin from shares join requested_files on "
+                       "shares.file = requested_files.unique_id")
+        sharing_clients = {}
+        for file_id, origin in cursor.fetchall():
+            sharing_clients.setdefault(file_id, []).append(origin)
+        return sharing_clients
@@ -0,0 +1,145 @@
+"""
+This module governs the way the metadata server chooses which origins of a file to hand out to downloading clients.
+Popular files might be shared by a huge amount of clients, so instead of returning all of them the server returns a
+bounded random sample, biased towards origins that are more likely to serve the downloader well. Since every downloader
+gets a different sample (in a different order), the downloading load is spread across all of the file's origins.
+Sharing clients periodically report their upload load, which lets the server direct downloaders towards idle and fast
+origins, and shield saturated ones.
+"""
+import heapq
+import random
+import time
+from threading import Lock
+from typing import Iterable, Optional
+from p2p_fileshare.framework.types import SharingClientInfo
+from p2p_fileshare.framework.messages import LoadReportMessage
+
+
+class OriginSelector(object):
+    """
+    Keeps in-memory information about the connected clients, and uses it to sample the origins of a file.
+    All methods of this class are thread safe.
+    """
+    DEFAULT_MAX_ORIGINS = 20
+    MAX_ORIGINS = 200
+    FRESHNESS_HALF_LIFE = 60  # seconds
+    MIN_WEIGHT = 0.05
+    LOAD_REPORT_TTL = 60  # seconds
+
+    def __init__(self):
+        self._last_seen = {}  # type: dict[str, float]
+        self._load_reports = {}  # type: dict[str, tuple[float, LoadReportMessage]]
+        self._lock = Lock()
+
+    def record_activity(self, client_id: str):
+        """
+        Lets the selector know we've just heard from a client.
+        """
+        with self._lock:
+            self._last_seen[client_id] = time.time()
+
+    def forget(self, client_id: str):
+        """
+        Removes all the information kept about a client (should be called once it disconnects).
+        """
+        with self._lock:
+            self._last_seen.pop(client_id, None)
+            self._load_reports.pop(client_id, None)
+
+    def record_load(self, client_id: str, load_report: LoadReportMessage):
+        """
+        Keeps the latest load report of a client.
+        """
+        with self._lock:
+            self._load_reports[client_id] = (time.time(), load_report)
+
+    def get_load(self, client_id: str) -> Optional[LoadReportMessage]:
+        """
+        :return: The latest load report of the client, or None if the client hasn't reported its load recently.
+        """
+        with self._lock:
+            return self._get_load(client_id)
+
+    def _get_load(self, client_id: str) -> Optional[LoadReportMessage]:
+        """
+        Must be called while holding the lock.
+        """
+        report_time, load_report = self._load_reports.get(client_id, (0, None))
+        if time.time() - report_time > self.LOAD_REPORT_TTL:
+            return None
+        return load_report
+
+    def _is_saturated(self, origin: SharingClientInfo) -> bool:
+        """
+        Whether the origin has recently reported it can't serve any more transfers.
+        """
+        load = self._get_load(origin.unique_id)
+        return load is not None and load.available_slots == 0
+
+    def _freshness(self, client_id: str) -> float:
+        """
+        A number between 0 and 1 which decays exponentially with the time that has passed since we last heard from the
+        client (the less fresh our information is, the less likely it is to be accurate).
+        """
+        last_seen = self._last_seen.get(client_id)
+        if last_seen is None:
+            return 0
+        return 0.5 ** ((time.time() - last_seen) / self.FRESHNESS_HALF_LIFE)
+
+    def _spare_capacity(self, origin: SharingClientInfo) -> float:
+        """
+        The fraction of the origin's upload slots which are currently free (origins that haven't reported their load are
+        assumed to be idle).
+        """
+        load = self._get_load(origin.unique_id)
+        if load is None or load.active_uploads + load.available_slots == 0:
+            return 1
+        return load.available_slots / (load.active_uploads + load.available_slots)
+
+    def _rate_per_upload(self, origin: SharingClientInfo) -> Optional[float]:
+        """
+        The upload rate each of the origin's transfers recently got, or None if it's unknown (the origin hasn't reported
+        its load, or hasn't been uploading anything).
+        """
+        load = self._get_load(origin.unique_id)
+        if load is None or load.active_uploads == 0:
+            return None
+        return load.upload_rate / load.active_uploads
+
+    def _weight(self, origin: SharingClientInfo, best_rate_per_upload: float) -> float:
+        """
+        The relative probability of an origin to be chosen.
+        :param best_rate_per_upload: The highest upload rate per transfer among the candidate origins, origins which
+        upload slower than it are less likely to be chosen.
+        """
+        weight = self._freshness(origin.unique_id) * self._spare_capacity(origin)
+        rate_per_upload = self._rate_per_upload(origin)
+        if rate_per_upload is not None and best_rate_per_upload > 0:
+            weight *= rate_per_upload / best_rate_per_upload
+        return max(weight, self.MIN_WEIGHT)
+
+    def sample(self, origins: Iterable[SharingClientInfo], max_origins: int = 0,
+               excluded_origins: Iterable[str] = ()) -> list[SharingClientInfo]:
+        """
+        Chooses a weighted random sample of the origins, without repetitions.
+        The sample is returned ordered by preference (a random order, biased towards heavier origins).
+        Saturated origins are only chosen if all the other origins are excluded.
+        :param origins: All the origins of a file.
+        :param max_origins: The maximal amount of origins to choose (0 to use the default amount).
+        :param excluded_origins: The unique IDs of origins which must not be chosen (e.g. the ones the downloader
+        already knows about).
+        """
+        max_origins = min(max_origins or self.DEFAULT_MAX_ORIGINS, self.MAX_ORIGINS)
+        excluded_origins = set(excluded_origins)
+        origins = [origin for origin in origins if origin.unique_id not in excluded_origins]
+        with self._lock:
+            available_origins = [origin for origin in origins if not self._is_saturated(origin)]
+            if available_origins:
+                origins = available_origins
+            best_rate_per_upload = max((rate for rate in map(self._rate_per_upload, origins) if rate is not None),
+                                       default=0)
+            weights = [self._weight(origin, best_rate_per_upload) for origin in origins]
+        # Weighted sampling without replacement - each origin gets the key U^(1/weight) (for a uniformly distributed U),
+        # and the origins with the largest keys are chosen.
+        keyed_origins = [(random.random() ** (1 / weight), origin) for weight, origin in zip(weights, origins)]
+        return [origin for _, origin in heapq.nlargest(max_origins, keyed_origins, key=lambda item: item[0])]
@@ -0,0 +1,106 @@
+"""
+This module contains the metadata server's search results cache.
+Popular searches are answered from memory instead of scanning the files table over and over again, while every change
+that might affect the results of a cached search (a share being added/removed, a sharing client connecting or
+disconnecting) invalidates the matching entries.
+"""
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Iterable, Optional
+
+
+class SearchCache(object):
+    """
+    An LRU cache of search results, bounded both in the amount of entries it holds and in the time each entry is valid.
+    Each key is a tuple whose first element is the searched string (the rest of the elements can be anything that
+    distinguishes between different results of the same search, such as pagination parameters).
+    All methods of this class are thread safe.
+    """
+    DEFAULT_MAX_SIZE = 1024
+    DEFAULT_TTL = 30  # seconds
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[tuple, tuple[float, Any]]
+        self._lock = Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _search_pattern(searched_string: str) -> re.Pattern:
+        """
+        Translates a searched string into a regular expression equivalent to the LIKE '%<searched string>%' clause
+        used by the DB (including its '%' and '_' wildcards), so that invalidation is precise.
+        """
+        pattern = "".join(".*" if char == "%" else "." if char == "_" else re.escape(char) for char in searched_string)
+        return re.compile(pattern, re.IGNORECASE | re.DOTALL)
+
+    @property
+    def generation(self) -> int:
+        """
+        A counter which is incremented on every invalidation.
+        It should be read before computing a result and passed to store, so that a result computed concurrently with an
+        invalidation will never be cached.
+        """
+        return self._generation
+
+    def lookup(self, key: tuple) -> Optional[Any]:
+        """
+        :return: The cached result of the search, or None if there's no valid cached result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self._ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._entries.pop(key)  # expired
+            self.misses += 1
+            return None
+
+    def store(self, key: tuple, result: Any, generation: int):
+        """
+        Caches the result of a search, evicting the least recently used entry if the cache is full.
+        :param generation: The value of the generation property before the result was computed.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return  # the result might have been invalidated while it was computed
+            self._entries[key] = (time.time(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_file_names(self, file_names: Iterable[str]):
+        """
+        Removes all the cached searches whose results might include (or should now include) one of the file names.
+        """
+        file_names = list(file_names)
+        if not file_names:
+            return
+        with self._lock:
+            self._generation += 1
+            invalid_searches = set()
+            for searched_string in {key[0] for key in self._entries}:
+                pattern = self._search_pattern(searched_string)
+                if any(pattern.search(file_name) for file_name in file_names):
+                    invalid_searches.add(searched_string)
+            for key in [key for key in self._entries if key[0] in invalid_searches]:
+                self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """
+        Counters that can be used to size the cache properly.
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self._max_size}
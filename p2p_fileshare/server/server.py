@@ -5,8 +5,12 @@ communication channels.
 """
 import socket
 import logging
+from threading import Event
 from p2p_fileshare.server.channel import ClientChannel
 from p2p_fileshare.server.db_manager import DBManager
+from p2p_fileshare.server.search_cache import SearchCache
+from p2p_fileshare.server.origin_selection import OriginSelector
+from p2p_fileshare.server.subscriptions import SubscriptionManager
 from p2p_fileshare.framework.channel import Channel
 from p2p_fileshare.framework.server import Server
 
@@ -19,13 +23,23 @@ class MetadataServer(Server):
     This class takes care of the server's core logic - accepting new clients and starting an appropriate ClientChannel
     for them.
     """
-    def __init__(self, port=0, db_path=None):
+    def __init__(self, port=0, db_path=None, search_cache_size=SearchCache.DEFAULT_MAX_SIZE,
+                 search_cache_ttl=SearchCache.DEFAULT_TTL):
         super().__init__(port)
         self._db = DBManager(db_path)
+        self._search_cache = SearchCache(search_cache_size, search_cache_ttl)
+        self._origin_selector = OriginSelector()
+        self._subscription_manager = SubscriptionManager()
+        self._stopping = Event()
 
     def _receive_new_client(self, client: socket.socket, client_address: tuple[str, int], finished_socket: socket.socket):
         new_channel = Channel(client)
-        return ClientChannel(new_channel, self._db, self.get_all_clients_info, finished_socket)
+        return ClientChannel(new_channel, self._db, self.get_all_clients_info, finished_socket, self._search_cache,
+                             self._origin_selector, self._subscription_manager, self._stopping)
+
+    def stop(self):
+        self._stopping.set()
+        super().stop()
 
     def _remove_old_clients(self):
         """
@@ -40,4 +54,8 @@ class MetadataServer(Server):
             self._communication_channels.remove(item)
 
     def get_all_clients_info(self):
-        return [channel.get_client_connection_info() for channel in self._items]
+        return [channel.get_client_connection_info() for channel in self._items if channel.is_connected]
+
+    @property
+    def search_cache_stats(self) -> dict[str, int]:
+        return self._search_cache.stats
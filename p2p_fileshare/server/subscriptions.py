@@ -0,0 +1,141 @@
+"""
+This module contains the subscriptions of downloading clients to changes in the origins of files.
+Instead of polling the server for the sharing information of a file over and over again during its download, a
+downloader subscribes to the file once, and the server pushes an OriginsUpdateMessage to it whenever an origin of the
+file is added (a client starts sharing it / connects) or removed (a client stops sharing it / disconnects).
+Updates are queued by the thread of the client that caused them, and sent by the thread of each subscriber, so a slow
+subscriber never blocks the other clients.
+"""
+from logging import getLogger
+from threading import Lock
+from typing import Iterable
+from collections import deque
+from p2p_fileshare.framework.channel import Channel
+from p2p_fileshare.framework.messages import OriginsUpdateMessage
+from p2p_fileshare.framework.types import SharingClientInfo
+from p2p_fileshare.framework.selectable_event import generate_socket_pair, signal
+
+
+logger = getLogger(__file__)
+
+
+class Subscriber(object):
+    """
+    The queue of origin updates waiting to be sent to a subscribed client.
+    The subscriber is selectable, and becomes readable once there are pending updates (which should then be sent by
+    the client's own thread via send_pending_updates).
+    All methods of this class are thread safe.
+    """
+    MAX_PENDING_UPDATES = 10000
+
+    def __init__(self, channel: Channel):
+        self._channel = channel
+        self._pending_updates = deque()  # type: deque[OriginsUpdateMessage]
+        self._event_provider, self._event_consumer = generate_socket_pair()
+        self._is_signaled = False
+        self._is_closed = False
+        self._lock = Lock()
+
+    def push(self, update: OriginsUpdateMessage):
+        """
+        Queues an update to be sent to the client.
+        """
+        with self._lock:
+            if self._is_closed:
+                return
+            if len(self._pending_updates) >= self.MAX_PENDING_UPDATES:
+                logger.warning("A subscriber isn't receiving its origin updates, dropping an update")
+                return
+            self._pending_updates.append(update)
+            # the event is signaled once until it is consumed, so the event sockets never fill up
+            if not self._is_signaled:
+                self._is_signaled = True
+                signal(self._event_provider)
+
+    def send_pending_updates(self):
+        """
+        Sends all the queued updates to the client, should only be called once the subscriber is readable.
+        """
+        with self._lock:
+            if self._is_signaled:
+                self._event_consumer.recv(1)
+                self._is_signaled = False
+            updates = list(self._pending_updates)
+            self._pending_updates.clear()
+        for update in updates:
+            try:
+                self._channel.send_message(update)
+            except Exception as e:
+                # the subscriber has probably disconnected, its subscriptions will be removed by its own thread
+                logger.debug(f"Failed pushing origins update: {e}")
+                return
+
+    def close(self):
+        with self._lock:
+            self._is_closed = True
+            self._pending_updates.clear()
+            self._event_provider.close()
+            self._event_consumer.close()
+
+    def fileno(self):
+        return self._event_consumer.fileno()
+
+
+class SubscriptionManager(object):
+    """
+    Maps each file to the clients subscribed to changes in its origins.
+    All methods of this class are thread safe.
+    """
+    MAX_SUBSCRIPTIONS_PER_CLIENT = 1000
+
+    def __init__(self):
+        self._subscribers = {}  # type: dict[str, set[Subscriber]]
+        self._subscriptions = {}  # type: dict[Subscriber, set[str]]
+        self._lock = Lock()
+
+    def subscribe(self, file_unique_id: str, subscriber: Subscriber) -> bool:
+        """
+        :return: Whether the subscription was added (a client can't exceed MAX_SUBSCRIPTIONS_PER_CLIENT).
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(subscriber, set())
+            if file_unique_id not in subscriptions and len(subscriptions) >= self.MAX_SUBSCRIPTIONS_PER_CLIENT:
+                return False
+            subscriptions.add(file_unique_id)
+            self._subscribers.setdefault(file_unique_id, set()).add(subscriber)
+            return True
+
+    def unsubscribe(self, file_unique_id: str, subscriber: Subscriber):
+        with self._lock:
+            self._subscriptions.get(subscriber, set()).discard(file_unique_id)
+            subscribers = self._subscribers.get(file_unique_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(file_unique_id, None)
+
+    def unsubscribe_all(self, subscriber: Subscriber):
+        """
+        Removes all the subscriptions of a client (should be called once it disconnects).
+        """
+        with self._lock:
+            for file_unique_id in self._subscriptions.pop(subscriber, set()):
+                subscribers = self._subscribers[file_unique_id]
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(file_unique_id)
+
+    def publish(self, file_unique_ids: Iterable[str], added_origins: list[SharingClientInfo] = None,
+                removed_origins: list[str] = None):
+        """
+        Queues an OriginsUpdateMessage to the subscribers of each of the files.
+        :param file_unique_ids: The files whose origins have changed.
+        :param added_origins: The origins that were added to all of the files.
+        :param removed_origins: The unique IDs of the origins that were removed from all of the files.
+        """
+        with self._lock:
+            notifications = [(file_unique_id, list(self._subscribers[file_unique_id]))
+                             for file_unique_id in file_unique_ids if file_unique_id in self._subscribers]
+        for file_unique_id, subscribers in notifications:
+            update = OriginsUpdateMessage(file_unique_id, added_origins or [], removed_origins or [])
+            for subscriber in subscribers:
+                subscriber.push(update)
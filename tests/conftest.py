@@ -10,7 +10,6 @@ from p2p_fileshare.client.files_manager import FilesManager
 from p2p_fileshare.framework.channel import Channel
 
 
-DEFAULT_PORT = '1337'
 LOCAL_HOST = '127.0.0.1'
 FIRST_USERNAME = 'first_username'
 SECOND_USERNAME = 'second_username'
@@ -31,7 +30,7 @@ def metadata_server() -> MetadataServer:
     """
     random_db_name = generate_random_name(5)
     from threading import Thread
-    server = MetadataServer(int(DEFAULT_PORT), db_path=random_db_name)
+    server = MetadataServer(0, db_path=random_db_name)  # listen on a free port, so that test runs can't collide
     server_thread = Thread(target=server.main_loop)
     server_thread.start()
     try:
@@ -40,39 +39,47 @@ def metadata_server() -> MetadataServer:
         server.stop()
         server_thread.join(2)  # wait 2 seconds for the server to close nicely
         unlink(random_db_name)  # cleanup our DB
+        _unlink_if_exists(f"{random_db_name}.lock")
+
+
+def _unlink_if_exists(path: str):
+    if os.path.exists(path):
+        unlink(path)
 
 
 @contextmanager
-def client(username: str) -> FilesManager:
+def client(username: str, server: MetadataServer) -> FilesManager:
     """
     Creates a FilesManager object with an underlying client channel.
     :param username: The username to be used for the client this FilesManager represents.
+    :param server: The metadata server the client connects to.
     """
     try:
-        command_line = [None, LOCAL_HOST, DEFAULT_PORT, username]
+        command_line = [None, LOCAL_HOST, str(server.port), username]
         files_manager = initialize_files_manager(command_line)
         yield files_manager
     finally:
         db_path = FilesManager.generate_db_path(username)
         os.unlink(db_path)
+        _unlink_if_exists(f"{db_path}.lock")
         os.unlink(client_id_path(username))
 
 
 @fixture(scope='function')
-def first_client():
-    with client(FIRST_USERNAME) as c:
+def first_client(metadata_server):
+    with client(FIRST_USERNAME, metadata_server) as c:
         yield c
 
 
 @fixture(scope='function')
-def second_client():
-    with client(SECOND_USERNAME) as c:
+def second_client(metadata_server):
+    with client(SECOND_USERNAME, metadata_server) as c:
         yield c
 
 
 @fixture(scope='function')
-def third_client():
-    with client(THIRD_USERNAME) as c:
+def third_client(metadata_server):
+    with client(THIRD_USERNAME, metadata_server) as c:
         yield c
 
 
@@ -0,0 +1,92 @@
+from p2p_fileshare.framework.bandwidth import BandwidthLimiter
+from p2p_fileshare.framework.channel import Channel
+from p2p_fileshare.framework.messages import ChunkDataResponseMessage
+from threading import Thread
+import socket
+import time
+import pytest
+
+
+def test_unlimited_limiter_does_not_wait():
+    limiter = BandwidthLimiter()
+    start_time = time.monotonic()
+    assert limiter.consume(100 * 1024 * 1024) == 0
+    assert time.monotonic() - start_time < 0.1
+
+
+def test_rate_is_limited():
+    limiter = BandwidthLimiter(100000)
+    start_time = time.monotonic()
+    for _ in range(5):
+        limiter.consume(20000)
+    elapsed = time.monotonic() - start_time
+    assert 0.8 <= elapsed < 2
+
+
+def test_bandwidth_is_split_by_weights():
+    """
+    Let two consumers compete for the bandwidth, and make sure the consumer whose weight is 3 times as large gets about
+    3 times as much of it.
+    """
+    limiter = BandwidthLimiter(400000)
+    consumed = {1: 0, 3: 0}
+    deadline = time.monotonic() + 2
+
+    def consume(weight: int):
+        while time.monotonic() < deadline:
+            limiter.consume(10000, weight)
+            consumed[weight] += 10000
+
+    consumers = [Thread(target=consume, args=(weight,)) for weight in consumed]
+    for consumer in consumers:
+        consumer.start()
+    for consumer in consumers:
+        consumer.join(5)
+    assert 2 <= consumed[3] / consumed[1] <= 4.5
+    assert consumed[1] + consumed[3] <= 400000 * 2.5
+
+
+def test_removing_the_limit_releases_waiters():
+    limiter = BandwidthLimiter(1000)
+    waiter = Thread(target=limiter.consume, args=(1000000,))
+    waiter.start()
+    time.sleep(0.2)
+    assert waiter.is_alive()
+    limiter.set_rate(0)
+    waiter.join(1)
+    assert not waiter.is_alive()
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        BandwidthLimiter().set_rate(-1)
+    with pytest.raises(ValueError):
+        BandwidthLimiter(1000).consume(10, weight=0)
+
+
+@pytest.mark.parametrize('limited_side', ['send', 'recv'])
+def test_limited_channel(limited_side: str):
+    """
+    Transfer a message through a channel whose sending or receiving is limited, and make sure it takes about as long as
+    the limit allows - and that the time spent waiting for the limiter doesn't count towards the receive timeout.
+    """
+    limiter = BandwidthLimiter(200000)
+    message = ChunkDataResponseMessage('a' * 32, 0, b'a' * 200000)
+    sender_socket, receiver_socket = socket.socketpair()
+    if limited_side == 'send':
+        sender, receiver = Channel(sender_socket, send_limiter=limiter), Channel(receiver_socket)
+        timeout = 5
+    else:
+        sender, receiver = Channel(sender_socket), Channel(receiver_socket, recv_limiter=limiter)
+        timeout = 0.5
+    try:
+        start_time = time.monotonic()
+        send_thread = Thread(target=sender.send_message, args=(message,))
+        send_thread.start()
+        received_message = receiver.recv_message(timeout)
+        send_thread.join(5)
+        assert received_message.data == message.data
+        assert 0.8 <= time.monotonic() - start_time < 3
+    finally:
+        sender.close()
+        receiver.close()
@@ -0,0 +1,51 @@
+from p2p_fileshare.framework.buffer_pool import BufferPool
+from threading import Thread
+import time
+
+
+def test_buffers_are_reused():
+    pool = BufferPool(100)
+    buffer = pool.acquire(40)
+    assert len(buffer) == 40 and pool.used == 40
+    pool.release(buffer)
+    assert pool.used == 0 and pool.idle == 40
+    assert pool.acquire(40) is buffer
+    assert pool.idle == 0
+
+
+def test_budget_is_enforced():
+    """
+    Acquire buffers until the budget is used up, and make sure the next acquire waits until a buffer is released.
+    """
+    pool = BufferPool(100)
+    buffers = [pool.acquire(40), pool.acquire(40)]
+    assert pool.acquire(40, timeout=0.2) is None
+    acquired_buffers = []
+    waiter = Thread(target=lambda: acquired_buffers.append(pool.acquire(40)))
+    waiter.start()
+    time.sleep(0.2)
+    assert not acquired_buffers and pool.waiters == 1
+    pool.release(buffers.pop())
+    waiter.join(1)
+    assert acquired_buffers and pool.used == 80
+
+
+def test_idle_buffers_are_dropped_for_other_sizes():
+    pool = BufferPool(100)
+    pool.release(pool.acquire(60))
+    buffer = pool.acquire(50)
+    assert len(buffer) == 50 and pool.idle == 0 and pool.used == 50
+
+
+def test_oversized_buffer():
+    """
+    A buffer larger than the budget is only handed out when no other buffer is in use.
+    """
+    pool = BufferPool(100)
+    buffer = pool.acquire(10)
+    assert pool.acquire(200, timeout=0.1) is None
+    pool.release(buffer)
+    oversized_buffer = pool.acquire(200, timeout=0.1)
+    assert len(oversized_buffer) == 200
+    pool.release(oversized_buffer)
+    assert pool.used == 0 and pool.idle == 0
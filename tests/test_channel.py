@@ -1,4 +1,4 @@
-from p2p_fileshare.framework.messages import SearchFileMessage, ClientIdMessage
+from p2p_fileshare.framework.messages import SearchFileMessage, ClientIdMessage, FileListMessage
 from p2p_fileshare.framework.channel import Channel, TimeoutException
 from utils import assert_objects_have_same_attributes
 import pytest
@@ -38,3 +38,17 @@ def test_channel_timeout_wrong_message(channel_pair: (Channel, Channel)):
     sender.send_message(DUMMY_MSG)
     with pytest.raises(TimeoutException):
         receiver.wait_for_message(ClientIdMessage, 1)
+
+
+def test_late_response_is_not_taken_by_the_next_request(client_and_server_channels):
+    """
+    Let a request time out before its response is sent, and make sure the late response isn't returned as the response
+    to the following request.
+    """
+    client_channel, server_channel = client_and_server_channels
+    with pytest.raises(TimeoutException):
+        client_channel.send_msg_and_wait_for_response(DUMMY_MSG, timeout=0.5)
+    server_channel.recv_message(1)
+    server_channel.send_message(FileListMessage([], next_offset=1))  # the late response
+    server_channel.send_message(FileListMessage([], next_offset=2))  # the response to the following request
+    assert client_channel.send_msg_and_wait_for_response(DUMMY_MSG, timeout=1).next_offset == 2
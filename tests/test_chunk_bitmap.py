@@ -0,0 +1,107 @@
+from p2p_fileshare.framework.chunk_bitmap import ChunkBitmap
+from p2p_fileshare.framework.types import FileObject, SharedFile
+from threading import Thread
+import tempfile
+import pytest
+import os
+
+
+def test_set_and_clear():
+    bitmap = ChunkBitmap(20)
+    assert bitmap.count == 0
+    assert bitmap.set(3)
+    assert not bitmap.set(3)
+    assert bitmap.set(17)
+    assert 3 in bitmap and 17 in bitmap and 4 not in bitmap
+    assert bitmap.count == 2
+    assert list(bitmap) == [3, 17]
+    assert bitmap.clear(3)
+    assert not bitmap.clear(3)
+    assert bitmap.count == 1
+    with pytest.raises(IndexError):
+        bitmap.set(20)
+
+
+def test_serialization():
+    bitmap = ChunkBitmap(11)
+    for chunk_num in (0, 9, 10):
+        bitmap.set(chunk_num)
+    data = bitmap.to_bytes()
+    assert data == bytes([0b00000001, 0b00000110])
+    # bits beyond the amount of chunks are ignored, and so are missing bytes
+    assert list(ChunkBitmap(11, b"\x01\xff")) == [0, 8, 9, 10]
+    assert ChunkBitmap(11, b"\x01\xff").count == 4
+    assert list(ChunkBitmap(11, b"\x03")) == [0, 1]
+    assert list(ChunkBitmap(11, data)) == [0, 9, 10]
+
+
+def test_find_clear():
+    bitmap = ChunkBitmap(100, b"\xff" * 12)
+    assert bitmap.find_clear() == 96
+    assert bitmap.find_clear(97) == 97
+    bitmap.clear(5)
+    assert bitmap.find_clear() == 5
+    assert bitmap.find_clear(6) == 96
+    bitmap.set(5)
+    for chunk_num in range(96, 100):
+        bitmap.set(chunk_num)
+    assert bitmap.is_full()
+    assert bitmap.find_clear() is None
+
+
+def test_claim():
+    bitmap = ChunkBitmap(10)
+    assert bitmap.claim(8) == 8
+    assert bitmap.claim(8) == 9
+    # wraps around once the chunks from start onwards are all claimed
+    assert bitmap.claim(8) == 0
+    assert [bitmap.claim() for _ in range(8)] == [1, 2, 3, 4, 5, 6, 7, None]
+
+
+def test_claim_range():
+    bitmap = ChunkBitmap(10)
+    assert bitmap.claim(3, 5) == 3
+    assert bitmap.claim(3, 5) == 4
+    # doesn't wrap around, nor claim chunks beyond the end
+    assert bitmap.claim(3, 5) is None
+    assert bitmap.claim(8, 10) == 8
+
+
+def test_concurrent_claims():
+    amount_of_chunks = 10000
+    bitmap = ChunkBitmap(amount_of_chunks)
+    claimed = [[] for _ in range(8)]
+
+    def _claim_all(claimed_chunks):
+        chunk_num = bitmap.claim()
+        while chunk_num is not None:
+            claimed_chunks.append(chunk_num)
+            chunk_num = bitmap.claim()
+
+    threads = [Thread(target=_claim_all, args=(claimed_chunks,)) for claimed_chunks in claimed]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    all_claimed = sum(claimed, [])
+    assert sorted(all_claimed) == list(range(amount_of_chunks))
+    assert bitmap.count == amount_of_chunks
+
+
+def test_file_object_claims_chunks(monkeypatch):
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 10)
+    with tempfile.TemporaryDirectory() as download_dir:
+        shared_file = SharedFile('a' * 32, 'downloaded_file', 0, 95, [])
+        with FileObject(os.path.join(download_dir, 'downloaded_file'), shared_file) as file_object:
+            file_object.mark_downloaded([0, 2])
+            assert file_object.amount_of_downloaded_chunks == 2
+            assert file_object.get_empty_chunk() == 1
+            assert file_object.get_empty_chunk() == 3
+            file_object.return_failed_chunk(1)
+            assert file_object.get_empty_chunk() == 1
+            # returning a chunk which was downloaded meanwhile doesn't make it empty again
+            file_object.mark_downloaded([1])
+            file_object.return_failed_chunk(1)
+            assert file_object.get_empty_chunk() == 4
+            assert file_object.downloaded_chunks == {0, 1, 2}
+            assert file_object.serialize_downloaded_chunks() == bytes([0b111, 0])
@@ -0,0 +1,115 @@
+from p2p_fileshare.client.chunk_writer import ChunkWriter, ChunkWriterException
+from p2p_fileshare.framework.types import FileObject, SharedFile
+from threading import Event
+import tempfile
+import pytest
+import time
+import os
+
+
+CHUNK_SIZE = 1024
+AMOUNT_OF_CHUNKS = 10
+FILE_SIZE = CHUNK_SIZE * (AMOUNT_OF_CHUNKS - 1) + 100  # the last chunk is partial
+
+
+@pytest.fixture
+def file_object(monkeypatch):
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', CHUNK_SIZE)
+    with tempfile.TemporaryDirectory() as download_dir:
+        shared_file = SharedFile('a' * 32, 'downloaded_file', 0, FILE_SIZE, [])
+        file_object = FileObject(os.path.join(download_dir, 'downloaded_file'), shared_file)
+        yield file_object
+        file_object.close()
+
+
+def _file_data(file_object: FileObject) -> bytes:
+    return b"".join(file_object.read_chunk(chunk_num) for chunk_num in range(file_object.amount_of_chunks))
+
+
+def test_chunks_are_coalesced(file_object: FileObject, monkeypatch):
+    data = os.urandom(FILE_SIZE)
+    writes = []
+    original_write_chunks = FileObject.write_chunks
+
+    def _write_chunks(self, first_chunk_num, chunks_data):
+        writes.append((first_chunk_num, len(chunks_data)))
+        original_write_chunks(self, first_chunk_num, chunks_data)
+
+    monkeypatch.setattr(FileObject, 'write_chunks', _write_chunks)
+    blocked = Event()
+    original_sync = FileObject.sync
+    # block the writer on its first batch, so that the rest of the chunks pile up in its queue
+    monkeypatch.setattr(FileObject, 'sync', lambda self: blocked.wait() and original_sync(self))
+
+    writer = ChunkWriter(file_object, max_queued_chunks=AMOUNT_OF_CHUNKS, fsync_interval=0)
+    writer.put(0, data[:CHUNK_SIZE])
+    time.sleep(0.5)
+    for chunk_num in [5, 2, 1, 3, 9, 6]:
+        writer.put(chunk_num, data[chunk_num * CHUNK_SIZE: (chunk_num + 1) * CHUNK_SIZE])
+    blocked.set()
+    writer.close()
+    assert writes == [(0, CHUNK_SIZE), (1, 3 * CHUNK_SIZE), (5, 2 * CHUNK_SIZE), (9, 100)]
+    assert file_object.downloaded_chunks == {0, 1, 2, 3, 5, 6, 9}
+    assert _file_data(file_object)[5 * CHUNK_SIZE:7 * CHUNK_SIZE] == data[5 * CHUNK_SIZE:7 * CHUNK_SIZE]
+
+
+def test_chunks_are_marked_once_durable(file_object: FileObject):
+    data = os.urandom(FILE_SIZE)
+    writer = ChunkWriter(file_object, fsync_interval=60)
+    for chunk_num in range(AMOUNT_OF_CHUNKS):
+        writer.put(chunk_num, data[chunk_num * CHUNK_SIZE: (chunk_num + 1) * CHUNK_SIZE])
+    time.sleep(0.5)
+    # the chunks were written, but the file wasn't synced yet
+    assert file_object.downloaded_chunks == set()
+    writer.close()
+    assert not file_object.has_empty_chunks()
+    assert _file_data(file_object) == data
+
+
+def test_backpressure(file_object: FileObject, monkeypatch):
+    blocked = Event()
+    monkeypatch.setattr(FileObject, 'write_chunks', lambda *args: blocked.wait())
+    writer = ChunkWriter(file_object, max_queued_chunks=2, fsync_interval=None)
+    writer.put(0, bytes(CHUNK_SIZE))  # taken by the writer, which is now blocked
+    time.sleep(0.5)
+    writer.put(1, bytes(CHUNK_SIZE))
+    writer.put(2, bytes(CHUNK_SIZE))
+    with pytest.raises(ChunkWriterException):
+        writer.put(3, bytes(CHUNK_SIZE), timeout=0.5)
+    blocked.set()
+    writer.close()
+    assert file_object.downloaded_chunks == {0, 1, 2}
+
+
+def test_write_errors_are_reported(file_object: FileObject, monkeypatch):
+    def _write_chunks(*args):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(FileObject, 'write_chunks', _write_chunks)
+    writer = ChunkWriter(file_object, fsync_interval=None)
+    writer.put(0, bytes(CHUNK_SIZE))
+    time.sleep(0.5)
+    assert isinstance(writer.error, OSError)
+    with pytest.raises(ChunkWriterException):
+        writer.put(1, bytes(CHUNK_SIZE))
+    writer.close()
+    assert file_object.downloaded_chunks == set()
+
+
+def test_close_after_crash(file_object: FileObject, monkeypatch):
+    """
+    Closing the writer must not hang once its thread has died, even if its queue is full.
+    """
+    blocked = Event()
+
+    def _next_batch(self):
+        blocked.wait()
+        raise RuntimeError("crashed")
+
+    monkeypatch.setattr(ChunkWriter, '_next_batch', _next_batch)
+    writer = ChunkWriter(file_object, max_queued_chunks=1, fsync_interval=None)
+    writer.put(0, bytes(CHUNK_SIZE))
+    blocked.set()
+    time.sleep(0.5)
+    assert isinstance(writer.error, RuntimeError)
+    writer.close()
@@ -0,0 +1,84 @@
+from p2p_fileshare.client.download_manager import DownloadManager
+from p2p_fileshare.client.file_transfer import ChunkDownloadSlots
+from p2p_fileshare.framework.types import SharingClientInfo
+from unittest.mock import Mock
+
+
+class FakeDownloader(object):
+    """
+    Stands for a FileDownloader whose download ends once the test calls finish (pausing and stopping it stops it right
+    away, while the manager's lock is held, so the manager isn't called back).
+    """
+    def __init__(self, download_manager: DownloadManager, priority: float = 1):
+        self._download_manager = download_manager
+        self.priority = priority
+        self.file_info = Mock()
+        self.local_path = 'local_path'
+        self.is_running = False
+        self.is_paused = False
+        self.done = False
+
+    def start(self):
+        self.is_running = True
+        self.is_paused = False
+
+    def pause(self):
+        self.is_paused = True
+        self.is_running = False
+
+    def stop(self):
+        self.done = True
+        self.is_running = False
+
+    def finish(self):
+        self.is_running = False
+        self._download_manager.download_stopped(self)
+
+    def is_done(self):
+        return self.done
+
+
+def _add_downloads(download_manager: DownloadManager, priorities: list[float]) -> list[FakeDownloader]:
+    downloads = [FakeDownloader(download_manager, priority) for priority in priorities]
+    for download in downloads:
+        download_manager.add_download(download)
+    return downloads
+
+
+def test_downloads_are_queued_by_priority():
+    download_manager = DownloadManager(max_active_downloads=2)
+    downloads = _add_downloads(download_manager, [1, 1, 1, 3])
+    assert [download.is_running for download in downloads] == [True, True, False, False]
+    assert [download_manager.queue_position(download) for download in downloads] == [None, None, 1, 0]
+    downloads[0].finish()
+    assert downloads[3].is_running and not downloads[2].is_running
+    download_manager.set_priority(2, 0.5)
+    _add_downloads(download_manager, [1])
+    assert download_manager.queue_position(downloads[2]) == 1
+    download_manager.remove_download(1)
+    assert downloads[1].done and not downloads[2].is_running
+
+
+def test_downloads_are_paused_and_resumed():
+    download_manager = DownloadManager(max_active_downloads=1)
+    downloads = _add_downloads(download_manager, [1, 1])
+    download_manager.pause_download(0)
+    assert downloads[0].is_paused and downloads[1].is_running
+    assert download_manager.queue_position(downloads[0]) is None
+    download_manager.resume_download(0)
+    assert download_manager.queue_position(downloads[0]) == 0
+    downloads[1].finish()
+    assert downloads[0].is_running and not downloads[0].is_paused
+
+
+def test_chunk_download_slots():
+    slots = ChunkDownloadSlots(max_chunk_downloads=3, max_peer_sessions=2)
+    first_origin = SharingClientInfo('a' * 32, ('1.1.1.1', 1))
+    second_origin = SharingClientInfo('b' * 32, ('2.2.2.2', 2))
+    assert slots.try_acquire(first_origin) and slots.try_acquire(first_origin)
+    assert not slots.is_peer_available(first_origin) and not slots.try_acquire(first_origin)
+    assert slots.try_acquire(second_origin)
+    assert not slots.has_free_slot() and not slots.try_acquire(second_origin)
+    slots.release(first_origin)
+    assert slots.try_acquire(second_origin)
+    assert slots.chunk_downloads == 3
@@ -1,22 +1,36 @@
 from p2p_fileshare.client.files_manager import FilesManager
 from p2p_fileshare.server.server import MetadataServer
-from p2p_fileshare.client.file_transfer import FileDownloader
-from p2p_fileshare.framework.types import SharedFile
+from p2p_fileshare.client.file_transfer import FileDownloader, ChunkDownloader
+from p2p_fileshare.client import file_share
+from p2p_fileshare.client.download_manager import DownloadManager
+from p2p_fileshare.framework.types import SharedFile, FileObject
+from p2p_fileshare.framework.storage import FileStorage
+from p2p_fileshare.framework.chunk_bitmap import ChunkBitmap
+from p2p_fileshare.framework.channel import Channel, BusyException
+from p2p_fileshare.framework.messages import StartFileTransferMessage, BusyMessage
+from conftest import LOCAL_HOST
 from utils import LogStashHandler
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 from unittest.mock import Mock
 import tempfile
 import os
+import socket
 import time
 import logging
+import pytest
+
+
+DOWNLOAD_TIMEOUT = 60
 
 
 @contextmanager
-def closed_temporary_file() -> tempfile.TemporaryFile:
+def closed_temporary_file() -> tempfile.NamedTemporaryFile:
     """
     :return: A closed temporary file which is guaranteed to exist and to be deleted once the context manager exits.
     """
-    with tempfile.TemporaryFile(delete=False) as tf:
+    with tempfile.NamedTemporaryFile(delete=False) as tf:
         tf.close()
         try:
             yield tf
@@ -24,6 +38,13 @@ def closed_temporary_file() -> tempfile.TemporaryFile:
             os.unlink(tf.name)
 
 
+def _wait_for_download(download: FileDownloader):
+    """
+    Waits for the download to finish and to release everything it uses (fails the test if it takes too long).
+    """
+    assert download.join(DOWNLOAD_TIMEOUT), "The download hasn't finished in time"
+
+
 @contextmanager
 def _prepare_for_download(first_client: FilesManager, second_client: FilesManager) -> (SharedFile,
                                                                                        tempfile._TemporaryFileWrapper,
@@ -89,10 +110,7 @@ def test_simple_file_transfer(metadata_server: MetadataServer, first_client: Fil
         requested_file, second_client_file, file_data = params
         second_client.download_file(requested_file.unique_id, second_client_file.name)
         download = second_client.list_downloads()[0]
-        while not download.is_done():
-            continue
-        # Sleeping to let the downloader close everything
-        time.sleep(3)
+        _wait_for_download(download)
         assert not download.failed, "Download failed!"
         with open(second_client_file.name, 'rb') as f:
             second_data = f.read()
@@ -110,10 +128,7 @@ def test_double_origin_file_transfer(metadata_server: MetadataServer, first_clie
         requested_file, third_client_file, file_data = params
         third_client.download_file(requested_file.unique_id, third_client_file.name)
         download = third_client.list_downloads()[0]
-        while not download.is_done():
-            continue
-        # Sleeping to let the downloader close everything
-        time.sleep(3)
+        _wait_for_download(download)
         assert not download.failed, "Download failed!"
         assert len(download._origins_stats) == 2, "Failed getting both origins"
         with open(third_client_file.name, 'rb') as f:
@@ -163,7 +178,483 @@ def test_transfer_timeout(metadata_server: MetadataServer, first_client: FilesMa
         start_time = time.time()
         # Give the FileDownloader 3 more seconds to avoid a race condition
         while not download.is_done() and time.time() - start_time < FileDownloader.CHUNK_TIMEOUT + 3:
-            continue
+            time.sleep(0.1)
 
     # Make sure a timeout has occurred by viewing the logs of file_transfer.py
     assert any(["due to timeout" in record.msg for record in log_stash.logs])
+
+
+def test_batch_file_transfer(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager):
+    """
+    Share two files via the first client, and download both of them via the second client using a single sharing info
+    request.
+    """
+    with closed_temporary_file() as first_shared_file, closed_temporary_file() as second_shared_file:
+        files_data = [os.urandom(3000), os.urandom(4000)]
+        for shared_file, file_data in zip([first_shared_file, second_shared_file], files_data):
+            with open(shared_file.name, 'wb') as f:
+                f.write(file_data)
+        first_client.share_files([first_shared_file.name, second_shared_file.name])
+        time.sleep(1)  # wait a bit so that the server will update its DB
+        requested_files = [second_client.search_file(os.path.basename(shared_file.name))[0]
+                           for shared_file in [first_shared_file, second_shared_file]]
+        with closed_temporary_file() as first_output, closed_temporary_file() as second_output:
+            second_client.download_files([(requested_files[0].unique_id, first_output.name),
+                                          (requested_files[1].unique_id, second_output.name)])
+            downloads = second_client.list_downloads()
+            assert len(downloads) == 2
+            for download in downloads:
+                _wait_for_download(download)
+            for download, output, file_data in zip(downloads, [first_output, second_output], files_data):
+                assert not download.failed, "Download failed!"
+                with open(output.name, 'rb') as f:
+                    assert f.read() == file_data, "File's data is different after transfer"
+
+
+def test_resume_download(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager,
+                         monkeypatch):
+    """
+    Simulate a download that was interrupted after its first chunk was written, and make sure resuming it only
+    downloads the rest of the chunks.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)  # so that the shared file would have 3 chunks
+    requested_chunks = []
+    original_chunk_downloader_init = ChunkDownloader.__init__
+
+    def _chunk_downloader_init(self, file_id, origin, file_object, chunk_writer, chunk_num, *args):
+        requested_chunks.append(chunk_num)
+        original_chunk_downloader_init(self, file_id, origin, file_object, chunk_writer, chunk_num, *args)
+
+    monkeypatch.setattr(ChunkDownloader, '__init__', _chunk_downloader_init)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        with open(second_client_file.name, 'wb') as f:
+            f.write(file_data[:1024] + bytes(len(file_data) - 1024))
+        second_client._local_db.add_download(requested_file, second_client_file.name)
+        second_client._local_db.update_download(requested_file.unique_id, second_client_file.name, bytes([0b001]))
+
+        second_client.resume_downloads()
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        assert sorted(requested_chunks) == [1, 2]
+        assert second_client._local_db.list_downloads() == []
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data, "File's data is different after resuming the download"
+
+
+def test_corrupted_resumed_chunk_is_downloaded_again(metadata_server: MetadataServer, first_client: FilesManager,
+                                                     second_client: FilesManager, monkeypatch):
+    """
+    A chunk that was corrupted on the disk while the download was interrupted must be verified and downloaded again.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        with open(second_client_file.name, 'wb') as f:
+            f.write(os.urandom(1024) + bytes(len(file_data) - 1024))
+        second_client._local_db.add_download(requested_file, second_client_file.name)
+        second_client._local_db.update_download(requested_file.unique_id, second_client_file.name, bytes([0b001]))
+
+        second_client.resume_downloads()
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        assert second_client._local_db.list_downloads() == []
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data, "The corrupted chunk wasn't downloaded again"
+
+
+def test_corrupted_download_fails(metadata_server: MetadataServer, first_client: FilesManager,
+                                  second_client: FilesManager, monkeypatch):
+    """
+    Without chunk hashes, a corrupted chunk is only detected once the whole file is verified - so the download must
+    fail rather than end with corrupted data.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)
+    monkeypatch.setattr(FileDownloader, 'MAX_CHUNK_HASHES_ATTEMPTS', 0)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        with open(second_client_file.name, 'wb') as f:
+            f.write(os.urandom(1024) + bytes(len(file_data) - 1024))
+        second_client._local_db.add_download(requested_file, second_client_file.name)
+        second_client._local_db.update_download(requested_file.unique_id, second_client_file.name, bytes([0b001]))
+
+        second_client.resume_downloads()
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert download.failed
+        assert second_client._local_db.list_downloads() == []
+
+
+def test_download_without_chunk_hashes(metadata_server: MetadataServer, first_client: FilesManager,
+                                       second_client: FilesManager, monkeypatch):
+    """
+    When no one supplies valid chunk hashes, the download should still complete (verifying only the whole file).
+    """
+    def _set_chunk_hashes(self, chunk_hashes):
+        raise ValueError("Invalid chunk hashes")
+
+    monkeypatch.setattr(FileObject, 'set_chunk_hashes', _set_chunk_hashes)
+    monkeypatch.setattr(FileDownloader, 'MAX_CHUNK_HASHES_ATTEMPTS', 2)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_write_failure_fails_download(metadata_server: MetadataServer, first_client: FilesManager,
+                                      second_client: FilesManager, monkeypatch):
+    """
+    Once the downloaded chunks can't be written, the download should fail instead of retrying them forever.
+    """
+    def _write_chunks(*args):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(FileObject, 'write_chunks', _write_chunks)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, _ = params
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert download.failed
+
+
+def _request_chunk(share_port: int, file_id: str, chunk_num: int) -> bytes:
+    s = socket.socket()
+    s.connect((LOCAL_HOST, share_port))
+    channel = Channel(s)
+    try:
+        return channel.send_msg_and_wait_for_response(StartFileTransferMessage(file_id, chunk_num)).data
+    finally:
+        channel.close()
+
+
+def test_upload_slots_are_enforced(metadata_server: MetadataServer, first_client: FilesManager, monkeypatch):
+    """
+    Take all of the sharing server's upload slots, and make sure chunk requests wait in the upload queue until a slot
+    is released, and that the downloader is told the client is busy once the queue is full (or the wait is too long).
+    """
+    monkeypatch.setattr(file_share.UploadStatistics, 'MAX_QUEUE_WAIT', 1)
+    with closed_temporary_file() as shared_file:
+        data = os.urandom(3000)
+        with open(shared_file.name, 'wb') as f:
+            f.write(data)
+        first_client.share_file(shared_file.name)
+        file_id = FilesManager._calculate_file_hash(shared_file.name)
+        file_share_server = first_client._file_share_server
+        upload_statistics = file_share_server._upload_statistics
+        monkeypatch.setattr(upload_statistics, '_max_queued_uploads', 1)
+        for _ in range(file_share_server.MAX_UPLOADS):
+            assert upload_statistics.try_start_upload()
+        assert file_share_server.load_report.available_slots == 0
+        with pytest.raises(BusyException):
+            _request_chunk(file_share_server.sharing_port, file_id, 0)  # no slot is released while it's queued
+        with ThreadPoolExecutor(1) as executor:
+            queued_request = executor.submit(_request_chunk, file_share_server.sharing_port, file_id, 0)
+            time.sleep(0.3)  # wait for the request to be queued
+            with pytest.raises(BusyException):
+                _request_chunk(file_share_server.sharing_port, file_id, 0)  # the queue is full
+            upload_statistics.upload_finished(0)
+            assert queued_request.result() == data[:FileObject.CHUNK_SIZE]
+
+
+def test_upload_queue_is_fair(monkeypatch):
+    """
+    Queue two uploads of one downloader and then an upload of another, and make sure the freed slots are handed out to
+    the downloaders in turns.
+    """
+    monkeypatch.setattr(file_share.UploadStatistics, 'MAX_QUEUE_WAIT', 10)
+    upload_statistics = file_share.UploadStatistics(1, 10)
+    assert upload_statistics.try_start_upload()
+    started_uploads = []
+
+    def _upload(downloader: str):
+        assert upload_statistics.start_upload(downloader)
+        started_uploads.append(downloader)
+
+    threads = []
+    for downloader in ("first", "first", "second"):
+        threads.append(Thread(target=_upload, args=(downloader,)))
+        threads[-1].start()
+        time.sleep(0.1)  # make sure the uploads are queued in order
+    for amount_of_uploads in range(1, len(threads) + 1):
+        upload_statistics.upload_finished(0)
+        while len(started_uploads) < amount_of_uploads:
+            time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert started_uploads == ["first", "second", "first"]
+
+
+def test_busy_origin_is_not_failed(metadata_server: MetadataServer, first_client: FilesManager,
+                                   second_client: FilesManager, monkeypatch):
+    """
+    Make the sharing client respond that it's busy to more requests than the amount of failures which gets an origin
+    dropped, and make sure the download still completes from it without dropping it.
+    """
+    busy_responses = []
+    original_start_upload = file_share.start_upload
+
+    def _start_upload(channel, upload_statistics):
+        if len(busy_responses) <= FileDownloader.MAX_ORIGIN_FAILS:
+            busy_responses.append(channel)
+            channel.send_message(BusyMessage(1))
+            return False
+        return original_start_upload(channel, upload_statistics)
+
+    removed_origins = []
+    monkeypatch.setattr(file_share, 'start_upload', _start_upload)
+    monkeypatch.setattr(FileDownloader, '_remove_origin',
+                        lambda self, chunk_downloader: removed_origins.append(chunk_downloader.origin))
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        assert len(busy_responses) > FileDownloader.MAX_ORIGIN_FAILS
+        assert removed_origins == []
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_corrupted_origin(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager,
+                          third_client: FilesManager, monkeypatch):
+    """
+    Share a file via two clients, then corrupt the first client's copy of it. The third client must verify the chunks
+    it downloads and get each corrupted chunk from the second client instead.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)  # so that the shared file would have 3 chunks
+    with _prepare_for_double_origin_download(first_client, second_client, third_client) as params:
+        requested_file, third_client_file, file_data = params
+        first_client_path = first_client._local_db.get_shared_file_path(requested_file.unique_id)
+        with open(first_client_path, 'wb') as f:
+            f.write(bytes(len(file_data)))
+        third_client.download_file(requested_file.unique_id, third_client_file.name)
+        download = third_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        with open(third_client_file.name, 'rb') as f:
+            assert f.read() == file_data, "Corrupted data was written into the downloaded file"
+
+
+def test_wrong_chunk_hashes_are_rejected(metadata_server: MetadataServer, first_client: FilesManager,
+                                         second_client: FilesManager, third_client: FilesManager, monkeypatch):
+    """
+    Make the server hand out wrong chunk hashes. Once both origins send the same data of a chunk which doesn't match
+    them, the downloader must drop them and get the right hashes from one of the origins.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)
+    monkeypatch.setattr(type(metadata_server._db), 'get_chunk_hashes', lambda self, file_unique_id: os.urandom(3 * 16))
+    with _prepare_for_double_origin_download(first_client, second_client, third_client) as params:
+        requested_file, third_client_file, file_data = params
+        third_client.download_file(requested_file.unique_id, third_client_file.name)
+        download = third_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        with open(third_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_large_file_transfer(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager,
+                             monkeypatch):
+    """
+    Share and download a sparse file larger than 4 GiB, whose size and chunk numbers don't fit in 32 bits.
+    Only the data beyond the first 4 GiB is random. In order to keep the test short, the download resumes with all the
+    chunks of the first 4 GiB (which are all zeros, just like the sparse download file) marked as downloaded, so that
+    only the chunks beyond it are transferred.
+    """
+    zeros_size = 4 * 1024 ** 3
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024 * 1024)
+    monkeypatch.setattr(FileStorage, 'PREALLOCATE_BLOCKS', False)  # keep both files sparse
+    with closed_temporary_file() as first_client_file, closed_temporary_file() as second_client_file:
+        tail_data = os.urandom(2 * 1024 * 1024 + 3000)
+        file_size = zeros_size + len(tail_data)
+        with open(first_client_file.name, 'wb') as f:
+            f.truncate(file_size)
+            f.seek(zeros_size)
+            f.write(tail_data)
+        with open(second_client_file.name, 'wb') as f:
+            f.truncate(file_size)
+        first_client.share_file(first_client_file.name)
+        time.sleep(1)  # wait a bit so that the server will update its DB
+        res = second_client.search_file(os.path.basename(first_client_file.name))
+        assert len(res) == 1 and res[0].size == file_size
+        requested_file = second_client.get_sharing_info([res[0].unique_id])[0]
+        # the chunk size is scaled up, since the file has too many chunks of the default size
+        assert requested_file.chunk_size == FileObject.choose_chunk_size(file_size) > FileObject.CHUNK_SIZE
+        downloaded_chunks = ChunkBitmap(-(-file_size // requested_file.chunk_size))
+        for chunk_num in range(zeros_size // requested_file.chunk_size):
+            downloaded_chunks.set(chunk_num)
+        second_client._start_download(requested_file, second_client_file.name, downloaded_chunks.to_bytes())
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        with open(second_client_file.name, 'rb') as f:
+            f.seek(zeros_size)
+            assert f.read() == tail_data
+
+
+def test_failed_chunk_is_resumed(metadata_server: MetadataServer, first_client: FilesManager,
+                                 second_client: FilesManager, monkeypatch):
+    """
+    Make the sharing client drop the connection after sending the first block of a chunk, and make sure the chunk is
+    resumed from the end of that block rather than downloaded again from its beginning.
+    """
+    block_size = 512
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 2048)  # so that the shared file would have 2 chunks
+    monkeypatch.setattr(file_share, 'RANGE_BLOCK_SIZE', block_size)
+    requested_ranges = []
+    original_upload_range = file_share.upload_range
+
+    def _upload_range(channel, db_manager, upload_statistics, open_files, request):
+        requested_ranges.append((request.offset, request.length))
+        if len(requested_ranges) == 1:
+            sent_messages = []
+            original_send_message = channel.send_message
+
+            def _send_first_block(message):
+                if not sent_messages:
+                    sent_messages.append(message)
+                    original_send_message(message)
+
+            channel.send_message = _send_first_block  # the connection is closed once the rest is dropped
+        original_upload_range(channel, db_manager, upload_statistics, open_files, request)
+
+    monkeypatch.setattr(file_share, 'upload_range', _upload_range)
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        failed_offset, failed_length = requested_ranges[0]
+        assert (failed_offset + block_size, failed_length - block_size) in requested_ranges[1:]
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_origin_without_range_requests(metadata_server: MetadataServer, first_client: FilesManager,
+                                       second_client: FilesManager, monkeypatch):
+    """
+    Make the sharing client drop range requests the way legacy clients do, and make sure whole chunks are requested
+    from it instead.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)
+    monkeypatch.setattr(file_share, 'upload_range', lambda channel, *args: channel.close())
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        assert [origin_stats['supports_ranges'] for origin_stats in download._origins_stats.values()] == [False]
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_queued_download_is_paused_and_resumed(metadata_server: MetadataServer, first_client: FilesManager,
+                                               second_client: FilesManager):
+    """
+    Queue a download while there's no room for active downloads, pause and resume it, and make sure it's downloaded
+    once there's room for it.
+    """
+    download_manager = second_client._download_manager
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        download_manager._max_active_downloads = 0
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        download = second_client.list_downloads()[0]
+        assert second_client.get_download_queue_position(download) == 0
+        assert download.progress == 0 and not download.is_done() and not download.failed
+        second_client.pause_download(0)
+        assert download.is_paused and second_client.get_download_queue_position(download) is None
+        download_manager._max_active_downloads = DownloadManager.MAX_ACTIVE_DOWNLOADS
+        second_client.resume_download(0)
+        _wait_for_download(download)
+        assert not download.failed, "Download failed!"
+        assert download_manager.download_slots.chunk_downloads == 0
+        with open(second_client_file.name, 'rb') as f:
+            assert f.read() == file_data
+
+
+def test_streaming_download(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager,
+                            monkeypatch):
+    """
+    Read a download from its last chunk while it's queued, and make sure the read blocks until the chunk is downloaded,
+    and that the chunk is downloaded first.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)  # so that the shared file would have 3 chunks
+    claimed_chunks = []
+    claim_chunk = FileDownloader._claim_chunk
+
+    def _record_claimed_chunk(self):
+        chunk_num = claim_chunk(self)
+        if chunk_num is not None:
+            claimed_chunks.append(chunk_num)
+        return chunk_num
+
+    monkeypatch.setattr(FileDownloader, '_claim_chunk', _record_claimed_chunk)
+    download_manager = second_client._download_manager
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        download_manager._max_active_downloads = 0
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        with second_client.open_download(0, timeout=0.5) as reader:
+            reader.seek(-100, os.SEEK_END)
+            with pytest.raises(TimeoutError):
+                reader.read(100)  # the download is still queued
+            reader._timeout = DOWNLOAD_TIMEOUT
+            with ThreadPoolExecutor(1) as executor:
+                last_bytes = executor.submit(reader.read, 1000)
+                second_client.pause_download(0)
+                download_manager._max_active_downloads = DownloadManager.MAX_ACTIVE_DOWNLOADS
+                second_client.resume_download(0)
+                assert last_bytes.result(DOWNLOAD_TIMEOUT) == file_data[-100:]
+            assert claimed_chunks[0] == 2
+            reader.seek(0)
+            assert reader.read() == file_data
+        _wait_for_download(second_client.list_downloads()[0])
+
+
+def test_streaming_download_over_http(metadata_server: MetadataServer, first_client: FilesManager,
+                                      second_client: FilesManager, monkeypatch):
+    """
+    Request ranges of a download from the local web server while it's queued, and make sure the requested range is
+    downloaded first and served once it's downloaded.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', 1024)  # so that the shared file would have 3 chunks
+    monkeypatch.syspath_prepend(os.path.dirname(file_share.__file__))  # the web server imports the client's main
+    from p2p_fileshare.client import local_web_server
+    monkeypatch.setattr(local_web_server, 'files_manager', second_client)
+    web_client = local_web_server.app.test_client()
+    download_manager = second_client._download_manager
+    with _prepare_for_download(first_client, second_client) as params:
+        requested_file, second_client_file, file_data = params
+        download_manager._max_active_downloads = 0
+        second_client.download_file(requested_file.unique_id, second_client_file.name)
+        assert web_client.get('/stream/1').status_code == 404
+        assert web_client.get('/stream/0', headers={'Range': f'bytes={len(file_data)}-'}).status_code == 416
+        with ThreadPoolExecutor(1) as executor:
+            range_response = executor.submit(web_client.get, '/stream/0', headers={'Range': 'bytes=2100-2199'})
+            time.sleep(0.5)
+            downloader = second_client.list_downloads()[0]
+            assert not range_response.done()  # the download is still queued
+            assert not downloader.is_chunk_downloaded(2)
+            second_client.pause_download(0)
+            download_manager._max_active_downloads = DownloadManager.MAX_ACTIVE_DOWNLOADS
+            second_client.resume_download(0)
+            response = range_response.result(DOWNLOAD_TIMEOUT)
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes 2100-2199/{len(file_data)}'
+        assert response.data == file_data[2100:2200]
+        response = web_client.get('/stream/0')
+        assert response.status_code == 200
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.data == file_data
+        _wait_for_download(downloader)
@@ -0,0 +1,150 @@
+from p2p_fileshare.framework.hashing import calculate_file_hashes, calculate_chunk_hash, get_chunk_hash, \
+    calculate_root_hash, CHUNK_HASH_SIZE
+from p2p_fileshare.framework.types import FileObject, SharedFile
+from p2p_fileshare.framework import hashing
+from p2p_fileshare.server.db_manager import DBManager
+from p2p_fileshare.client.db_manager import DBManager as ClientDBManager
+import tempfile
+import hashlib
+import pytest
+import os
+
+
+CHUNK_SIZE = 1024
+FILE_SIZE = 3 * CHUNK_SIZE + 100
+
+
+@pytest.fixture
+def shared_data():
+    data = os.urandom(FILE_SIZE)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        file_path = os.path.join(shared_dir, 'shared_file')
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        yield file_path, data
+
+
+def test_file_hashes(shared_data):
+    file_path, data = shared_data
+    file_hash, chunk_hashes = calculate_file_hashes(file_path, CHUNK_SIZE)
+    assert file_hash == hashlib.md5(data).hexdigest()
+    assert len(chunk_hashes) == 4 * CHUNK_HASH_SIZE
+    assert get_chunk_hash(chunk_hashes, 3) == calculate_chunk_hash(data[3 * CHUNK_SIZE:])
+
+
+def test_parallel_hashing(monkeypatch):
+    """
+    The chunks are hashed in parallel, so make sure their hashes are still kept in order (also when the reading thread
+    has to wait for the pending chunks to be hashed).
+    """
+    monkeypatch.setattr(hashing, 'MAX_PENDING_HASHING_BYTES', 3 * CHUNK_SIZE)
+    chunks = [os.urandom(CHUNK_SIZE) for _ in range(50)] + [os.urandom(100)]
+    file_hash, chunk_hashes = hashing.hash_chunks(chunks)
+    assert file_hash == hashlib.md5(b"".join(chunks)).hexdigest()
+    assert chunk_hashes == b"".join(hashlib.md5(chunk_data).digest() for chunk_data in chunks)
+    assert hashing.hash_chunks(chunks, with_file_hash=False) == (None, chunk_hashes)
+
+
+def test_root_hash(shared_data):
+    file_path, data = shared_data
+    chunk_hashes = calculate_file_hashes(file_path, CHUNK_SIZE)[1]
+    first_pair = hashlib.md5(chunk_hashes[:2 * CHUNK_HASH_SIZE]).digest()
+    second_pair = hashlib.md5(chunk_hashes[2 * CHUNK_HASH_SIZE:]).digest()
+    assert calculate_root_hash(chunk_hashes) == hashlib.md5(first_pair + second_pair).hexdigest()
+    # an odd hash out is moved up as is
+    assert calculate_root_hash(chunk_hashes[:3 * CHUNK_HASH_SIZE]) == \
+        hashlib.md5(first_pair + get_chunk_hash(chunk_hashes, 2)).hexdigest()
+    assert calculate_file_hashes(file_path, CHUNK_SIZE, legacy_hash=False) == \
+        (calculate_root_hash(chunk_hashes), chunk_hashes)
+    # files which have a single chunk have the same hash either way
+    assert calculate_file_hashes(file_path, FILE_SIZE, legacy_hash=False)[0] == hashlib.md5(data).hexdigest()
+
+
+def test_hash_cache(shared_data, monkeypatch):
+    """
+    Files which haven't changed since they were hashed must not be read again, while changed files must be re-hashed.
+    """
+    file_path, data = shared_data
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', CHUNK_SIZE)
+    hash_cache = ClientDBManager(os.path.join(os.path.dirname(file_path), 'client.db'))
+    expected_hashes = calculate_file_hashes(file_path, CHUNK_SIZE)
+    assert calculate_file_hashes(file_path, CHUNK_SIZE, hash_cache) == expected_hashes
+
+    def _fail_hashing(*args, **kwargs):
+        raise AssertionError("The file was hashed again")
+
+    with monkeypatch.context() as hashing_patch:
+        hashing_patch.setattr(hashing, 'hash_chunks', _fail_hashing)
+        assert calculate_file_hashes(file_path, CHUNK_SIZE, hash_cache) == expected_hashes
+        with FileObject(file_path, is_local=True, hash_cache=hash_cache) as file_object:
+            assert file_object.get_shared_file().unique_id == expected_hashes[0]
+        # the chunk hashes depend on the chunk size, so hashes of another chunk size aren't taken from the cache
+        with pytest.raises(AssertionError):
+            calculate_file_hashes(file_path, CHUNK_SIZE * 2, hash_cache)
+
+    with open(file_path, 'ab') as f:
+        f.write(b"more data")
+    assert calculate_file_hashes(file_path, CHUNK_SIZE, hash_cache)[0] == hashlib.md5(data + b"more data").hexdigest()
+
+
+def test_chunk_verification(shared_data, monkeypatch):
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', CHUNK_SIZE)
+    file_path, data = shared_data
+    file_hash, chunk_hashes = calculate_file_hashes(file_path, CHUNK_SIZE)
+    shared_file = SharedFile(file_hash, 'shared_file', 0, FILE_SIZE, [])
+    with tempfile.TemporaryDirectory() as download_dir:
+        with FileObject(os.path.join(download_dir, 'downloaded_file'), shared_file) as file_object:
+            assert file_object.is_chunk_valid(0, b'anything'), "Any data is valid while the hashes are unknown"
+            with pytest.raises(ValueError):
+                file_object.set_chunk_hashes(chunk_hashes[:-1])
+            file_object.set_chunk_hashes(chunk_hashes)
+            assert file_object.is_chunk_valid(1, data[CHUNK_SIZE:2 * CHUNK_SIZE])
+            assert not file_object.is_chunk_valid(1, data[:CHUNK_SIZE])
+
+
+def test_resumed_chunks_are_verified(shared_data, monkeypatch):
+    """
+    Resume a download whose first two chunks were marked as downloaded, but only the first of them has the right data.
+    """
+    monkeypatch.setattr(FileObject, 'CHUNK_SIZE', CHUNK_SIZE)
+    file_path, data = shared_data
+    file_hash, chunk_hashes = calculate_file_hashes(file_path, CHUNK_SIZE)
+    shared_file = SharedFile(file_hash, 'shared_file', 0, FILE_SIZE, [])
+    with tempfile.TemporaryDirectory() as download_dir:
+        download_path = os.path.join(download_dir, 'downloaded_file')
+        with open(download_path, 'wb') as f:
+            f.write(data[:CHUNK_SIZE] + bytes(FILE_SIZE - CHUNK_SIZE))
+        with FileObject(download_path, shared_file, downloaded_chunks=bytes([0b011])) as file_object:
+            file_object.set_chunk_hashes(chunk_hashes)
+            assert file_object.verify_downloaded_chunks() == [1]
+            assert file_object.downloaded_chunks == {0}
+            assert sorted([file_object.get_empty_chunk() for _ in range(3)]) == [1, 2, 3]
+
+
+def test_server_keeps_majority_chunk_hashes():
+    """
+    The server can't tell which chunk hashes are right, so the ones reported by most of the file's origins are served.
+    """
+    shared_file = SharedFile('a' * 32, 'shared_file', 0, FILE_SIZE, [])
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = DBManager(os.path.join(db_dir, 'server.db'))
+        for origin in ['1' * 32, '2' * 32, '3' * 32]:
+            db.add_new_client(origin)
+            db.new_share(shared_file, origin)
+        assert not db.add_chunk_hashes(shared_file.unique_id, b'wrong', '4' * 32), "Only origins may report hashes"
+        assert db.add_chunk_hashes(shared_file.unique_id, b'wrong', '1' * 32)
+        assert db.get_chunk_hashes(shared_file.unique_id) == b'wrong'
+        db.add_chunk_hashes(shared_file.unique_id, b'right', '2' * 32)
+        db.add_chunk_hashes(shared_file.unique_id, b'right', '3' * 32)
+        assert db.get_chunk_hashes(shared_file.unique_id) == b'right'
+        db.remove_shares([shared_file.unique_id], '2' * 32)
+        db.remove_share(shared_file.unique_id, '3' * 32)
+        assert db.get_chunk_hashes(shared_file.unique_id) == b'wrong'
+
+
+def test_chunk_size_is_scaled():
+    assert FileObject.choose_chunk_size(0) == FileObject.CHUNK_SIZE
+    max_default_size = FileObject.CHUNK_SIZE * FileObject.MAX_AMOUNT_OF_CHUNKS
+    assert FileObject.choose_chunk_size(max_default_size) == FileObject.CHUNK_SIZE
+    assert FileObject.choose_chunk_size(max_default_size + 1) == 2 * FileObject.CHUNK_SIZE
+    assert FileObject.choose_chunk_size(2 ** 60) == FileObject.MAX_CHUNK_SIZE
@@ -4,28 +4,73 @@ import pytest
 
 
 DUMMY_UNIQUE_ID = 'a' * 32
+DUMMY_PORT = 8080
 DUMMY_NAME = 'myFile.txt'
 DUMMY_MODIFICATION_TIME = 100
 DUMMY_SIZE = 5 * 1024 * 1024  # 5 MB
 DUMMY_ORIGINS = []
 DUMMY_SHARED_FILE = SharedFile(DUMMY_UNIQUE_ID, DUMMY_NAME, DUMMY_MODIFICATION_TIME, DUMMY_SIZE, DUMMY_ORIGINS)
+DUMMY_ORIGIN = SharingClientInfo('b' * 32, ('10.0.0.1', DUMMY_PORT))
+DUMMY_OTHER_ORIGIN = SharingClientInfo('c' * 32, ('10.0.0.2', DUMMY_PORT))
+DUMMY_SHARED_FILE_WITH_ORIGINS = SharedFile(DUMMY_UNIQUE_ID, DUMMY_NAME, DUMMY_MODIFICATION_TIME, DUMMY_SIZE,
+                                            [DUMMY_ORIGIN, DUMMY_OTHER_ORIGIN])
+DUMMY_OTHER_SHARED_FILE = SharedFile('d' * 32, DUMMY_NAME, DUMMY_MODIFICATION_TIME, DUMMY_SIZE, [DUMMY_OTHER_ORIGIN])
+DUMMY_LARGE_SIZE = 300 * 1024 ** 3  # 300 GB
+DUMMY_LARGE_SHARED_FILE = SharedFile('e' * 32, DUMMY_NAME, DUMMY_MODIFICATION_TIME, DUMMY_LARGE_SIZE, [])
+DUMMY_LARGE_CHUNK_NUM = 2 ** 40
+DUMMY_SCALED_SHARED_FILE = SharedFile('f' * 32, DUMMY_NAME, DUMMY_MODIFICATION_TIME, DUMMY_LARGE_SIZE, [],
+                                      LEGACY_CHUNK_SIZE * 16)
 DUMMY_CHUNK_NUM = 15
 DUMMY_DATA = b"A" * 1024
 DUMMY_MESSAGE = "This is a message"
-DUMMY_PORT = 8080
+DUMMY_LIMIT = 20
+DUMMY_OFFSET = 40
 
 MESSAGES = [
     SearchFileMessage(DUMMY_NAME),
+    SearchFileMessage(DUMMY_NAME, DUMMY_LIMIT, DUMMY_OFFSET, SEARCH_SORT_SIZE),
+    FileListMessage([DUMMY_SHARED_FILE, DUMMY_SHARED_FILE]),
+    FileListMessage([DUMMY_SHARED_FILE], DUMMY_OFFSET),
+    FileListMessage([DUMMY_LARGE_SHARED_FILE, DUMMY_SHARED_FILE]),
+    FileListMessage([DUMMY_SCALED_SHARED_FILE, DUMMY_SHARED_FILE], DUMMY_OFFSET),
+    ShareFileMessage(DUMMY_SCALED_SHARED_FILE),
+    ShareFilesBatchMessage([DUMMY_SHARED_FILE, DUMMY_SCALED_SHARED_FILE]),
+    SharingInfoResponseMessage(DUMMY_SCALED_SHARED_FILE),
+    SharingInfoBatchResponseMessage([DUMMY_SCALED_SHARED_FILE, DUMMY_SHARED_FILE_WITH_ORIGINS]),
     ShareFileMessage(DUMMY_SHARED_FILE),
     ClientIdMessage(DUMMY_UNIQUE_ID),
+    ClientIdMessage(DUMMY_UNIQUE_ID, LEGACY_PROTOCOL_VERSION),
     SharingInfoRequestMessage(DUMMY_UNIQUE_ID),
+    SharingInfoRequestMessage(DUMMY_UNIQUE_ID, DUMMY_LIMIT, [DUMMY_ORIGIN.unique_id, DUMMY_OTHER_ORIGIN.unique_id]),
     SharingInfoResponseMessage(DUMMY_SHARED_FILE),
+    SharingInfoResponseMessage(DUMMY_SHARED_FILE_WITH_ORIGINS),
+    SharingInfoResponseMessage(DUMMY_SHARED_FILE_WITH_ORIGINS, DUMMY_LIMIT),
+    SharingInfoResponseMessage(DUMMY_LARGE_SHARED_FILE),
     StartFileTransferMessage(DUMMY_UNIQUE_ID, DUMMY_CHUNK_NUM),
     ChunkDataResponseMessage(DUMMY_UNIQUE_ID, DUMMY_CHUNK_NUM, DUMMY_DATA),
+    StartFileTransferMessage(DUMMY_UNIQUE_ID, DUMMY_LARGE_CHUNK_NUM),
+    ChunkDataResponseMessage(DUMMY_UNIQUE_ID, DUMMY_LARGE_CHUNK_NUM, DUMMY_DATA),
     GeneralSuccessMessage(DUMMY_MESSAGE),
     GeneralErrorMessage(DUMMY_MESSAGE),
     RemoveShareMessage(DUMMY_UNIQUE_ID),
-    SharePortMessage(DUMMY_PORT)
+    SharePortMessage(DUMMY_PORT),
+    ShareFilesBatchMessage([DUMMY_SHARED_FILE, DUMMY_SHARED_FILE]),
+    RemoveSharesBatchMessage([DUMMY_UNIQUE_ID, DUMMY_UNIQUE_ID]),
+    BatchStatusMessage([True, False, True, True, False, False, True, False, True]),
+    SharingInfoBatchRequestMessage([DUMMY_UNIQUE_ID, DUMMY_OTHER_SHARED_FILE.unique_id]),
+    SharingInfoBatchResponseMessage([DUMMY_SHARED_FILE_WITH_ORIGINS, DUMMY_OTHER_SHARED_FILE, DUMMY_SHARED_FILE]),
+    SharingInfoBatchResponseMessage([DUMMY_LARGE_SHARED_FILE, DUMMY_SHARED_FILE_WITH_ORIGINS]),
+    LoadReportMessage(DUMMY_LIMIT, 5 * 1024 ** 3, DUMMY_OFFSET),
+    SubscribeOriginsMessage(DUMMY_UNIQUE_ID),
+    UnsubscribeOriginsMessage(DUMMY_UNIQUE_ID),
+    OriginsUpdateMessage(DUMMY_UNIQUE_ID, [DUMMY_ORIGIN, DUMMY_OTHER_ORIGIN], [DUMMY_OTHER_ORIGIN.unique_id]),
+    PeerExchangeMessage(DUMMY_UNIQUE_ID, [DUMMY_ORIGIN, DUMMY_OTHER_ORIGIN]),
+    ChunkHashesMessage(DUMMY_UNIQUE_ID, bytes(range(48))),
+    ChunkHashesRequestMessage(DUMMY_UNIQUE_ID),
+    RangeRequestMessage(DUMMY_UNIQUE_ID, DUMMY_OFFSET, DUMMY_LIMIT),
+    RangeRequestMessage(DUMMY_UNIQUE_ID, DUMMY_LARGE_SIZE, DUMMY_LARGE_SIZE),
+    RangeDataResponseMessage(DUMMY_UNIQUE_ID, DUMMY_LARGE_SIZE, DUMMY_DATA),
+    BusyMessage(DUMMY_LIMIT)
 ]
 
 
@@ -37,3 +82,40 @@ def test_message_serialization(message):
     """
     after_serialization_message = Message.deserialize(message.serialize())
     assert_objects_have_same_attributes(message, after_serialization_message)
+
+
+def test_sharing_info_batch_response_deduplicates_origins():
+    """
+    An origin sharing multiple files should only be serialized once in a SharingInfoBatchResponseMessage.
+    """
+    data = SharingInfoBatchResponseMessage([DUMMY_SHARED_FILE_WITH_ORIGINS, DUMMY_OTHER_SHARED_FILE]).serialize()
+    assert data.count(DUMMY_OTHER_ORIGIN.unique_id.encode("utf-8")) == 1
+
+
+def test_legacy_serialization():
+    """
+    Values which fit in 32 bits must be serialized exactly as legacy clients serialize them, and messages sent by legacy
+    clients must still be understood.
+    """
+    assert FileMessage(DUMMY_SHARED_FILE).serialize()[-UNIQUE_ID_LENGTH - 4: -UNIQUE_ID_LENGTH] == \
+        struct.pack("I", DUMMY_SIZE)
+    assert StartFileTransferMessage(DUMMY_UNIQUE_ID, DUMMY_CHUNK_NUM).serialize() == \
+        struct.pack("I", START_FILE_TRANSFER_MESSAGE_TYPE) + DUMMY_UNIQUE_ID.encode("utf-8") + \
+        struct.pack("I", DUMMY_CHUNK_NUM)
+    legacy_client_id = Message.deserialize(struct.pack("I", CLIENT_ID_MESSAGE_TYPE) + DUMMY_UNIQUE_ID.encode("utf-8"))
+    assert legacy_client_id.protocol_version == LEGACY_PROTOCOL_VERSION
+    # a size which equals the marker itself must be serialized as a large value
+    marker_file = SharedFile(DUMMY_UNIQUE_ID, DUMMY_NAME, DUMMY_MODIFICATION_TIME, LARGE_VALUE_MARKER, [])
+    assert FileMessage.deserialize(FileMessage(marker_file).serialize())[0].file.size == LARGE_VALUE_MARKER
+    assert not is_legacy_file(marker_file)
+
+
+
+def test_legacy_chunk_size():
+    """
+    Files sent by legacy clients (which don't send chunk sizes) must have the legacy chunk size.
+    """
+    data = ShareFileMessage(DUMMY_SCALED_SHARED_FILE).serialize()
+    assert Message.deserialize(data).file.chunk_size == DUMMY_SCALED_SHARED_FILE.chunk_size
+    assert Message.deserialize(data[:-4]).file.chunk_size == LEGACY_CHUNK_SIZE
+    assert not is_legacy_file(DUMMY_SCALED_SHARED_FILE)
@@ -0,0 +1,70 @@
+from p2p_fileshare.server.origin_selection import OriginSelector
+from p2p_fileshare.framework.types import SharingClientInfo
+from p2p_fileshare.framework.messages import LoadReportMessage
+from collections import Counter
+import random
+
+
+ORIGINS = [SharingClientInfo(f"{index:032}", ('10.0.0.1', 1000 + index)) for index in range(50)]
+
+
+def test_origin_sample_is_bounded():
+    selector = OriginSelector()
+    sample = selector.sample(ORIGINS, max_origins=10)
+    assert len(sample) == 10
+    assert len(set(sample)) == 10
+    assert len(selector.sample(ORIGINS)) == OriginSelector.DEFAULT_MAX_ORIGINS
+
+
+def test_origin_sample_excludes_known_origins():
+    selector = OriginSelector()
+    excluded_origins = [origin.unique_id for origin in ORIGINS[:45]]
+    assert set(selector.sample(ORIGINS, max_origins=10, excluded_origins=excluded_origins)) == set(ORIGINS[45:])
+
+
+def test_origin_sample_spreads_load():
+    """
+    Every origin should be chosen first by some of the downloaders, and fresher origins should be preferred.
+    """
+    random.seed(0)  # stale origins are rarely chosen, so an unlucky run might never choose one of them
+    selector = OriginSelector()
+    for origin in ORIGINS[:25]:
+        selector.record_activity(origin.unique_id)
+    first_choices = Counter(selector.sample(ORIGINS, max_origins=1)[0] for _ in range(5000))
+    assert len(first_choices) == len(ORIGINS)
+    assert sum(first_choices[origin] for origin in ORIGINS[:25]) > sum(first_choices[origin] for origin in ORIGINS[25:])
+
+
+def test_origin_sample_prefers_idle_origins():
+    selector = OriginSelector()
+    for origin in ORIGINS[:2]:
+        selector.record_activity(origin.unique_id)
+    selector.record_load(ORIGINS[0].unique_id, LoadReportMessage(active_uploads=0, upload_rate=0, available_slots=10))
+    selector.record_load(ORIGINS[1].unique_id, LoadReportMessage(active_uploads=9, upload_rate=10 ** 6,
+                                                                 available_slots=1))
+    first_choices = Counter(selector.sample(ORIGINS[:2], max_origins=1)[0] for _ in range(1000))
+    assert first_choices[ORIGINS[0]] > first_choices[ORIGINS[1]]
+
+
+def test_origin_sample_prefers_fast_origins():
+    selector = OriginSelector()
+    for origin in ORIGINS[:2]:
+        selector.record_activity(origin.unique_id)
+    selector.record_load(ORIGINS[0].unique_id, LoadReportMessage(active_uploads=4, upload_rate=10 ** 7,
+                                                                 available_slots=4))
+    selector.record_load(ORIGINS[1].unique_id, LoadReportMessage(active_uploads=4, upload_rate=10 ** 5,
+                                                                 available_slots=4))
+    first_choices = Counter(selector.sample(ORIGINS[:2], max_origins=1)[0] for _ in range(1000))
+    assert first_choices[ORIGINS[0]] > first_choices[ORIGINS[1]]
+
+
+def test_origin_sample_shields_saturated_origins():
+    selector = OriginSelector()
+    for origin in ORIGINS[:45]:
+        selector.record_load(origin.unique_id, LoadReportMessage(active_uploads=10, upload_rate=10 ** 6,
+                                                                 available_slots=0))
+    assert set(selector.sample(ORIGINS, max_origins=10)) == set(ORIGINS[45:])
+    # when all the origins are saturated, they should still be returned
+    assert len(selector.sample(ORIGINS[:45], max_origins=10)) == 10
+    selector.forget(ORIGINS[0].unique_id)
+    assert selector.sample(ORIGINS[:45], max_origins=10) == [ORIGINS[0]]
@@ -0,0 +1,85 @@
+from p2p_fileshare.client.files_manager import FilesManager
+from p2p_fileshare.client.peer_exchange import PeerTable
+from p2p_fileshare.client.file_transfer import FileDownloader
+from p2p_fileshare.server.server import MetadataServer
+from p2p_fileshare.framework.channel import Channel
+from p2p_fileshare.framework.messages import PeerExchangeMessage
+from p2p_fileshare.framework.types import SharingClientInfo, SharedFile
+from conftest import LOCAL_HOST
+import socket
+import tempfile
+import os
+
+
+PEERS = [SharingClientInfo(f"{index:032}", ('10.0.0.1', 1000 + index)) for index in range(5)]
+FILE_ID = 'f' * 32
+
+
+def test_peer_table_is_bounded(monkeypatch):
+    monkeypatch.setattr(PeerTable, 'MAX_PEERS_PER_FILE', 3)
+    peer_table = PeerTable()
+    peer_table.add_peers(FILE_ID, PEERS)
+    assert peer_table.get_peers(FILE_ID) == [PEERS[4], PEERS[3], PEERS[2]]
+    assert peer_table.get_peers(FILE_ID, excluded_peers=[PEERS[3].unique_id]) == [PEERS[4], PEERS[2]]
+    assert peer_table.get_peers('e' * 32) == []
+
+
+def test_peer_table_expires_peers(monkeypatch):
+    peer_table = PeerTable()
+    peer_table.add_peers(FILE_ID, PEERS[:2])
+    monkeypatch.setattr(PeerTable, 'PEER_TTL', -1)
+    assert peer_table.get_peers(FILE_ID) == []
+
+
+def test_peer_exchange_origins_are_capped(monkeypatch):
+    """
+    Origins learned via peer exchange must not crowd out the origins handed out by the server.
+    """
+    monkeypatch.setattr(FileDownloader, 'MAX_SERVER_ORIGINS', 4)
+    monkeypatch.setattr(FileDownloader, 'MAX_PEX_ORIGINS', 3)
+    monkeypatch.setattr(FileDownloader, 'MAX_NEW_PEERS_PER_EXCHANGE', 2)
+    origins = [SharingClientInfo(f"{index:032}", ('10.0.0.2', 2000 + index)) for index in range(20)]
+    # the file downloader isn't started, only its origins bookkeeping is used
+    downloader = FileDownloader.__new__(FileDownloader)
+    downloader._file_info = SharedFile(FILE_ID, 'file', 0, 0, origins[:2])
+    downloader._pex_origins = set()
+
+    downloader._add_origins(origins[2:10], from_peer_exchange=True)
+    assert downloader._file_info.origins == origins[:4]
+    downloader._add_origins(origins[10:20], from_peer_exchange=True)
+    assert downloader._file_info.origins == origins[:4] + [origins[10]]
+    # the server's origins have their own cap, and origins vouched for by the server no longer count as PEX origins
+    downloader._add_origins(origins[2:3] + origins[15:20])
+    assert downloader._file_info.origins == origins[:4] + [origins[10], origins[15]]
+    downloader._add_origins(origins[11:13], from_peer_exchange=True)
+    assert downloader._file_info.origins == origins[:4] + [origins[10], origins[15], origins[11]]
+
+
+def _exchange_peers(share_port: int, file_id: str, peers: list[SharingClientInfo]) -> list[SharingClientInfo]:
+    s = socket.socket()
+    s.connect((LOCAL_HOST, share_port))
+    channel = Channel(s)
+    try:
+        return channel.send_msg_and_wait_for_response(PeerExchangeMessage(file_id, peers)).peers
+    finally:
+        channel.close()
+
+
+def test_peer_exchange(metadata_server: MetadataServer, first_client: FilesManager):
+    """
+    Exchange peers with the first client's sharing server as two different downloaders, and make sure the second one
+    learns about the origins known by the first one.
+    """
+    with tempfile.TemporaryDirectory() as shared_dir:
+        file_path = os.path.join(shared_dir, 'pex_file')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(1000))
+        first_client.share_file(file_path)
+        file_id = FilesManager._calculate_file_hash(file_path)
+        share_port = first_client._file_share_server.sharing_port
+
+        assert _exchange_peers(share_port, file_id, PEERS[:2]) == []
+        assert _exchange_peers(share_port, file_id, PEERS[1:3]) == [PEERS[0]]
+        # files which aren't shared by the client have no peers
+        assert _exchange_peers(share_port, FILE_ID, PEERS[3:]) == []
+        assert _exchange_peers(share_port, FILE_ID, []) == []
@@ -0,0 +1,49 @@
+from p2p_fileshare.client.files_manager import FilesManager
+from p2p_fileshare.server.server import MetadataServer
+from p2p_fileshare.framework.messages import SEARCH_SORT_SIZE
+from conftest import generate_random_name
+import tempfile
+import os
+import time
+
+
+def test_paginated_search(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager):
+    """
+    Share several files with a common name prefix and make sure a paginated search retrieves each of them exactly once,
+    in the requested order, using the next offset returned by the server.
+    """
+    prefix = generate_random_name(10)
+    sizes = [300, 100, 200]
+    with tempfile.TemporaryDirectory() as shared_dir:
+        for index, size in enumerate(sizes):
+            file_path = os.path.join(shared_dir, f"{prefix}_{index}")
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(size))
+            first_client.share_file(file_path)
+        time.sleep(1)  # wait a bit so that the server will update its DB
+
+        first_page, next_offset = second_client.search_file_page(prefix, limit=2, sort_by=SEARCH_SORT_SIZE)
+        assert [file.size for file in first_page] == [100, 200]
+        assert next_offset == 2
+        second_page, next_offset = second_client.search_file_page(prefix, limit=2, offset=next_offset,
+                                                                  sort_by=SEARCH_SORT_SIZE)
+        assert [file.size for file in second_page] == [300]
+        assert next_offset is None
+        assert sorted(file.size for file in second_client.search_file(prefix)) == sorted(sizes)
+
+
+def test_search_wildcards_are_literal(metadata_server: MetadataServer, first_client: FilesManager,
+                                      second_client: FilesManager):
+    """
+    Make sure LIKE's wildcard characters in a searched name only match themselves.
+    """
+    prefix = generate_random_name(10)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        for name in [f"{prefix}_100%", f"{prefix}A100X"]:
+            with open(os.path.join(shared_dir, name), 'wb') as f:
+                f.write(os.urandom(100))
+            first_client.share_file(os.path.join(shared_dir, name))
+        time.sleep(1)  # wait a bit so that the server will update its DB
+
+        assert [file.name for file in second_client.search_file(f"{prefix}_100%")] == [f"{prefix}_100%"]
+        assert [file.name for file in second_client.search_file(f"{prefix}_")] == [f"{prefix}_100%"]
@@ -0,0 +1,51 @@
+from p2p_fileshare.server.search_cache import SearchCache
+import time
+
+
+DUMMY_RESULT = ['result']
+
+
+def test_search_cache_lru_eviction():
+    """
+    Fill the cache beyond its size and make sure the least recently used entry is the one evicted.
+    """
+    cache = SearchCache(max_size=2)
+    cache.store(('first',), DUMMY_RESULT, cache.generation)
+    cache.store(('second',), DUMMY_RESULT, cache.generation)
+    assert cache.lookup(('first',)) is DUMMY_RESULT  # 'second' is now the least recently used entry
+    cache.store(('third',), DUMMY_RESULT, cache.generation)
+    assert cache.lookup(('second',)) is None
+    assert cache.lookup(('first',)) is DUMMY_RESULT
+    assert cache.stats['hits'] == 2 and cache.stats['misses'] == 1
+
+
+def test_search_cache_ttl():
+    cache = SearchCache(ttl=0.5)
+    cache.store(('file',), DUMMY_RESULT, cache.generation)
+    assert cache.lookup(('file',)) is DUMMY_RESULT
+    time.sleep(0.6)
+    assert cache.lookup(('file',)) is None
+
+
+def test_search_cache_invalidation():
+    """
+    Only searches that match the file name (according to the DB's LIKE semantics) should be invalidated.
+    """
+    cache = SearchCache()
+    for searched_string in ['movie', 'MOV', 'm_vie', 'song', 'mo%e']:
+        cache.store((searched_string, 0), DUMMY_RESULT, cache.generation)
+    cache.invalidate_file_names(['my_movie.mkv'])
+    assert cache.lookup(('song', 0)) is DUMMY_RESULT
+    for searched_string in ['movie', 'MOV', 'm_vie', 'mo%e']:
+        assert cache.lookup((searched_string, 0)) is None
+
+
+def test_search_cache_concurrent_invalidation():
+    """
+    A result computed before an invalidation took place must not be cached.
+    """
+    cache = SearchCache()
+    generation = cache.generation
+    cache.invalidate_file_names(['file'])
+    cache.store(('file',), DUMMY_RESULT, generation)
+    assert cache.lookup(('file',)) is None
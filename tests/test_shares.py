@@ -0,0 +1,130 @@
+from p2p_fileshare.client.files_manager import FilesManager
+from p2p_fileshare.client.db_manager import DBManager
+from p2p_fileshare.framework import db
+from p2p_fileshare.framework.hashing import calculate_file_hashes
+from p2p_fileshare.server.server import MetadataServer
+from conftest import generate_random_name
+import tempfile
+import pytest
+import os
+import time
+
+
+def test_batch_share_and_remove(metadata_server: MetadataServer, first_client: FilesManager,
+                                second_client: FilesManager):
+    """
+    Share multiple files using a single batch (including a file that appears twice in the batch), make sure they can all
+    be found, and then remove all of the shares using a single batch.
+    """
+    prefix = generate_random_name(10)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        file_paths = []
+        for index in range(3):
+            file_paths.append(os.path.join(shared_dir, f"{prefix}_{index}"))
+            with open(file_paths[-1], 'wb') as f:
+                f.write(os.urandom(100))
+
+        statuses = first_client.share_files(file_paths + [file_paths[0]])
+        assert statuses == [True, True, True, False]
+        assert len(first_client.list_shares()) == 3
+        time.sleep(1)  # wait a bit so that the server will update its DB
+        found_files = second_client.search_file(prefix)
+        assert len(found_files) == 3
+
+        unique_ids = [found_file.unique_id for found_file in found_files]
+        assert first_client.remove_shares(unique_ids + [unique_ids[0]]) == [True, True, True, False]
+        assert len(first_client.list_shares()) == 0
+        assert second_client.search_file(prefix) == []
+
+
+def test_share_index(monkeypatch):
+    """
+    Make sure the shares are looked up in memory only, while changes to them are kept in the DB as well.
+    """
+    with tempfile.TemporaryDirectory() as db_dir:
+        file_path = os.path.join(db_dir, "shared_file")
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(100))
+        local_db = DBManager(os.path.join(db_dir, "client.db"))
+        file_hash, chunk_hashes = calculate_file_hashes(file_path, 1024, local_db)
+        local_db.add_share(file_hash, file_path)
+        local_db.add_chunk_hashes([(file_hash, chunk_hashes, 1024)])
+        local_db.add_shares([("b" * 32, "other_file")])
+
+        reloaded_db = DBManager(local_db.db_path)
+        reloaded_db.load_shares()
+
+        def _fail_db_access(*args, **kwargs):
+            raise AssertionError("The DB was accessed")
+
+        monkeypatch.setattr(db, 'db_cursor', _fail_db_access)
+        for manager in (local_db, reloaded_db):
+            assert manager.is_there_any_shared_file()
+            assert manager.get_shared_file_path(file_hash) == file_path
+            assert manager.get_chunk_size(file_hash) == 1024
+            assert manager.get_share(file_hash).file_key[1:] == (os.stat(file_path).st_ino, 100,
+                                                                 os.stat(file_path).st_mtime_ns)
+            assert manager.get_chunk_size("b" * 32) is None
+            assert sorted(manager.list_shares()) == sorted([(file_path, file_hash), ("other_file", "b" * 32)])
+        monkeypatch.undo()
+
+        local_db.remove_shares([file_hash, "c" * 32])
+        with pytest.raises(ValueError):
+            local_db.remove_share(file_hash)
+        local_db.remove_share("b" * 32)
+        assert not local_db.is_there_any_shared_file()
+        reloaded_db = DBManager(local_db.db_path)
+        assert reloaded_db.list_shares() == []
+
+
+def test_directory_share(metadata_server: MetadataServer, first_client: FilesManager, second_client: FilesManager,
+                         monkeypatch):
+    """
+    Share a directory tree, change it, and make sure rescanning it only hashes the new and changed files, shares them,
+    and stops sharing the files which were changed or removed.
+    """
+    prefix = generate_random_name(10)
+    hashed_files = []
+    original_create_shared_file = FilesManager._create_shared_file
+
+    def _create_shared_file(self, file_path):
+        hashed_files.append(os.path.basename(file_path))
+        return original_create_shared_file(self, file_path)
+
+    monkeypatch.setattr(FilesManager, '_create_shared_file', _create_shared_file)
+    with tempfile.TemporaryDirectory() as shared_dir:
+        os.makedirs(os.path.join(shared_dir, "sub", "subsub"))
+        file_paths = {name: os.path.join(shared_dir, *sub_dirs, f"{prefix}_{name}")
+                      for name, sub_dirs in [("top", []), ("sub", ["sub"]), ("deep", ["sub", "subsub"])]}
+        for file_path in file_paths.values():
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(100))
+
+        first_client.share_directory(shared_dir).join()
+        assert sorted(hashed_files) == sorted(f"{prefix}_{name}" for name in file_paths)
+        assert first_client.list_shared_directories() == [os.path.abspath(shared_dir)]
+        time.sleep(1)  # wait a bit so that the server will update its DB
+        assert len(second_client.search_file(prefix)) == 3
+
+        hashed_files.clear()
+        first_client.rescan_directories()
+        assert hashed_files == []
+
+        os.unlink(file_paths["deep"])
+        with open(file_paths["top"], 'ab') as f:
+            f.write(b"more data")
+        with open(os.path.join(shared_dir, "sub", f"{prefix}_new"), 'wb') as f:
+            f.write(os.urandom(100))
+        first_client.rescan_directories()
+        assert sorted(hashed_files) == [f"{prefix}_new", f"{prefix}_top"]
+        time.sleep(1)
+        found_files = second_client.search_file(prefix)
+        assert sorted(found_file.name for found_file in found_files) == \
+            sorted([f"{prefix}_new", f"{prefix}_sub", f"{prefix}_top"])
+        assert sorted(file_path for file_path, _ in first_client.list_shares()) == \
+            sorted([file_paths["top"], file_paths["sub"], os.path.join(shared_dir, "sub", f"{prefix}_new")])
+
+        first_client.remove_directory_share(shared_dir)
+        assert first_client.list_shares() == []
+        assert first_client.list_shared_directories() == []
+        assert second_client.search_file(prefix) == []
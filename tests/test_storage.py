@@ -0,0 +1,91 @@
+from p2p_fileshare.framework.storage import FileStorage
+from p2p_fileshare.client.file_share import OpenFilesCache
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import pytest
+import os
+
+
+PIECE_SIZE = 4096
+
+
+@pytest.fixture
+def storage_path():
+    with tempfile.TemporaryDirectory() as storage_dir:
+        yield os.path.join(storage_dir, 'storage')
+
+
+def test_preallocate_keeps_existing_data(storage_path):
+    with open(storage_path, 'wb') as f:
+        f.write(b'existing data')
+    storage = FileStorage(storage_path, writable=True)
+    storage.preallocate(10 * 1024 * 1024)
+    assert storage.size == os.path.getsize(storage_path) == 10 * 1024 * 1024
+    assert storage.read(0, 13) == b'existing data'
+    assert storage.read(13, 10) == bytes(10)
+    storage.close()
+    assert storage.closed
+
+
+def test_concurrent_positional_access(storage_path):
+    """
+    Write and read pieces from multiple threads at once, without any of them interfering with the others.
+    """
+    pieces = [os.urandom(PIECE_SIZE) for _ in range(64)]
+    storage = FileStorage(storage_path, writable=True)
+    storage.preallocate(len(pieces) * PIECE_SIZE)
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda index: storage.write(index * PIECE_SIZE, pieces[index]), range(len(pieces))))
+        assert list(executor.map(lambda index: storage.read(index * PIECE_SIZE, PIECE_SIZE),
+                                 range(len(pieces)))) == pieces
+    # reading past the end of the file returns less data
+    assert storage.read((len(pieces) - 1) * PIECE_SIZE, 2 * PIECE_SIZE) == pieces[-1]
+    storage.close()
+    with pytest.raises(ValueError):
+        storage.read(0, PIECE_SIZE)
+
+
+@pytest.mark.parametrize('has_preadv', [True, False])
+def test_read_into(storage_path, monkeypatch, has_preadv: bool):
+    if not has_preadv:
+        monkeypatch.delattr(os, 'preadv', raising=False)
+    data = os.urandom(3 * PIECE_SIZE)
+    with open(storage_path, 'wb') as f:
+        f.write(data)
+    storage = FileStorage(storage_path)
+    buffer = bytearray(2 * PIECE_SIZE)
+    assert storage.read_into(PIECE_SIZE, memoryview(buffer)) == 2 * PIECE_SIZE and buffer == data[PIECE_SIZE:]
+    # reading past the end of the file reads less data
+    assert storage.read_into(2 * PIECE_SIZE, memoryview(buffer)) == PIECE_SIZE
+    assert buffer[:PIECE_SIZE] == data[2 * PIECE_SIZE:]
+    storage.close()
+
+
+def test_read_only_storage(storage_path):
+    with open(storage_path, 'wb') as f:
+        f.write(b'data')
+    storage = FileStorage(storage_path)
+    assert storage.read(0, 100) == b'data'
+    with pytest.raises(OSError):
+        storage.write(0, b'other data')
+    storage.close()
+
+
+def test_open_files_are_reused(storage_path, monkeypatch):
+    monkeypatch.setattr(OpenFilesCache, 'MAX_OPEN_FILES', 1)
+    with open(storage_path, 'wb') as f:
+        f.write(b'shared data')
+    open_files = OpenFilesCache()
+    with open_files.open('f' * 32, storage_path) as first_storage:
+        pass
+    with open_files.open('f' * 32, storage_path) as storage:
+        assert storage is first_storage
+        # storages which are in use are never closed
+        with open_files.open('e' * 32, storage_path) as other_storage:
+            assert not storage.closed
+        assert storage.read(0, 6) == b'shared'
+    with open_files.open('d' * 32, storage_path) as storage:
+        assert storage is not first_storage and storage is not other_storage
+    assert first_storage.closed and other_storage.closed
+    open_files.close()
+    assert storage.closed
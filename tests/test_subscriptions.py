@@ -0,0 +1,99 @@
+from p2p_fileshare.client.files_manager import FilesManager
+from p2p_fileshare.server.server import MetadataServer
+from p2p_fileshare.server.channel import ClientChannel
+from p2p_fileshare.server.search_cache import SearchCache
+from p2p_fileshare.server.origin_selection import OriginSelector
+from p2p_fileshare.server.subscriptions import SubscriptionManager, Subscriber
+from p2p_fileshare.framework.messages import SubscribeOriginsMessage, UnsubscribeOriginsMessage, \
+    OriginsUpdateMessage, ClientIdMessage
+from p2p_fileshare.framework.selectable_event import generate_socket_pair
+from unittest.mock import Mock
+from threading import Event
+from select import select
+from queue import Queue
+import sqlite3
+import tempfile
+import os
+
+
+def test_origin_changes_are_pushed(metadata_server: MetadataServer, first_client: FilesManager,
+                                   second_client: FilesManager):
+    """
+    Subscribe to the origins of a file via the second client, and make sure the server pushes the origin changes made by
+    the first client sharing the file and then removing its share.
+    """
+    with tempfile.TemporaryDirectory() as shared_dir:
+        file_path = os.path.join(shared_dir, 'subscribed_file')
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(1000))
+        file_id = FilesManager._calculate_file_hash(file_path)
+
+        updates = Queue()
+        server_channel = second_client._communication_channel
+        server_channel.add_push_handler(OriginsUpdateMessage, updates.put)
+        try:
+            server_channel.send_msg_and_wait_for_response(SubscribeOriginsMessage(file_id))
+            first_client.share_file(file_path)
+            update = updates.get(timeout=5)
+            assert update.file_unique_id == file_id
+            assert len(update.added_origins) == 1 and update.removed_origins == []
+            origin = update.added_origins[0]
+            assert origin.port == first_client._file_share_server.sharing_port
+
+            first_client.remove_share(file_id)
+            update = updates.get(timeout=5)
+            assert update.added_origins == [] and update.removed_origins == [origin.unique_id]
+
+            server_channel.send_message(UnsubscribeOriginsMessage(file_id))
+            # the unsubscription is handled before the following request, so no more changes should be pushed
+            second_client.search_file('subscribed_file')
+            first_client.share_file(file_path)
+            second_client.search_file('subscribed_file')
+            assert updates.empty()
+        finally:
+            server_channel.remove_push_handler(OriginsUpdateMessage, updates.put)
+
+
+def test_disconnect_survives_db_errors(client_and_server_channels):
+    """
+    Make sure a client whose disconnection fails to update the DB is still unsubscribed and removed by the server.
+    """
+    client_channel, server_channel = client_and_server_channels
+    db = Mock()
+    db.get_shared_file_names.return_value = []
+    db.get_shared_file_ids.side_effect = sqlite3.OperationalError("no such table: files")
+    subscription_manager = SubscriptionManager()
+    finished_provider, finished_consumer = generate_socket_pair()
+    ClientChannel(server_channel, db, lambda: [], finished_provider, SearchCache(), OriginSelector(),
+                  subscription_manager, Event())
+    client_channel.send_message(ClientIdMessage('c' * 32))
+    client_channel.send_msg_and_wait_for_response(SubscribeOriginsMessage('f' * 32))
+    assert len(subscription_manager._subscribers['f' * 32]) == 1
+
+    client_channel.close()
+    rlist, _, _ = select([finished_consumer], [], [], 5)
+    assert rlist, "The server wasn't signaled that the client has finished"
+    assert 'f' * 32 not in subscription_manager._subscribers
+
+
+def test_updates_are_sent_by_the_subscriber():
+    """
+    Publishing must not block on the subscribers' sockets - the updates should be queued until each subscriber's own
+    thread sends them.
+    """
+    channel = Mock()
+    subscriber = Subscriber(channel)
+    subscription_manager = SubscriptionManager()
+    assert subscription_manager.subscribe('f' * 32, subscriber)
+    subscription_manager.publish(['f' * 32, 'e' * 32], removed_origins=['c' * 32])
+    subscription_manager.publish(['f' * 32], removed_origins=['d' * 32])
+    channel.send_message.assert_not_called()
+
+    rlist, _, _ = select([subscriber], [], [], 5)
+    assert rlist, "The subscriber wasn't signaled about the pending updates"
+    subscriber.send_pending_updates()
+    updates = [call.args[0] for call in channel.send_message.call_args_list]
+    assert [update.removed_origins for update in updates] == [['c' * 32], ['d' * 32]]
+    rlist, _, _ = select([subscriber], [], [], 0)
+    assert not rlist
+    subscriber.close()
@@ -20,19 +20,31 @@ def is_builtin(obj):
     return obj.__class__.__module__ == 'builtins'
 
 
+def assert_lists_have_same_items(first: list, second: list):
+    assert isinstance(second, list), "Objects have different type!"
+    assert len(first) == len(second), "Lists have different lengths"
+    for first_item, second_item in zip(first, second):
+        if is_builtin(first_item):
+            assert first_item == second_item
+        else:
+            assert_objects_have_same_attributes(first_item, second_item)
+
+
 def assert_objects_have_same_attributes(first, second):
     """
     Make sure both objects passed to this function have the same attributes set, and that each one of their attributes
     have equal value.
     If one of the object's attributes is of non builtin type we cannot assume it has a valid __eq__ method and we'll
-    resort to using this function recursively on it.
+    resort to using this function recursively on it (the same goes for the items of list attributes).
     """
     assert isinstance(first, type(second)), "Objects have different type!"
     assert set(first.__dict__) == set(second.__dict__), "Objects have non matching attributes set"
     for attr in first.__dict__:
         first_attr = getattr(first, attr)
         second_attr = getattr(second, attr)
-        if is_builtin(first_attr):
+        if isinstance(first_attr, list):
+            assert_lists_have_same_items(first_attr, second_attr)
+        elif is_builtin(first_attr):
             assert first_attr == second_attr
         else:
             assert_objects_have_same_attributes(first_attr, second_attr)
\ No newline at end of file